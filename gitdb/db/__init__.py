@@ -9,3 +9,4 @@ from gitdb.db.mem import *
 from gitdb.db.pack import *
 from gitdb.db.git import *
 from gitdb.db.ref import *
+from gitdb.db.overlay import *
@@ -9,12 +9,17 @@ from gitdb.util import (
     hex_to_bin
 )
 
-from gitdb.utils.encoding import force_text
+from gitdb.utils.encoding import (
+    force_bytes,
+    force_text
+)
 from gitdb.exc import (
     BadObject,
     AmbiguousObjectName
 )
 
+from collections import OrderedDict
+from contextlib import suppress
 from itertools import chain
 from functools import reduce
 
@@ -60,6 +65,21 @@ class ObjectDBR:
         """Return iterator yielding 20 byte shas for all objects in this data base"""
         raise NotImplementedError()
 
+    def iter_by_type(self, type):
+        """Return iterator yielding 20 byte shas of all objects of the given type
+
+        :param type: type string, like 'blob' or 'tree'
+
+        **Note:** this default implementation queries the info of each object, subclasses
+            may implement it more efficiently"""
+        type = force_bytes(type)
+        info = self.info
+        for sha in self.sha_iter():
+            if info(sha).type == type:
+                yield sha
+            # END handle type match
+        # END for each sha
+
     #} END query interface
 
 
@@ -168,13 +188,38 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
     """A database which delegates calls to sub-databases.
 
     Databases are stored in the lazy-loaded _dbs attribute.
-    Define _set_cache_ to update it with your databases"""
+    Define _set_cache_ to update it with your databases
+
+    The sub-database containing an object is remembered in a bounded LRU cache. Entries
+    are invalidated per sub-database, once it reports a change in ``update_cache``.
+
+    Sub-databases are queried in order of the amount of objects found in them, which
+    is updated periodically"""
+
+    # maximum amount of shas whose sub-database is remembered
+    db_cache_size = 64 * 1024
+    # if True, shas which were not found are remembered as well, until ``update_cache``
+    # is forced or a sub-database reports a change. Only suitable if objects are added
+    # through this instance, or if new objects are announced by calling update_cache
+    db_cache_negative = False
+    # amount of lookups missing the cache after which the sub-databases are reordered,
+    # or 0 to keep their order
+    db_sort_interval = 500
 
     def _set_cache_(self, attr):
         if attr == '_dbs':
             self._dbs = list()
-        elif attr == '_db_cache':
-            self._db_cache = dict()
+        elif attr in ('_db_cache', '_db_generations', '_db_cache_stats'):
+            # sha -> (sub-database or None if missing, generation of the sub-database)
+            self._db_cache = OrderedDict()
+            # sub-database or None -> generation, which invalidates all older entries
+            self._db_generations = dict()
+            # hits, misses, negative hits, evictions
+            self._db_cache_stats = [0, 0, 0, 0]
+        elif attr in ('_db_stats', '_db_lookups'):
+            # sub-database -> [hits, misses] of lookups missing the cache
+            self._db_stats = dict()
+            self._db_lookups = 0
         else:
             super()._set_cache_(attr)
 
@@ -183,19 +228,67 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
         :raise BadObject:"""
         # most databases use binary representations, prevent converting
         # it every time a database is being queried
-        try:
-            return self._db_cache[sha]
-        except KeyError:
-            pass
+        entry = self._db_cache.get(sha)
+        if entry is not None and entry[1] == self._db_generations.get(entry[0], 0):
+            with suppress(KeyError):
+                self._db_cache.move_to_end(sha)
+            # END another thread may have evicted it
+            db = entry[0]
+            if db is None:
+                self._db_cache_stats[2] += 1
+                raise BadObject(sha)
+            # END handle known missing object
+            self._db_cache_stats[0] += 1
+            return db
         # END first level cache
 
+        self._db_cache_stats[1] += 1
+        self._db_lookups += 1
+        if self.db_sort_interval and self._db_lookups % self.db_sort_interval == 0:
+            self._sort_dbs()
+        # END update sorting
+
+        stats = self._db_stats
         for db in self._dbs:
             if db.has_object(sha):
-                self._db_cache[sha] = db
+                stats.setdefault(db, [0, 0])[0] += 1
+                self._cache_route(sha, db)
                 return db
+            # END handle hit
+            stats.setdefault(db, [0, 0])[1] += 1
         # END for each database
+        if self.db_cache_negative:
+            self._cache_route(sha, None)
+        # END remember missing object
         raise BadObject(sha)
 
+    def _cache_route(self, sha, db):
+        """Remember the given sub-database to contain the given sha, or that it is missing if db is None"""
+        cache = self._db_cache
+        cache.pop(sha, None)
+        cache[sha] = (db, self._db_generations.get(db, 0))
+        while len(cache) > self.db_cache_size:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                break
+            # END another thread may have emptied it
+            self._db_cache_stats[3] += 1
+        # END evict least recently used entries
+
+    def _sort_dbs(self):
+        """Query the sub-databases with the most hits first
+        **Note:** like ``PackedDB._sort_entities``, this doesn't lock. A new sorted list is
+            bound instead of reordering the existing one, so concurrent lookups keep iterating
+            the previous list and always see all databases"""
+        stats = self._db_stats
+        self._dbs = sorted(self._dbs, key=lambda db: stats.get(db, (0, 0))[0], reverse=True)
+
+    def _forget_route(self, sha):
+        """Forget the cached sub-database of the given sha, which is required once an object
+        previously remembered as missing was added"""
+        self._db_cache.pop(sha, None)
+
     #{ ObjectDBR interface
 
     def has_object(self, sha):
@@ -207,10 +300,25 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
         # END handle exceptions
 
     def info(self, sha):
-        return self._db_query(sha).info(sha)
+        try:
+            return self._db_query(sha).info(sha)
+        except BadObject:
+            # the object may have moved to another database since its route was cached
+            if sha not in self._db_cache:
+                raise
+            self._forget_route(sha)
+            return self._db_query(sha).info(sha)
+        # END handle stale routes
 
     def stream(self, sha):
-        return self._db_query(sha).stream(sha)
+        try:
+            return self._db_query(sha).stream(sha)
+        except BadObject:
+            if sha not in self._db_cache:
+                raise
+            self._forget_route(sha)
+            return self._db_query(sha).stream(sha)
+        # END handle stale routes
 
     def size(self):
         """:return: total size of all contained databases"""
@@ -219,6 +327,9 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
     def sha_iter(self):
         return chain(*(db.sha_iter() for db in self._dbs))
 
+    def iter_by_type(self, type):
+        return chain(*(db.iter_by_type(type) for db in self._dbs))
+
     #} END object DBR Interface
 
     #{ Interface
@@ -228,16 +339,64 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
         return tuple(self._dbs)
 
     def update_cache(self, force=False):
-        # something might have changed, clear everything
-        self._db_cache.clear()
+        # only the entries of databases which changed are invalidated
         stat = False
         for db in self._dbs:
-            if isinstance(db, CachingDB):
-                stat |= db.update_cache(force)
+            if isinstance(db, CachingDB) and db.update_cache(force):
+                self.invalidate_cache(db)
+                stat = True
             # END if is caching db
         # END for each database to update
+        if force:
+            # databases which don't cache may have changed as well
+            self._db_generations[None] = self._db_generations.get(None, 0) + 1
+        # END handle forced update
         return stat
 
+    def invalidate_cache(self, db=None):
+        """Forget which objects the given sub-database contains, as well as all objects
+        remembered to be missing, as the database changed
+
+        :param db: one of our sub-databases, or None to forget everything"""
+        if db is None:
+            self._db_cache.clear()
+            return
+        # END handle full invalidation
+        generations = self._db_generations
+        generations[db] = generations.get(db, 0) + 1
+        generations[None] = generations.get(None, 0) + 1
+
+    def remove_db(self, db):
+        """Stop querying the given sub-database, and forget all information about it
+
+        :param db: one of our sub-databases
+        :raise ValueError: if it isn't one of our sub-databases"""
+        dbs = list(self._dbs)
+        dbs.remove(db)
+        # like in _sort_dbs, concurrent lookups keep iterating the previous list
+        self._dbs = dbs
+        self._db_stats.pop(db, None)
+        self._db_generations.pop(db, None)
+        # routes to the database would become valid again without its generation - removing
+        # databases is rare enough to forget everything
+        self.invalidate_cache()
+
+    def db_stats(self):
+        """:return: list of tuple(database, hits, misses) for each sub-database, in the order
+            they are queried. Only lookups which missed the cache are counted, hits being
+            the amount of objects found in the database, misses the amount of queries for
+            objects it didn't contain"""
+        stats = self._db_stats
+        return [(db, *stats.get(db, (0, 0))) for db in self._dbs]
+
+    def cache_info(self):
+        """:return: dict with the statistics of the cache of sub-databases containing objects:
+            hits, misses, negative_hits (lookups of objects known to be missing), evictions,
+            and size, the amount of entries"""
+        hits, misses, negative_hits, evictions = self._db_cache_stats
+        return dict(hits=hits, misses=misses, negative_hits=negative_hits,
+                    evictions=evictions, size=len(self._db_cache))
+
     def partial_to_complete_sha_hex(self, partial_hexsha):
         """
         :return: 20 byte binary sha1 from the given less-than-40 byte hexsha (bytes or str)
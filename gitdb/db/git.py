@@ -9,12 +9,40 @@ from gitdb.db.base import (
 )
 
 from gitdb.db.loose import LooseObjectDB
-from gitdb.db.pack import PackedDB
+from gitdb.db.pack import (
+    PackedDB,
+    PackWriterDB
+)
 from gitdb.db.ref import ReferenceDB
 
-from gitdb.exc import InvalidDBRoot
+from gitdb.exc import (
+    BadObject,
+    InvalidDBRoot
+)
+from gitdb.pack import (
+    PackEntity,
+    OFS_DELTA,
+    REF_DELTA,
+    order_bases_first
+)
+from gitdb.util import bin_to_hex
+from gitdb.base import IStream
+from gitdb.fun import (
+    chunk_size,
+    loose_object_header,
+    stream_copy
+)
+from gitdb.stream import Sha1Writer
+
+from contextlib import (
+    contextmanager,
+    suppress
+)
 
+import tempfile
+import threading
 import os
+import zlib
 
 __all__ = ('GitDB', )
 
@@ -26,20 +54,38 @@ class GitDB(FileDBBase, ObjectDBW, CompoundDB):
 
     ``IMPORTANT``: The usage of this implementation is highly discouraged as it fails to release file-handles.
     This can be a problem with long-running processes and/or big repositories.
+    Set ``PackedDB.max_open_packs`` to bound the amount of packs kept open.
     """
     # Configuration
     PackDBCls = PackedDB
     LooseDBCls = LooseObjectDB
     ReferenceDBCls = ReferenceDB
+    PackWriterDBCls = PackWriterDB
 
     # Directories
     packs_dir = 'pack'
     loose_dir = ''
     alternates_dir = os.path.join('info', 'alternates')
 
-    def __init__(self, root_path):
-        """Initialize ourselves on a git objects directory"""
+    # Maintenance
+    # amount of loose objects required before pack_loose_objects creates a pack
+    pack_min_loose_count = 100
+    # each pack must hold at least this factor more objects than all smaller packs together
+    pack_geometric_factor = 2
+
+    # inputs up to this size are kept in memory while hashing them in dedupe mode
+    dedupe_spool_size = 1024 * 1024
+
+    def __init__(self, root_path, dedupe=False):
+        """Initialize ourselves on a git objects directory
+
+        :param dedupe: if True, ``store`` hashes objects before writing them, and skips
+            compressing and writing objects which exist anywhere in this database already"""
         super().__init__(root_path)
+        self._maintenance_lock = threading.Lock()
+        self._dedupe = dedupe
+        self._num_skipped = 0
+        self._bytes_skipped = 0
 
     def _set_cache_(self, attr):
         if attr == '_dbs' or attr == '_loose_db':
@@ -53,6 +99,9 @@ class GitDB(FileDBBase, ObjectDBW, CompoundDB):
                     self._dbs.append(dbcls(path))
                     if dbcls is self.LooseDBCls:
                         loose_db = self._dbs[-1]
+                    elif dbcls is self.PackDBCls:
+                        # resolve deltas against objects stored anywhere in this database
+                        self._dbs[-1].set_base_db(self)
                     # END remember loose db
                 # END check path exists
             # END for each db type
@@ -74,7 +123,21 @@ class GitDB(FileDBBase, ObjectDBW, CompoundDB):
     #{ ObjectDBW interface
 
     def store(self, istream):
-        return self._loose_db.store(istream)
+        if self._dedupe:
+            istream = self._store_unique(istream)
+        else:
+            istream = self._loose_db.store(istream)
+        # END handle dedupe mode
+        self._forget_route(istream.binsha)
+        return istream
+
+    def store_many(self, istreams, **kwargs):
+        """Store multiple objects as loose objects concurrently, see ``LooseObjectDB.store_many``"""
+        istreams = self._loose_db.store_many(istreams, **kwargs)
+        for istream in istreams:
+            self._forget_route(istream.binsha)
+        # END for each new object
+        return istreams
 
     def ostream(self):
         return self._loose_db.ostream()
@@ -83,3 +146,279 @@ class GitDB(FileDBBase, ObjectDBW, CompoundDB):
         return self._loose_db.set_ostream(ostream)
 
     #} END objectdbw interface
+
+    #{ Interface
+
+    @contextmanager
+    def bulk_store(self, **kwargs):
+        """Context manager yielding a PackWriterDB which writes all objects stored
+        into it into a single new pack, instead of one loose object file each.
+
+        While the context is active, the objects are readable through this database
+        as well. When it exits without error, the new pack is moved into place and
+        our pack database is updated, otherwise the pending pack is discarded::
+
+            with gdb.bulk_store() as bulk_db:
+                for istream in istreams:
+                    bulk_db.store(istream)
+
+        :param kwargs: passed to the PackWriterDB constructor"""
+        pack_dir = self.db_path(self.packs_dir)
+        os.makedirs(pack_dir, exist_ok=True)
+
+        wdb = self.PackWriterDBCls(pack_dir, **kwargs)
+        self._dbs.insert(0, wdb)
+        self.invalidate_cache(wdb)
+        try:
+            with wdb:
+                yield wdb
+            # END commit or rollback
+        finally:
+            self.remove_db(wdb)
+        # END assure pending pack is not queried anymore
+
+        pack_db = self._pack_db()
+        pack_db.update_cache(force=True)
+        self.invalidate_cache(pack_db)
+
+    def pack_loose_objects(self, min_count=None, delete=True, max_count=None):
+        """Move loose objects into new packs to keep lookups in the loose object database fast.
+
+        Each object in the new pack is read back and checked against its sha before the pack
+        is made available to readers, and only afterwards the loose object files are removed.
+        Readers are not blocked meanwhile, as each object is available through either database
+        at all times.
+
+        :param min_count: minimum amount of loose objects required to create a pack,
+            defaults to ``pack_min_loose_count``
+        :param delete: if True, loose objects are removed once they are contained in a pack
+        :param max_count: if not None, at most this amount of objects is written into each
+            pack, producing multiple packs which become available incrementally
+        :return: amount of objects which were packed"""
+        if min_count is None:
+            min_count = self.pack_min_loose_count
+        # END handle default
+
+        with self._maintenance_lock:
+            shas = list(self._loose_db.sha_iter())
+            if not shas or len(shas) < min_count:
+                return 0
+            # END abort if there is too little to do
+
+            pack_db = self._pack_db()
+            pack_dir = pack_db.root_path()
+            batch_size = max_count or len(shas)
+            for start in range(0, len(shas), batch_size):
+                batch = shas[start:start + batch_size]
+                entity = PackEntity.create((self._loose_db.stream(sha) for sha in batch),
+                                           pack_dir, object_count=len(batch))
+                try:
+                    self._verify_pack(entity, batch)
+                finally:
+                    entity.close()
+                # END assure handles are released
+
+                pack_db.update_cache(force=True)
+                self.invalidate_cache(pack_db)
+                self.invalidate_cache(self._loose_db)
+                if delete:
+                    self._loose_db.prune(batch)
+                # END remove loose objects
+            # END for each batch
+        # END maintenance
+        return len(shas)
+
+    def merge_packs(self, factor=None):
+        """Merge small packs into a new one, so that each remaining pack contains at least
+        ``factor`` times more objects than all smaller packs together. This keeps the amount of
+        packs logarithmic in the amount of objects, without rewriting the large packs over and
+        over again.
+
+        Objects which were deltas of other merged objects are deltified against the same base
+        again, which recomputes the delta, and each base is written right in front of its
+        deltas. All objects are read back and checked against their sha before the merged
+        packs are removed. Packs with a .keep file are never merged.
+
+        :param factor: geometric factor, defaults to ``pack_geometric_factor``
+        :return: amount of packs which were merged into a new one"""
+        if factor is None:
+            factor = self.pack_geometric_factor
+        # END handle default
+
+        with self._maintenance_lock:
+            pack_db = self._pack_db()
+            pack_db.update_cache(force=True)
+            entities = [entity for entity in pack_db.entities()
+                        if not os.path.exists(os.path.splitext(entity.pack().path())[0] + '.keep')]
+            entities.sort(key=lambda entity: entity.index().size())
+            counts = [entity.index().size() for entity in entities]
+
+            # find the largest pack which doesn't outgrow all smaller ones together by the
+            # factor - it and all smaller ones get merged. All larger packs keep the progression
+            split = 0
+            total = sum(counts)
+            for i in range(len(counts) - 1, 0, -1):
+                total -= counts[i]
+                if counts[i] < factor * total:
+                    split = i
+                    break
+                # END found break in progression
+            # END for each pack from largest to smallest
+            if split == 0:
+                return 0
+            # END nothing to merge
+            merged = entities[:split + 1]
+
+            # collect all unique objects and the bases of deltas
+            shas = dict()
+            bases = dict()
+            for entity in merged:
+                index, pack_file = entity.index(), entity.pack()
+                offset_to_sha = {index.offset(i): index.sha(i) for i in range(index.size())}
+                for offset, sha in offset_to_sha.items():
+                    if sha in shas:
+                        continue
+                    # END skip duplicates
+                    shas[sha] = entity
+                    info = pack_file.info(offset)
+                    if info.type_id == OFS_DELTA:
+                        bases[sha] = offset_to_sha[offset - info.delta_info]
+                    elif info.type_id == REF_DELTA:
+                        bases[sha] = bytes(info.delta_info)
+                    # END handle delta
+                # END for each object
+            # END for each pack to merge
+            bases = {sha: base_sha for sha, base_sha in bases.items() if base_sha in shas}
+
+            entity = PackEntity.create((shas[sha].stream(sha) for sha in shas), pack_db.root_path(),
+                                       object_count=len(shas), thin_bases=bases, base_db=self,
+                                       order=order_bases_first)
+            try:
+                self._verify_pack(entity, shas)
+                new_pack_path = entity.pack().path()
+            finally:
+                entity.close()
+            # END assure handles are released
+
+            # make the new pack available before the old ones disappear
+            pack_db.update_cache(force=True)
+            self.invalidate_cache(pack_db)
+            merged = [old_entity for old_entity in merged if old_entity.pack().path() != new_pack_path]
+            for old_entity in merged:
+                basename = os.path.splitext(old_entity.pack().path())[0]
+                for ext in ('.pack', '.idx', '.rev', '.bitmap'):
+                    with suppress(FileNotFoundError):
+                        os.remove(basename + ext)
+                    # END ignore missing files
+                # END for each file
+            # END for each merged pack
+            pack_db.update_cache(force=True)
+            self.invalidate_cache(pack_db)
+            for old_entity in merged:
+                old_entity.close()
+            # END release handles of removed packs
+        # END maintenance
+        return len(merged)
+
+    def skipped(self):
+        """:return: tuple(num_objects, num_bytes) of the objects, and their uncompressed size,
+            which were not written by ``store`` in dedupe mode as they existed already"""
+        return self._num_skipped, self._bytes_skipped
+
+    def maintain(self, min_count=None, factor=None, background=False):
+        """Pack loose objects and merge small packs, see ``pack_loose_objects`` and ``merge_packs``
+
+        :param background: if True, the work is done by a daemon thread
+        :return: the started thread if background is True, None otherwise"""
+        def run():
+            self.pack_loose_objects(min_count)
+            self.merge_packs(factor)
+        # END maintenance function
+
+        if not background:
+            run()
+            return None
+        # END handle synchronous maintenance
+        thread = threading.Thread(target=run, name="gitdb-maintenance", daemon=True)
+        thread.start()
+        return thread
+
+    #} END interface
+
+    #{ Internal
+
+    def _store_unique(self, istream):
+        """Store the given istream unless an object with the same sha exists in any of our
+        databases. The content is hashed first, spooling it to disk if it is large"""
+        if istream.binsha is not None:
+            if self.has_object(istream.binsha):
+                self._num_skipped += 1
+                self._bytes_skipped += istream.size
+                return istream
+            # END skip existing objects
+            return self._loose_db.store(istream)
+        # END handle precompressed streams
+
+        sha_writer = Sha1Writer()
+        with tempfile.SpooledTemporaryFile(self.dedupe_spool_size) as spool:
+            def write(data):
+                spool.write(data)
+                return sha_writer.write(data)
+            # END write helper
+            sha_writer.write(loose_object_header(istream.type, istream.size))
+            if stream_copy(istream.read, write, istream.size, chunk_size) != istream.size:
+                raise ValueError("Expected to read %i bytes from input stream" % istream.size)
+            # END verify size
+
+            binsha = sha_writer.sha(as_hex=False)
+            if self.has_object(binsha):
+                self._num_skipped += 1
+                self._bytes_skipped += istream.size
+            else:
+                spool.seek(0)
+                self._loose_db.store(IStream(istream.type, istream.size, spool))
+            # END store new objects only
+        # END assure spool is removed
+        istream.binsha = binsha
+        return istream
+
+    def _pack_db(self):
+        """:return: our PackedDB, which is created if there is none yet"""
+        for db in self._dbs:
+            if isinstance(db, self.PackDBCls):
+                return db
+            # END found pack db
+        # END for each db
+
+        pack_dir = self.db_path(self.packs_dir)
+        os.makedirs(pack_dir, exist_ok=True)
+        pack_db = self.PackDBCls(pack_dir)
+        pack_db.set_base_db(self)
+        self._dbs.insert(0, pack_db)
+        return pack_db
+
+    def _verify_pack(self, entity, shas):
+        """Check that all shas are contained in the given entity, and that each of their
+        objects, with all deltas applied, hashes to its sha. Nothing the objects were copied
+        from may be removed before this succeeded.
+
+        :raise ValueError: if an object is missing or corrupted. In that case, the pack is
+            removed"""
+        sha_to_index = entity.index().sha_to_index
+        for sha in shas:
+            try:
+                valid = sha_to_index(sha) is not None and entity.is_valid_stream(sha, use_crc=False)
+            except (BadObject, ValueError, zlib.error):
+                valid = False
+            # END handle undecodable objects
+            if not valid:
+                entity.close()
+                pack_path = entity.pack().path()
+                os.remove(pack_path)
+                os.remove(os.path.splitext(pack_path)[0] + '.idx')
+                raise ValueError("Object %s was not written correctly into pack at %s"
+                                 % (bin_to_hex(sha), pack_path))
+            # END handle corruption
+        # END for each sha
+
+    #} END internal
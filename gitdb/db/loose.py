@@ -18,6 +18,7 @@ from gitdb.exc import (
 from gitdb.stream import (
     DecompressMemMapReader,
     FDCompressedSha1Writer,
+    FDPipelinedCompressedSha1Writer,
     FDStream,
     Sha1Writer
 )
@@ -29,6 +30,7 @@ from gitdb.base import (
 
 from gitdb.util import (
     file_contents_ro_filepath,
+    copy_file_range_to,
     ENOENT,
     hex_to_bin,
     bin_to_hex,
@@ -38,23 +40,35 @@ from gitdb.util import (
     remove,
     rename,
     dirname,
-    basename,
-    join
+    join,
+    read,
+    close,
+    fsync
 )
 
 from gitdb.fun import (
     chunk_size,
-    loose_object_header_info,
     write_object,
     stream_copy
 )
 
+from gitdb.const import (
+    BYTE_SPACE,
+    NULL_BYTE
+)
 from gitdb.utils.encoding import force_bytes
 
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import errno
 import tempfile
 import os
 import sys
 import time
+import zlib
 
 
 __all__ = ('LooseObjectDB', )
@@ -74,13 +88,50 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
     if os.name == 'nt':
         new_objects_mode = int("644", 8)
 
-    def __init__(self, root_path):
+    # amount of threads listing fan-out directories concurrently
+    listing_workers = 8
+    # directory listings are only cached if the directory was not modified within this
+    # amount of seconds, as modifications within the timestamp granularity can't be detected
+    listing_racy_seconds = 2.0
+    # amount of objects store_many writes before moving them into place
+    store_batch_size = 1024
+    # objects of at least this size are hashed, compressed and written by separate threads
+    pipeline_threshold = 16 * 1024 * 1024
+    # amount of compressed bytes read at a time when reading object headers only
+    header_read_size = 512
+    # maximum amount of existing objects whose path is cached
+    path_cache_size = 16 * 1024
+    # maximum amount of missing objects which are remembered
+    negative_cache_size = 64 * 1024
+    # if True, new objects are written into unnamed files which get their name once complete,
+    # leaving nothing behind if the process dies while writing. Requires O_TMPFILE and /proc
+    use_anonymous_tmpfiles = hasattr(os, 'O_TMPFILE') and os.path.isdir('/proc/self/fd')
+    # if not 0, the amount of seconds a fan-out directory is assumed to be unchanged after
+    # its modification time was checked. Only suitable if no other process adds objects
+    negative_cache_validation_interval = 0
+
+    def __init__(self, root_path, compression=None):
+        """:param compression: if not None, an AdaptiveCompression instance deciding
+            on the compression level of newly stored objects"""
         super().__init__(root_path)
-        self._hexsha_to_file = dict()
+        self._compression = compression
+        # bounded LRU cache of hexsha -> path of existing objects
+        self._path_cache = OrderedDict()
+        # fan-out directory name -> [st_mtime_ns, time of last validation, set of missing hexshas]
+        self._missing = dict()
+        self._num_missing = 0
+        # fan-out directory name -> (st_mtime_ns, sorted tuple of binshas)
+        self._listing_cache = dict()
+        # fan-out directories known to exist
+        self._known_dirs = set()
+        # True if newly created files get new_objects_mode despite the umask, None if unknown
+        self._mode_ok = None
         # Additional Flags - might be set to 0 after the first failure
         # Depending on the root, this might work for some mounts, for others not, which
         # is why it is per instance
         self._fd_open_flags = getattr(os, 'O_NOATIME', 0)
+        # Might be set to False after the first failure, as not all file systems support it
+        self._use_anonymous_tmpfiles = self.use_anonymous_tmpfiles
 
     #{ Interface
     def object_path(self, hexsha):
@@ -93,37 +144,196 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
         """
         :return: readable object path to the object identified by hexsha
         :raise BadObject: If the object file does not exist"""
-        with suppress(KeyError):
-            return self._hexsha_to_file[hexsha]
-        # END ignore cache misses
+        hexsha = force_bytes(hexsha)
+        path_cache = self._path_cache
+        path = path_cache.get(hexsha)
+        if path is not None:
+            with suppress(KeyError):
+                path_cache.move_to_end(hexsha)
+            # END ignore concurrent eviction
+            return path
+        # END handle cache hit
 
-        # try filesystem
+        dir_name = hexsha[:2].decode('ascii')
+        if self._is_known_missing(hexsha, dir_name):
+            raise BadObject(hexsha)
+        # END handle negative cache hit
+
+        # try filesystem - the directory must be checked first, to notice objects
+        # which are added after we looked for them
+        dir_mtime = self._dir_mtime(dir_name)
         path = self.db_path(self.object_path(hexsha))
         if exists(path):
-            self._hexsha_to_file[hexsha] = path
+            path_cache[hexsha] = path
+            if len(path_cache) > self.path_cache_size:
+                with suppress(KeyError):
+                    path_cache.popitem(last=False)
+                # END ignore concurrent eviction
+            # END keep cache bounded
             return path
-        # END handle cache
+        # END handle existing object
+        self._remember_missing(hexsha, dir_name, dir_mtime)
         raise BadObject(hexsha)
 
+    def compression(self):
+        """:return: AdaptiveCompression instance used when storing objects, or None
+            if the default compression level is used"""
+        return self._compression
+
     def partial_to_complete_sha_hex(self, partial_hexsha):
         """:return: 20 byte binary sha1 string which matches the given name uniquely
         :param name: hexadecimal partial name (bytes or ascii string)
         :raise AmbiguousObjectName:
         :raise BadObject: """
+        prefix = force_bytes(partial_hexsha).lower()
+        shas = self.sha_iter()
+        if len(prefix) >= 2:
+            # only the fan-out directory of the prefix can contain candidates. Its listing is
+            # sorted, the first candidate is at the position of the prefix padded with zeros
+            try:
+                shas = self._list_fanout_dir(prefix[:2].decode('ascii'))
+                first = bisect_left(shas, hex_to_bin(prefix.ljust(40, b'0')))
+            except ValueError as e:
+                raise BadObject(partial_hexsha) from e
+            # END handle invalid hex names
+            shas = islice(shas, first, None)
+        # END handle prefix which selects a directory
+
         candidate = None
-        for binsha in self.sha_iter():
-            if bin_to_hex(binsha).startswith(force_bytes(partial_hexsha)):
+        for binsha in shas:
+            if bin_to_hex(binsha).startswith(prefix):
                 # it can't ever find the same object twice
                 if candidate is not None:
                     raise AmbiguousObjectName(partial_hexsha)
                 candidate = binsha
+            elif len(prefix) >= 2:
+                break
+            # END stop at the first mismatch of sorted shas
         # END for each object
         if candidate is None:
             raise BadObject(partial_hexsha)
         return candidate
 
+    def prune(self, shas):
+        """Remove the object files of the given objects, for instance after they have been
+        written into a pack. Fan-out directories which become empty are removed as well.
+
+        :param shas: iterable of 20 byte binary shas. Objects which do not exist are ignored
+        :return: amount of removed object files"""
+        count = 0
+        dirs = set()
+        for sha in shas:
+            hexsha = bin_to_hex(sha)
+            self._path_cache.pop(hexsha, None)
+            obj_path = self.db_path(self.object_path(hexsha))
+            try:
+                remove(obj_path)
+            except FileNotFoundError:
+                continue
+            # END ignore missing objects
+            count += 1
+            dirs.add(dirname(obj_path))
+        # END for each sha
+
+        for obj_dir in dirs:
+            # fails if another object was added in the meanwhile
+            with suppress(OSError):
+                os.rmdir(obj_dir)
+                self._known_dirs.discard(obj_dir)
+        # END for each fan-out directory
+        return count
+
     #} END interface
 
+    #{ Existence Caches
+
+    def _dir_mtime(self, dir_name):
+        """:return: modification time of the given fan-out directory in ns, or None if it doesn't exist"""
+        try:
+            return os.stat(self.db_path(dir_name)).st_mtime_ns
+        except OSError:
+            return None
+        # END handle missing directory
+
+    def _is_known_missing(self, hexsha, dir_name):
+        """:return: True if the given object is known not to exist, as the fan-out directory
+            didn't change since we looked for it"""
+        entry = self._missing.get(dir_name)
+        if entry is None or hexsha not in entry[2]:
+            return False
+        # END handle unknown object
+
+        now = time.time()
+        if now - entry[1] < self.negative_cache_validation_interval:
+            return True
+        # END trust recently validated entries
+        if self._dir_mtime(dir_name) == entry[0]:
+            entry[1] = now
+            return True
+        # END handle unchanged directory
+
+        if self._missing.pop(dir_name, None) is entry:
+            self._num_missing -= len(entry[2])
+        # END drop outdated entries
+        return False
+
+    def _remember_missing(self, hexsha, dir_name, dir_mtime):
+        """Remember that the object doesn't exist as long as its fan-out directory keeps
+        the given modification time"""
+        now = time.time()
+        if dir_mtime is not None and now - dir_mtime / 1e9 <= self.listing_racy_seconds:
+            return
+        # END changes within the timestamp granularity can't be detected
+
+        if self._num_missing >= self.negative_cache_size:
+            self._missing.clear()
+            self._num_missing = 0
+        # END keep cache bounded
+        entry = self._missing.get(dir_name)
+        if entry is None or entry[0] != dir_mtime:
+            if entry is not None:
+                self._num_missing -= len(entry[2])
+            # END forget outdated objects
+            entry = self._missing[dir_name] = [dir_mtime, now, set()]
+        # END handle new or outdated entry
+        if hexsha not in entry[2]:
+            entry[2].add(hexsha)
+            self._num_missing += 1
+        # END add object
+
+    def _forget_missing(self, hexsha):
+        """Drop the given hexsha from our negative cache, as the object was just written"""
+        entry = self._missing.get(hexsha[:2].decode('ascii'))
+        if entry is not None and hexsha in entry[2]:
+            entry[2].discard(hexsha)
+            self._num_missing -= 1
+        # END handle known missing object
+
+    #} END existence caches
+
+    def _open_loose_object(self, sha):
+        """
+        :return: file descriptor of the object file opened for reading
+        :raise BadObject: if object could not be located"""
+        db_path = self.db_path(self.object_path(bin_to_hex(sha)))
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+        try:
+            return os.open(db_path, flags | self._fd_open_flags)
+        except OSError as e:
+            if e.errno == ENOENT or not self._fd_open_flags:
+                raise BadObject(sha) from e
+            # END handle missing objects
+            # try again without noatime
+            try:
+                fd = os.open(db_path, flags)
+            except OSError as new_e:
+                raise BadObject(sha) from new_e
+            # END handle error
+            # didn't work because of our flag, don't try it again
+            self._fd_open_flags = 0
+            return fd
+        # END exception handling
+
     def _map_loose_object(self, sha):
         """
         :return: memory map of that file to allow random read access
@@ -152,20 +362,62 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
         return super().set_ostream(stream)
 
     def info(self, sha):
-        m = self._map_loose_object(sha)
+        # only read and decompress as much as needed for the header
+        fd = self._open_loose_object(sha)
         try:
-            typ, size = loose_object_header_info(m)
-            return OInfo(sha, typ, size)
+            dcompr = zlib.decompressobj()
+            hdr = b''
+            while NULL_BYTE not in hdr:
+                data = read(fd, self.header_read_size)
+                if not data:
+                    raise ValueError("Loose object %s has no valid header" % bin_to_hex(sha).decode('ascii'))
+                # END handle truncated objects
+                hdr += dcompr.decompress(dcompr.unconsumed_tail + data, self.header_read_size)
+            # END read until the header is complete
         finally:
-            if hasattr(m, 'close'):
-                m.close()
-        # END assure release of system resources
+            close(fd)
+        # END assure file is closed
+        typ, size = hdr[:hdr.find(NULL_BYTE)].split(BYTE_SPACE)
+        return OInfo(sha, typ, int(size))
+
+    def info_many(self, shas, workers=4):
+        """Obtain the info of multiple objects concurrently
+
+        :param shas: iterable of 20 byte binary shas
+        :param workers: amount of threads to use
+        :return: list of OInfo instances in the order of the given shas
+        :raise BadObject: if one of the objects does not exist"""
+        with ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(self.info, shas))
+        # END assure threads are shut down
 
     def stream(self, sha):
         m = self._map_loose_object(sha)
         type, size, stream = DecompressMemMapReader.new(m, close_on_deletion=True)
         return OStream(sha, type, size, stream)
 
+    def raw_object(self, sha):
+        """
+        :return: memoryview of the compressed object file as stored on disk, which
+            includes the object header. The view is backed by a memory map which is
+            released once the view is
+        :raise BadObject: if the object does not exist"""
+        return memoryview(self._map_loose_object(sha))
+
+    def send_raw_object(self, sha, out):
+        """Write the compressed object file, as returned by ``raw_object``, to the given
+        file or socket without copying its data through userspace if the platform allows it.
+
+        :param out: file descriptor, or object with a fileno() method, like a socket
+        :return: amount of bytes written
+        :raise BadObject: if the object does not exist"""
+        fd = self._open_loose_object(sha)
+        try:
+            return copy_file_range_to(fd, 0, os.fstat(fd).st_size, out)
+        finally:
+            os.close(fd)
+        # END assure file is closed
+
     def has_object(self, sha):
         try:
             self.readable_db_object_path(bin_to_hex(sha))
@@ -177,13 +429,20 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
     def store(self, istream):
         """note: The sha we produce will be hex by nature"""
         tmp_path = None
+        tmp_fd = None
         writer = self.ostream()
         if writer is None:
-            # open a tmp file to write the data to
-            fd, tmp_path = tempfile.mkstemp(prefix='obj', dir=self._root_path)
+            # open an anonymous or a named tmp file to write the data to
+            tmp_fd = self._open_anonymous_tmpfile()
+            if tmp_fd is not None:
+                # the writer closes its descriptor, but we need ours to link the file
+                fd = os.dup(tmp_fd)
+            else:
+                fd, tmp_path = tempfile.mkstemp(prefix='obj', dir=self._root_path)
+            # END handle tmp file kind
 
             if istream.binsha is None:
-                writer = FDCompressedSha1Writer(fd)
+                writer = self._compressing_writer(fd, istream.size)
             else:
                 writer = FDStream(fd)
             # END handle direct stream copies
@@ -201,12 +460,14 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
                                  chunk_size=self.stream_chunk_size)
                 # END handle direct stream copies
             finally:
-                if tmp_path:
+                if tmp_path or tmp_fd is not None:
                     writer.close()
             # END assure target stream is closed
         except:
             if tmp_path:
                 remove(tmp_path)
+            if tmp_fd is not None:
+                close(tmp_fd)
             raise
         # END assure tmpfile removal on error
 
@@ -217,6 +478,17 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
             hexsha = writer.sha(as_hex=True)
         # END handle sha
 
+        if tmp_fd is not None:
+            try:
+                if not self._link_anonymous_tmpfile(tmp_fd, hexsha):
+                    # linking isn't possible here - name a copy the conventional way
+                    tmp_path = self._copy_anonymous_tmpfile(tmp_fd)
+                # END handle unsupported linking
+            finally:
+                close(tmp_fd)
+            # END assure descriptor is closed
+        # END handle anonymous tmp file
+
         if tmp_path:
             obj_path = self.db_path(self.object_path(hexsha))
             obj_dir = dirname(obj_path)
@@ -248,21 +520,267 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
         # END handle dry_run
 
         istream.binsha = hex_to_bin(hexsha)
+        self._forget_missing(force_bytes(hexsha))
         return istream
 
-    def sha_iter(self):
-        # find all files which look like an object, extract sha from there
-        for root, dirs, files in os.walk(self.root_path()):
-            root_base = basename(root)
-            if len(root_base) != 2:
-                continue
+    def store_many(self, istreams, workers=4, fsync=False):
+        """Store multiple objects, hashing, compressing and writing them concurrently.
+
+        Objects are written to temporary files first, which are moved into place once a batch
+        of ``store_batch_size`` objects was written. Fan-out directories are only created once,
+        and the file mode is fixed up only if the umask doesn't already yield it.
+
+        :param istreams: iterable of IStream instances, see ``store``
+        :param workers: amount of threads to use
+        :param fsync: if True, all files and the directories containing them are synced to disk
+            before and after they are moved into place, respectively
+        :return: list of the given istreams, with their binsha set
+        :raise IOError: if data could not be written. Objects of previous batches remain stored"""
+        if self.ostream() is not None:
+            return [self.store(istream) for istream in istreams]
+        # END handle custom writer
 
-            for f in files:
-                if len(f) != 38:
+        istreams = iter(istreams)
+        result = list()
+        with ThreadPoolExecutor(workers) as executor:
+            while True:
+                batch = list(islice(istreams, self.store_batch_size))
+                if not batch:
+                    break
+                # END handle end of input
+                futures = [executor.submit(self._write_tmp_object, istream) for istream in batch]
+                tmp_paths = list()
+                try:
+                    for future in futures:
+                        tmp_paths.append(future.result())
+                    # END for each pending write
+                    if fsync:
+                        list(executor.map(self._fsync_path, tmp_paths))
+                    # END sync file contents
+                except:
+                    for future in futures:
+                        with suppress(Exception):
+                            remove(future.result())
+                        # END ignore failed writes
+                    # END for each tmp file
+                    raise
+                # END remove tmp files on error
+
+                obj_dirs = set()
+                for istream, tmp_path in zip(batch, tmp_paths):
+                    obj_path = self.db_path(self.object_path(istream.hexsha))
+                    obj_dir = dirname(obj_path)
+                    if obj_dir not in self._known_dirs:
+                        os.makedirs(obj_dir, exist_ok=True)
+                        self._known_dirs.add(obj_dir)
+                    # END create fan-out directory once
+                    try:
+                        os.replace(tmp_path, obj_path)
+                    except FileNotFoundError:
+                        # the directory was removed in the meanwhile
+                        os.makedirs(obj_dir, exist_ok=True)
+                        os.replace(tmp_path, obj_path)
+                    except PermissionError:
+                        # replacing existing objects doesn't work on NTFS
+                        if not isfile(obj_path):
+                            raise
+                        remove(tmp_path)
+                    # END handle existing object
+                    obj_dirs.add(obj_dir)
+                    self._forget_missing(istream.hexsha)
+                # END for each written object
+
+                if fsync:
+                    list(executor.map(self._fsync_path, obj_dirs))
+                # END sync directory entries
+                result.extend(batch)
+            # END for each batch
+        # END assure threads are shut down
+        return result
+
+    def _list_fanout_dir(self, name):
+        """:return: sorted tuple of binary shas of all objects in the fan-out directory with
+            the given two-character name. Listings are cached until the directory changes"""
+        path = self.db_path(name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self._listing_cache.pop(name, None)
+            return ()
+        # END handle missing directory
+
+        cached = self._listing_cache.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        # END handle cache hit
+
+        shas = list()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if len(entry.name) != 38:
                     continue
-                yield hex_to_bin(root_base + f)
-            # END for each file
-        # END for each walk iteration
+                # END skip temporary files
+                try:
+                    shas.append(hex_to_bin(name + entry.name))
+                except ValueError:
+                    continue
+                # END skip files which are no objects
+            # END for each entry
+        # END assure iterator is closed
+        shas = tuple(sorted(shas))
+
+        if time.time() - mtime / 1e9 > self.listing_racy_seconds:
+            self._listing_cache[name] = (mtime, shas)
+        # END cache listings of stable directories
+        return shas
+
+    def _iter_listings(self):
+        """:return: iterator over the listings of all 256 fan-out directories, in order"""
+        names = ["%02x" % i for i in range(256)]
+        if self.listing_workers < 2:
+            return map(self._list_fanout_dir, names)
+        # END handle serial listing
+        with ThreadPoolExecutor(self.listing_workers) as executor:
+            return iter(list(executor.map(self._list_fanout_dir, names)))
+        # END assure threads are shut down
+
+    def _write_tmp_object(self, istream):
+        """Write the given istream into a new temporary file, as ``store`` would, setting its binsha
+        :return: path to the temporary file, readable by everyone"""
+        mode = self.new_objects_mode
+        tmp_path = join(self._root_path, 'obj%s' % os.urandom(8).hex())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), mode)
+        if istream.binsha is not None:
+            writer = FDStream(fd)
+        else:
+            writer = self._compressing_writer(fd, istream.size)
+        # END handle direct stream copies
+
+        try:
+            try:
+                # the umask may remove permissions we need - that only has to be checked once
+                if self._mode_ok is None:
+                    self._mode_ok = (os.fstat(fd).st_mode & 0o777) == mode
+                # END check mode of the first file
+
+                if istream.binsha is not None:
+                    stream_copy(istream.read, writer.write, sys.maxsize, self.stream_chunk_size)
+                else:
+                    write_object(istream.type, istream.size, istream.read, writer.write,
+                                 chunk_size=self.stream_chunk_size)
+                # END handle direct stream copies
+            finally:
+                writer.close()
+            # END assure file is closed
+            if istream.binsha is None:
+                istream.binsha = writer.sha(as_hex=False)
+            # END set sha
+            if not self._mode_ok:
+                chmod(tmp_path, mode)
+            # END fix mode
+        except:
+            remove(tmp_path)
+            raise
+        # END assure tmpfile removal on error
+        return tmp_path
+
+    def _open_anonymous_tmpfile(self):
+        """:return: descriptor of an unnamed, writable file in our root directory which has
+            the mode of new objects, or None if the platform or file system doesn't support it"""
+        if not self._use_anonymous_tmpfiles:
+            return None
+        # END handle unsupported
+        try:
+            return os.open(self._root_path, os.O_TMPFILE | os.O_RDWR, self.new_objects_mode)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+                raise
+            # the kernel or the file system doesn't support it - don't try again
+            self._use_anonymous_tmpfiles = False
+            return None
+        # END handle unsupported file system
+
+    def _link_anonymous_tmpfile(self, fd, hexsha):
+        """Give the unnamed file behind the given descriptor the path of the object with the
+        given hexsha. It stays unnamed, and thus is discarded on close, if the object exists
+        :return: False if the file couldn't be linked as the platform doesn't allow it"""
+        mode = self.new_objects_mode
+        # the umask may remove permissions we need - that only has to be checked once
+        if self._mode_ok is None:
+            self._mode_ok = (os.fstat(fd).st_mode & 0o777) == mode
+        if not self._mode_ok:
+            os.fchmod(fd, mode)
+        # END fix mode
+
+        obj_path = self.db_path(self.object_path(hexsha))
+        obj_dir = dirname(obj_path)
+        if obj_dir not in self._known_dirs:
+            os.makedirs(obj_dir, exist_ok=True)
+            self._known_dirs.add(obj_dir)
+        # END create fan-out directory once
+
+        # linkat(AT_SYMLINK_FOLLOW) through /proc works without special privileges,
+        # as opposed to linkat(AT_EMPTY_PATH) on the descriptor itself
+        fd_path = '/proc/self/fd/%i' % fd
+        try:
+            try:
+                os.link(fd_path, obj_path, follow_symlinks=True)
+            except FileNotFoundError:
+                # the directory was removed in the meanwhile
+                os.makedirs(obj_dir, exist_ok=True)
+                os.link(fd_path, obj_path, follow_symlinks=True)
+            # END handle missing directory
+        except FileExistsError:
+            pass
+        except OSError as e:
+            # EXDEV is reported if /proc doesn't resolve the descriptor for linking, as in
+            # some sandboxes. Everything else, like a full disk, is a real error
+            if e.errno not in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL, errno.EXDEV):
+                raise
+            # linking is unsupported here - don't try again
+            self._use_anonymous_tmpfiles = False
+            return False
+        # END handle existing object
+        return True
+
+    def _copy_anonymous_tmpfile(self, fd):
+        """:return: path to a new, named tmp file with the contents of the unnamed file
+            behind the given descriptor"""
+        out_fd, tmp_path = tempfile.mkstemp(prefix='obj', dir=self._root_path)
+        try:
+            try:
+                copy_file_range_to(fd, 0, os.fstat(fd).st_size, out_fd)
+            finally:
+                close(out_fd)
+            # END assure descriptor is closed
+        except:
+            remove(tmp_path)
+            raise
+        # END assure tmpfile removal on error
+        return tmp_path
+
+    def _compressing_writer(self, fd, size):
+        """:return: writer compressing an object of the given size into fd, which hashes,
+            compresses and writes concurrently for large objects"""
+        if size >= self.pipeline_threshold:
+            return FDPipelinedCompressedSha1Writer(fd, self._compression)
+        # END handle large objects
+        return FDCompressedSha1Writer(fd, self._compression)
+
+    def _fsync_path(self, path):
+        """Sync the file or directory at the given path to disk"""
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+        # END assure file is closed
+
+    def sha_iter(self):
+        # list the fan-out directories only, instead of walking the whole tree
+        for shas in self._iter_listings():
+            yield from shas
+        # END for each fan-out directory
 
     def size(self):
-        return len(tuple(self.sha_iter()))
+        return sum(len(shas) for shas in self._iter_listings())
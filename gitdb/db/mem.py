@@ -4,12 +4,15 @@
 # the New BSD License: https://opensource.org/license/bsd-3-clause/
 """Contains the MemoryDatabase implementation"""
 from gitdb.db.loose import LooseObjectDB
+from gitdb.db.pack import PackedDB
+from gitdb.db.git import GitDB
 from gitdb.db.base import (
     ObjectDBR,
     ObjectDBW
 )
 
 from gitdb.base import (
+    OInfo,
     OStream,
     IStream,
 )
@@ -20,11 +23,28 @@ from gitdb.exc import (
 )
 
 from gitdb.stream import (
-    ZippedStoreShaWriter,
+    ZippedContentReader,
     DecompressMemMapReader,
 )
+from gitdb.pack import PackEntity
 
+from gitdb.fun import (
+    chunk_size,
+    loose_object_header,
+    stream_copy
+)
+from gitdb.util import make_sha
+
+from collections import OrderedDict
 from io import BytesIO
+from itertools import chain
+from struct import pack
+
+import shutil
+import tempfile
+import threading
+import weakref
+import zlib
 
 __all__ = ("MemoryDB", )
 
@@ -36,53 +56,137 @@ class MemoryDB(ObjectDBR, ObjectDBW):
     it to the actual physical storage, as it allows to query whether object already
     exists in the target storage before introducing actual IO"""
 
-    def __init__(self):
+    def __init__(self, compression=None, raw=False, max_bytes=None, spill_dir=None):
+        """:param compression: if not None, an AdaptiveCompression instance deciding
+            on the compression level of stored objects
+        :param raw: if True, objects are kept uncompressed, which is faster but needs more memory
+        :param max_bytes: if not None, the maximum amount of bytes of object data to keep in
+            memory. Once exceeded, the least recently used objects are moved into a loose
+            object database in spill_dir
+        :param spill_dir: existing directory to keep objects exceeding max_bytes in. If None,
+            a temporary directory is created once needed, and removed along with this instance"""
         super().__init__()
-        self._db = LooseObjectDB("path/doesnt/matter")
+        self._compression = compression
+        self._raw = raw
+        self._max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        self._spill_db = None
+        # amount of bytes of object data in our cache
+        self._num_bytes = 0
+        # serializes changes to our cache, including the recency updates of readers if
+        # objects may be spilled
+        self._lock = threading.Lock()
 
-        # maps 20 byte shas to their OStream objects
-        self._cache = dict()
+        # maps 20 byte shas to (type, size, data, content) tuples, least recently used first.
+        # data is immutable and in the loose object format, or the plain object data if raw.
+        # content is None, or (offset, adler32) of the raw deflate data of the content within
+        # data, if it is independent of the header
+        self._cache = OrderedDict()
 
     def set_ostream(self, stream):
         raise UnsupportedOperation("MemoryDB's always stream into memory")
 
     def store(self, istream):
-        zstream = ZippedStoreShaWriter()
-        self._db.set_ostream(zstream)
+        content = None
+        if istream.binsha is not None:
+            # the stream provides the object in loose format
+            data = istream.read()
+            type, size, stream = DecompressMemMapReader.new(data, close_on_deletion=False)
+            if self._raw:
+                data = stream.read(size)
+            # END handle storage format
+        elif self._raw:
+            type, size = istream.type, istream.size
+            data = istream.read(size)
+            sha = make_sha(loose_object_header(type, size))
+            sha.update(data)
+            istream.binsha = sha.digest()
+        else:
+            type, size = istream.type, istream.size
+            header = loose_object_header(type, size)
+            sha = make_sha(header)
+            if self._compression is None:
+                zstream = zlib.compressobj(zlib.Z_BEST_SPEED)
+            else:
+                zstream = self._compression.compressobj(type, size)
+            # END handle compression policy
+            # the header is compressed separately, which keeps the compressed content usable
+            # for packs as it is. The full flush ends its raw deflate data on a byte boundary
+            hzstream = zlib.compressobj(zlib.Z_BEST_SPEED, zlib.DEFLATED, -zlib.MAX_WBITS)
+            zheader = hzstream.compress(header) + hzstream.flush(zlib.Z_FULL_FLUSH)
+            zchunks = list()
+            checksums = [zlib.adler32(header), 1]
 
-        istream = self._db.store(istream)
-        zstream.close()     # close to flush
-        zstream.seek(0)
+            def write(chunk):
+                sha.update(chunk)
+                checksums[0] = zlib.adler32(chunk, checksums[0])
+                checksums[1] = zlib.adler32(chunk, checksums[1])
+                zchunks.append(zstream.compress(chunk))
+            # END content writer
 
-        # don't provide a size, the stream is written in object format, hence the
-        # header needs decompression
-        decomp_stream = DecompressMemMapReader(zstream.getvalue(), close_on_deletion=False)
-        self._cache[istream.binsha] = OStream(istream.binsha, istream.type, istream.size, decomp_stream)
+            stream_copy(istream.read, write, size, chunk_size)
+            zchunks.append(zstream.flush())
+            zcontent = b''.join(zchunks)
+            # zlib header, header and content deflate data, checksum over header and content
+            data = b''.join((zcontent[:2], zheader, zcontent[2:-4], pack('>L', checksums[0])))
+            istream.binsha = sha.digest()
+            content = (2 + len(zheader), checksums[1])
+        # END handle storage format
+
+        with self._lock:
+            if self._spill_db is not None and self._spill_db.has_object(istream.binsha):
+                return istream
+            # END handle spilled objects
 
+            prev_entry = self._cache.pop(istream.binsha, None)
+            if prev_entry is not None:
+                self._num_bytes -= len(prev_entry[2])
+            # END handle duplicates
+            self._cache[istream.binsha] = (type, size, data, content)
+            self._num_bytes += len(data)
+
+            if self._max_bytes is not None and self._num_bytes > self._max_bytes:
+                self._spill()
+            # END handle budget
+        # END synchronize writers
         return istream
 
     def has_object(self, sha):
-        return sha in self._cache
+        return sha in self._cache or (self._spill_db is not None and self._spill_db.has_object(sha))
 
     def info(self, sha):
-        # we always return streams, which are infos as well
-        return self.stream(sha)
+        entry = self._entry(sha)
+        if entry is None:
+            return self._spilled(sha).info(sha)
+        return OInfo(sha, entry[0], entry[1])
 
     def stream(self, sha):
-        try:
-            ostream = self._cache[sha]
-            # rewind stream for the next one to read
-            ostream.stream.seek(0)
-            return ostream
-        except KeyError as e:
-            raise BadObject(sha) from e
-        # END exception handling
+        """:return: a new OStream for each call, which can be used independently of
+            any other stream, by any thread"""
+        entry = self._entry(sha)
+        if entry is None:
+            return self._spilled(sha).stream(sha)
+        # END handle spilled objects
+        type, size, data = entry[:3]
+        if self._raw:
+            return OStream(sha, type, size, BytesIO(data))
+        # don't provide a size, the data is in object format, hence the
+        # header needs decompression
+        return OStream(sha, type, size, DecompressMemMapReader(data, close_on_deletion=False))
 
     def size(self):
-        return len(self._cache)
+        if self._spill_db is None:
+            return len(self._cache)
+        return len(self._cache) + self._spill_db.size()
 
     def sha_iter(self):
-        return self._cache.keys()
+        # reading objects reorders them, which must be possible while iterating
+        with self._lock:
+            shas = list(self._cache)
+        # END synchronize with writers
+        if self._spill_db is None:
+            return iter(shas)
+        return chain(shas, self._spill_db.sha_iter())
 
     #{ Interface
     def stream_copy(self, sha_iter, odb):
@@ -98,13 +202,120 @@ class MemoryDB(ObjectDBR, ObjectDBW):
                 continue
             # END check object existence
 
-            ostream = self.stream(sha)
-            # compressed data including header
-            sio = BytesIO(ostream.stream.data())
-            istream = IStream(ostream.type, ostream.size, sio, sha)
-
-            odb.store(istream)
+            odb.store(self._copy_istream(sha))
             count += 1
         # END for each sha
         return count
+
+    def flush_to_pack(self, odb_or_dir):
+        """Write all objects which don't exist in the given database into a single new pack.
+        Compressed object data is copied into the pack as it is, instead of being compressed again
+
+        :param odb_or_dir: GitDB or PackedDB to write the pack into, which is updated to
+            provide the new objects right away, or a directory to write a pack of all objects to
+        :return: PackEntity of the new pack, or None if there was nothing to write"""
+        odb = None
+        if isinstance(odb_or_dir, GitDB):
+            odb = odb_or_dir
+            pack_dir = odb._pack_db().root_path()
+        elif isinstance(odb_or_dir, PackedDB):
+            odb = odb_or_dir
+            pack_dir = odb.root_path()
+        else:
+            pack_dir = odb_or_dir
+        # END handle target
+
+        shas = [sha for sha in self.sha_iter() if odb is None or not odb.has_object(sha)]
+        if not shas:
+            return None
+        # END handle nothing to do
+
+        entity = PackEntity.create((self._pack_stream(sha) for sha in shas), pack_dir,
+                                   object_count=len(shas), compression=self._compression)
+        if odb is not None:
+            odb.update_cache(force=True)
+        # END make objects available
+        return entity
+
+    def num_bytes(self):
+        """:return: amount of bytes of object data kept in memory"""
+        return self._num_bytes
+
+    def spill_db(self):
+        """:return: LooseObjectDB keeping the objects which didn't fit into memory, or None
+            if no object was moved out of memory yet"""
+        return self._spill_db
     #} END interface
+
+    #{ Internals
+    def _entry(self, sha):
+        """:return: (type, size, data, content) tuple of the object with the given sha if it is
+            kept in memory, or None
+        **Note:** the recency of objects only matters if they may be spilled. Only then
+            the lock is taken to update it, otherwise reads don't wait for writers"""
+        if self._max_bytes is None:
+            # entries are immutable tuples which are replaced as a whole
+            return self._cache.get(sha)
+        # END handle unbounded cache
+        with self._lock:
+            entry = self._cache.get(sha)
+            if entry is not None:
+                self._cache.move_to_end(sha)
+            # END update recency
+        # END synchronize changes of the order
+        return entry
+
+    def _spilled(self, sha):
+        """:return: database keeping the object with the given sha, which isn't in memory
+        :raise BadObject: if there is no such database"""
+        # objects are written to disk before they are removed from memory
+        if self._spill_db is None:
+            raise BadObject(sha)
+        return self._spill_db
+
+    def _copy_istream(self, sha):
+        """:return: IStream providing the object with the given sha for storage in another database,
+            in the loose format if possible to prevent it from being compressed again"""
+        # don't use _entry(), which would change the order of objects being iterated
+        entry = self._cache.get(sha)
+        if entry is None:
+            info = self._spilled(sha).info(sha)
+            return IStream(info.type, info.size, BytesIO(self._spill_db.raw_object(sha)), sha)
+        # END handle spilled objects
+        type, size, data = entry[:3]
+        if self._raw:
+            return IStream(type, size, BytesIO(data))
+        # compressed data including header
+        return IStream(type, size, BytesIO(data), sha)
+
+    def _pack_stream(self, sha):
+        """:return: OStream of the object with the given sha, whose stream provides the
+            compressed content in pack format if possible"""
+        entry = self._cache.get(sha)
+        if entry is None or entry[3] is None:
+            return self.stream(sha)
+        # END handle objects without reusable content
+        type, size, data, (offset, adler) = entry
+        # keep the zlib header, and replace the checksum over header and content
+        zdata = data[:2] + data[offset:-4] + pack('>L', adler)
+        return OStream(sha, type, size, ZippedContentReader(zdata, size))
+
+    def _spill(self):
+        """Move the least recently used objects into our spill database until the
+        data of the remaining ones fits into max_bytes
+        **Note:** must be called with the lock held"""
+        if self._spill_db is None:
+            spill_dir = self._spill_dir
+            if spill_dir is None:
+                spill_dir = tempfile.mkdtemp(prefix='gitdb-spill-')
+                weakref.finalize(self, shutil.rmtree, spill_dir, True)
+            # END create temporary directory
+            self._spill_db = LooseObjectDB(spill_dir)
+        # END create spill database
+
+        while self._cache and self._num_bytes > self._max_bytes:
+            sha = next(iter(self._cache))
+            self._spill_db.store(self._copy_istream(sha))
+            self._num_bytes -= len(self._cache.pop(sha)[2])
+        # END for each object to move
+    #} END internals
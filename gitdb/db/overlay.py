@@ -0,0 +1,328 @@
+# Copyright (C) 2010, 2011 Sebastian Thiel (byronimo@gmail.com) and contributors
+#
+# This module is part of GitDB and is released under
+# the New BSD License: https://opensource.org/license/bsd-3-clause/
+"""Contains the OverlayDB implementation"""
+from gitdb.db.base import (
+    ObjectDBR,
+    ObjectDBW
+)
+from gitdb.db.mem import MemoryDB
+from gitdb.db.pack import PackedDB
+from gitdb.db.git import GitDB
+
+from gitdb.exc import UnsupportedOperation
+
+from concurrent.futures import ThreadPoolExecutor
+
+import threading
+
+__all__ = ('OverlayDB', )
+
+
+class OverlayDB(ObjectDBR, ObjectDBW):
+
+    """A write-back database which keeps new objects in a MemoryDB in front of a
+    persistent database, like a GitDB.
+
+    Reads check the objects in memory first, then the persistent database. Once enough
+    objects were written, or the first of them was written long enough ago, they are
+    flushed into the persistent database in the background, as a single pack or as loose
+    objects, depending on their amount. Objects remain readable while they are flushed.
+
+    For transaction-like use, disable automatic flushing and call ``flush()`` to commit
+    or ``discard()`` to drop the objects written so far.
+
+    If writing a batch in the background fails, its objects stay in memory and the error
+    is raised by the next call to ``store`` or ``flush``. ``flush`` tries to write them again.
+
+    **Note:** call ``close()`` or ``flush()`` before the process ends, otherwise objects
+        written since the last flush are lost"""
+
+    # CONFIGURATION
+    # amount of objects in memory which triggers a flush
+    flush_count = 1024
+    # amount of bytes of object data in memory which triggers a flush
+    flush_bytes = 32 * 1024 * 1024
+    # if not None, the amount of seconds after which objects in memory are flushed
+    flush_interval = 5.0
+    # batches of at least this amount of objects are flushed as pack, smaller ones as
+    # loose objects
+    pack_min_count = 32
+
+    def __init__(self, db, auto_flush=True, compression=None):
+        """
+        :param db: persistent database receiving the objects. Objects are written as packs
+            into a GitDB or PackedDB, and one by one into other writable databases
+        :param auto_flush: if True, objects are flushed in the background once the configured
+            thresholds are reached. Otherwise they are flushed by ``flush()`` only
+        :param compression: if not None, an AdaptiveCompression instance deciding
+            on the compression level of stored objects"""
+        super().__init__()
+        self._db = db
+        self._auto_flush = auto_flush
+        self._compression = compression
+        # protects the batches - readers don't need to lock
+        self._lock = threading.Lock()
+        # serializes writing batches into the persistent database
+        self._flush_lock = threading.Lock()
+        # the batch receiving new objects
+        self._mdb = MemoryDB(compression)
+        # batches which are being written, oldest first
+        self._flushing = list()
+        self._timer = None
+        self._executor = None
+        # protects the futures and the error of background flushes. It is taken by the
+        # callbacks of futures, which may run while the lock above is held
+        self._futures_lock = threading.Lock()
+        self._futures = set()
+        # tuple(batch, exception) of the first background flush which failed, or None
+        self._error = None
+
+    def __del__(self):
+        # objects which weren't flushed are dropped, like in discard() - just stop our threads
+        if self._timer is not None:
+            self._timer.cancel()
+        # END cancel pending flush
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        # END stop background writer
+
+    #{ Query Interface
+
+    def has_object(self, sha):
+        return any(mdb.has_object(sha) for mdb in self._memory_dbs()) or self._db.has_object(sha)
+
+    def info(self, sha):
+        return self._db_for(sha).info(sha)
+
+    def stream(self, sha):
+        return self._db_for(sha).stream(sha)
+
+    def size(self):
+        return sum(1 for _ in self.sha_iter())
+
+    def sha_iter(self):
+        seen = set()
+        for mdb in self._memory_dbs():
+            for sha in mdb.sha_iter():
+                if sha not in seen:
+                    seen.add(sha)
+                    yield sha
+            # END for each sha in memory
+        # END for each batch
+        for sha in self._db.sha_iter():
+            if sha not in seen:
+                yield sha
+        # END for each persistent sha
+
+    #} END query interface
+
+    #{ Edit Interface
+
+    def set_ostream(self, stream):
+        raise UnsupportedOperation("OverlayDB's always stream into memory")
+
+    def store(self, istream):
+        self._raise_error()
+        with self._lock:
+            mdb = self._mdb
+            istream = mdb.store(istream)
+            if not self._auto_flush:
+                return istream
+            # END handle manual flushing
+
+            if mdb.size() >= self.flush_count or mdb.num_bytes() >= self.flush_bytes:
+                self._submit(self._take_batch())
+            elif self._timer is None and self.flush_interval is not None:
+                self._timer = threading.Timer(self.flush_interval, self._flush_expired, (mdb,))
+                self._timer.daemon = True
+                self._timer.start()
+            # END handle thresholds
+        # END synchronize writers
+        return istream
+
+    #} END edit interface
+
+    #{ Interface
+
+    def flush(self):
+        """Write all objects in memory into the persistent database and wait until
+        all of them, including those flushed in the background, are written
+        :return: amount of objects which were written by this call
+        :raise Exception: the error which occurred when writing a batch. Its objects stay in
+            memory, and are written once this method is called again"""
+        with self._lock:
+            self._take_batch()
+            batches = list(self._flushing)
+        # END synchronize writers
+        with self._futures_lock:
+            futures = list(self._futures)
+        # END synchronize with callbacks
+
+        for future in futures:
+            future.result()
+        # END wait for background flushes
+        with self._futures_lock:
+            if self._error is not None and self._error[0] in batches:
+                # the batch is written again below
+                self._error = None
+            # END forget failure
+        # END synchronize with background flushes
+
+        count = 0
+        for mdb in batches:
+            if self._write_batch(mdb):
+                count += mdb.size()
+            # END count written objects
+        # END for each remaining batch
+        return count
+
+    def close(self):
+        """Flush all objects in memory like ``flush()``, and stop the thread writing
+        objects in the background
+        :return: amount of objects which were written by this call"""
+        try:
+            return self.flush()
+        finally:
+            with self._lock:
+                executor, self._executor = self._executor, None
+            # END synchronize writers
+            if executor is not None:
+                executor.shutdown()
+            # END stop background writer
+        # END assure executor is shut down
+
+    def discard(self):
+        """Drop all objects which were written since the last flush and are not yet
+        being flushed
+        :return: amount of discarded objects"""
+        with self._lock:
+            batch = self._take_batch(flushing=False)
+        # END synchronize writers
+        if batch is None:
+            return 0
+        return batch.size()
+
+    def pending(self):
+        """:return: amount of objects which are kept in memory, including those being flushed"""
+        return sum(mdb.size() for mdb in self._memory_dbs())
+
+    def database(self):
+        """:return: the persistent database we write into"""
+        return self._db
+
+    #} END interface
+
+    #{ Internals
+
+    def _memory_dbs(self):
+        """:return: our MemoryDBs, newest first"""
+        return [self._mdb] + self._flushing[::-1]
+
+    def _db_for(self, sha):
+        """:return: database containing the object with the given sha, which is
+            our persistent database if the object isn't in memory"""
+        for mdb in self._memory_dbs():
+            if mdb.has_object(sha):
+                return mdb
+            # END found object
+        # END for each batch
+        return self._db
+
+    def _take_batch(self, flushing=True):
+        """Replace the current batch with a new one
+        **Note:** must be called with the lock held
+        :param flushing: if True, the batch remains readable until it was written
+        :return: the previous batch, or None if it was empty"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # END cancel pending flush
+
+        mdb = self._mdb
+        if not mdb.size():
+            return None
+        # END handle empty batch
+        self._mdb = MemoryDB(self._compression)
+        if flushing:
+            self._flushing.append(mdb)
+        # END keep batch readable
+        return mdb
+
+    def _submit(self, mdb):
+        """Write the given batch in the background
+        **Note:** must be called with the lock held"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        # END create executor
+        future = self._executor.submit(self._write_background, mdb)
+        with self._futures_lock:
+            self._futures.add(future)
+        # END synchronize with callbacks
+        future.add_done_callback(self._forget_future)
+
+    def _forget_future(self, future):
+        """Called once a background flush is done, which doesn't need to be waited for anymore"""
+        with self._futures_lock:
+            self._futures.discard(future)
+        # END synchronize with other callbacks
+
+    def _write_background(self, mdb):
+        """Write the given batch like ``_write_batch``, but keep the error if that fails, as
+        nobody waits for the result. The error is kept before the future is done, so ``flush``
+        sees it once it waited for us"""
+        try:
+            self._write_batch(mdb)
+        except Exception as e:
+            with self._futures_lock:
+                if self._error is None:
+                    self._error = (mdb, e)
+                # END keep first error only
+            # END synchronize with readers of the error
+        # END handle failure
+
+    def _raise_error(self):
+        """Raise the error of a failed background flush, if there is one, only once"""
+        with self._futures_lock:
+            error, self._error = self._error, None
+        # END synchronize with background flushes
+        if error is not None:
+            raise error[1]
+        # END handle failure
+
+    def _flush_expired(self, mdb):
+        """Called by our timer to flush the given batch if it is still the current one"""
+        with self._lock:
+            if self._mdb is not mdb:
+                return
+            # END handle batch flushed meanwhile
+            self._timer = None
+            self._submit(self._take_batch())
+        # END synchronize writers
+
+    def _write_batch(self, mdb):
+        """Write all objects of the given batch into our persistent database, and stop
+        providing them from memory afterwards
+        :return: False if the batch was written already"""
+        with self._flush_lock:
+            if mdb not in self._flushing:
+                return False
+            # END handle batch written meanwhile
+            if mdb.size() >= self.pack_min_count and isinstance(self._db, (GitDB, PackedDB)):
+                entity = mdb.flush_to_pack(self._db)
+                if entity is not None:
+                    entity.close()
+                # END release handles
+            else:
+                mdb.stream_copy(mdb.sha_iter(), self._db)
+            # END handle batch size
+
+            # the objects are available in the persistent database now
+            with self._lock:
+                self._flushing.remove(mdb)
+            # END synchronize writers
+        # END serialize flushes
+        return True
+
+    #} END internals
@@ -6,10 +6,18 @@
 from gitdb.db.base import (
     FileDBBase,
     ObjectDBR,
+    ObjectDBW,
     CachingDB
 )
 
-from gitdb.util import LazyMixin
+from gitdb.util import (
+    LazyMixin,
+    make_sha,
+    bin_to_hex,
+    mman,
+    release_unused_maps,
+    remove,
+)
 
 from gitdb.exc import (
     BadObject,
@@ -17,17 +25,78 @@ from gitdb.exc import (
     AmbiguousObjectName
 )
 
-from gitdb.pack import PackEntity
+from gitdb.base import (
+    OInfo,
+    OStream
+)
 
+from gitdb.fun import (
+    chunk_size,
+    create_pack_object_header,
+    is_equal_canonical_sha,
+    loose_object_header,
+    type_to_type_id_map
+)
+
+from gitdb.stream import (
+    DecompressMemMapReader,
+    Sha1Writer
+)
+
+from gitdb.pack import (
+    PackEntity,
+    PackFile,
+    IndexWriter,
+    write_stream_to_pack
+)
+
+from binascii import crc32
+from collections import OrderedDict
 from functools import reduce
+from struct import pack
 
 import os
 import glob
+import tempfile
+import threading
+import weakref
+import zlib
 
-__all__ = ('PackedDB', )
+__all__ = ('PackedDB', 'PackWriterDB')
 
 #{ Utilities
 
+class _WeakBaseDB:
+
+    """Resolves the external REF_DELTA bases of the packs of a PackedDB through a weakly
+    referenced database. Once that is gone, the PackedDB itself is used, and once that is
+    gone as well, bases can't be found anymore"""
+    __slots__ = ('_pdb', '_db')
+
+    def __init__(self, pdb, db):
+        self._pdb = weakref.ref(pdb)
+        self._db = weakref.ref(db)
+
+    def _database(self, sha):
+        """:return: the database to query for the given sha
+        :raise BadObject: if no database is alive anymore"""
+        db = self._db()
+        if db is None:
+            db = self._pdb()
+            if db is None:
+                raise BadObject(sha)
+            # END handle dead pack database
+        # END fall back to pack database
+        return db
+
+    def info(self, sha):
+        return self._database(sha).info(sha)
+
+    def stream(self, sha):
+        return self._database(sha).stream(sha)
+
+#} END utilities
+
 
 class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
 
@@ -38,6 +107,12 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
     # any effect, but it should have one
     _sort_interval = 500
 
+    # if not None, the maximum amount of packs whose index and pack files are kept mapped.
+    # The least recently used packs are closed, and reopened once they are needed again.
+    # Lookups of objects which are not in the most recently used packs will reopen packs
+    # then, so it should be larger than the amount of packs used frequently
+    max_open_packs = None
+
     def __init__(self, root_path):
         super().__init__(root_path)
         # list of lists with three items:
@@ -47,6 +122,12 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
         # self._entities = list()       # lazy loaded list
         self._hit_count = 0             # amount of hits
         self._st_mtime = 0              # last modification data of our root path
+        # database resolving REF_DELTA bases which are not in the delta's pack
+        self._base_db = _WeakBaseDB(self, self)
+        # entities which were used since they were closed, least recently used first.
+        # Only maintained if max_open_packs is set
+        self._open_entities = OrderedDict()
+        self._open_lock = threading.Lock()
 
     def _set_cache_(self, attr):
         if attr == '_entities':
@@ -70,7 +151,11 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
             self._sort_entities()
         # END update sorting
 
+        governed = self.max_open_packs is not None
         for item in self._entities:
+            if governed:
+                self._use_entity(item[1])
+            # END track open packs
             index = item[2](sha)
             if index is not None:
                 item[0] += 1            # one hit for you
@@ -104,6 +189,7 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
 
     def sha_iter(self):
         for entity in self.entities():
+            self._use_entity(entity)
             index = entity.index()
             sha_by_index = index.sha
             for index in range(index.size()):
@@ -111,7 +197,16 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
             # END for each index
         # END for each entity
 
+    def iter_by_type(self, type):
+        """Uses pack bitmaps if available, or the type tables of our packs otherwise,
+        see ``PackEntity.iter_by_type``"""
+        for entity in self.entities():
+            self._use_entity(entity)
+            yield from entity.iter_by_type(type)
+        # END for each entity
+
     def size(self):
+        # the size is cached, hence it doesn't keep the index open
         sizes = [item[1].index().size() for item in self._entities]
         return reduce(lambda x, y: x + y, sizes, 0)
 
@@ -154,7 +249,9 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
             # init the hit-counter/priority with the size, a good measure for hit-
             # probability. Its implemented so that only 12 bytes will be read
             entity = PackEntity(pack_file)
+            entity.set_base_db(self._base_db)
             self._entities.append([entity.pack().size(), entity, entity.index().sha_to_index])
+            self._use_entity(entity)
         # END for each new packfile
 
         # removed packs
@@ -167,6 +264,9 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
                 # END found index
             # END for each entity
             assert del_index != -1
+            with self._open_lock:
+                self._open_entities.pop(self._entities[del_index][1], None)
+            # END synchronize tracking
             del(self._entities[del_index])
         # END for each removed pack
 
@@ -174,6 +274,30 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
         self._sort_entities()
         return True
 
+    def ingest_pack_stream(self, read, **kwargs):
+        """Receive a pack from the given stream and make it available in this database,
+        along with a newly created index.
+
+        :param read: read function of a possibly non-seekable stream providing the pack
+        :param kwargs: see ``PackEntity.create_from_stream``
+        :return: PackEntity of the new pack
+        :raise ParseError: if the pack could not be parsed, or contains deltas whose
+            base objects are not contained in it"""
+        entity = PackEntity.create_from_stream(read, self.root_path(), **kwargs)
+        self.update_cache(force=True)
+        return entity
+
+    def set_base_db(self, db):
+        """Set the database used by our packs to resolve REF_DELTA base objects which are
+        not contained in the delta's pack. By default, all our packs are searched.
+
+        :param db: ObjectDBR instance, usually the compound database we are part of. Only
+            a weak reference will be kept to it. Once it is gone, our packs are searched again"""
+        self._base_db = _WeakBaseDB(self, db)
+        for item in self.__dict__.get('_entities', ()):
+            item[1].set_base_db(self._base_db)
+        # END for each existing entity
+
     def entities(self):
         """:return: list of pack entities operated upon by this database"""
         return [item[1] for item in self._entities]
@@ -188,6 +312,7 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
         :raise BadObject: """
         candidate = None
         for item in self._entities:
+            self._use_entity(item[1])
             item_index = item[1].index().partial_sha_to_index(partial_binsha, canonical_length)
             if item_index is not None:
                 sha = item[1].index().sha(item_index)
@@ -203,4 +328,284 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
         # still not found ?
         raise BadObject(partial_binsha)
 
+    def resource_usage(self):
+        """:return: dict with the resources in use: open_packs, the amount of our packs which
+            may be open, as tracked if max_open_packs is set, as well as mapped_files, file_handles
+            and mapped_bytes of the memory manager, which is shared by all databases"""
+        return dict(open_packs=len(self._open_entities), mapped_files=mman.num_open_files(),
+                    file_handles=mman.num_file_handles(), mapped_bytes=mman.mapped_memory_size())
+
+    #} END interface
+
+    #{ Internals
+
+    def _use_entity(self, entity):
+        """Remember the given entity to be used, and close the least recently used ones
+        if there are more than max_open_packs"""
+        max_open_packs = self.max_open_packs
+        if max_open_packs is None:
+            return
+        # END handle unlimited packs
+
+        with self._open_lock:
+            open_entities = self._open_entities
+            if entity in open_entities:
+                open_entities.move_to_end(entity)
+                return
+            # END handle open entity
+            open_entities[entity] = None
+            closed = [open_entities.popitem(last=False)[0]
+                      for _ in range(len(open_entities) - max(max_open_packs, 1))]
+        # END synchronize tracking
+
+        if closed:
+            for lru_entity in closed:
+                lru_entity.close()
+            # END for each entity to close
+            release_unused_maps()
+        # END release resources
+
+    #} END internals
+
+
+class PackWriterDB(FileDBBase, ObjectDBR, ObjectDBW):
+
+    """A database which writes all objects it stores into a single new pack.
+
+    Compared to storing objects in a loose object database, this needs just one file
+    for all objects, which makes it suitable to import large amounts of objects at once.
+    Objects can be read back as soon as they have been stored.
+
+    Once ``commit`` is called, the pack and its index are moved into place under their
+    final names. Use instances as context manager to commit automatically, or to
+    ``rollback`` if an exception occurred::
+
+        with PackWriterDB(pack_dir) as pwdb:
+            pwdb.store(istream)
+        # pack_dir/pack-<sha>.pack and .idx exist now
+
+    **Note:** Objects which are stored more than once will only be written once"""
+
+    def __init__(self, root_path, zlib_compression=zlib.Z_BEST_SPEED, compression=None):
+        """
+        :param root_path: directory into which to write the pack and index
+        :param zlib_compression: zlib compression level to use for all objects
+        :param compression: if not None, an AdaptiveCompression instance deciding
+            on the compression level per object. zlib_compression is ignored in that case"""
+        super().__init__(root_path)
+        self._zlib_compression = zlib_compression
+        self._compression = compression
+        self._fd = None                 # file descriptor of the pending pack
+        self._path = None               # path to the pending pack
+        self._rfile = None              # file object to read pending objects
+        self._ofs = 0                   # offset at which the next object will be written
+        # maps binsha to tuple(type, size, data_offset, end_offset, crc, offset)
+        self._objs = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        # END handle exception
+
+    def __del__(self):
+        if self._fd is not None:
+            self.rollback()
+        # END release pending pack
+
+    def _open(self):
+        """Create the pending pack file and write its preliminary header"""
+        self._fd, self._path = tempfile.mkstemp('', 'tmp_pack_', self._root_path)
+        self._rfile = open(self._path, 'rb')
+        self._write(pack('>LLL', PackFile.pack_signature, PackFile.pack_version_default, 0))
+        self._ofs = PackFile.first_object_offset
+
+    def _write(self, data):
+        os.write(self._fd, data)
+
+    def _truncate(self):
+        """Drop everything written after the last complete object"""
+        os.ftruncate(self._fd, self._ofs)
+        os.lseek(self._fd, self._ofs, os.SEEK_SET)
+
+    def _pending_info(self, sha):
+        try:
+            return self._objs[sha]
+        except KeyError as e:
+            raise BadObject(sha) from e
+        # END handle unknown object
+
+    #{ Object DB Read
+
+    def has_object(self, sha):
+        return sha in self._objs
+
+    def info(self, sha):
+        return OInfo(sha, *self._pending_info(sha)[:2])
+
+    def stream(self, sha):
+        type, size, data_offset, end_offset = self._pending_info(sha)[:4]
+        self._rfile.seek(data_offset)
+        data = self._rfile.read(end_offset - data_offset)
+        return OStream(sha, type, size, DecompressMemMapReader(data, False, size))
+
+    def size(self):
+        return len(self._objs)
+
+    def sha_iter(self):
+        return iter(list(self._objs))
+
+    def partial_to_complete_sha(self, partial_binsha, canonical_length):
+        """:return: 20 byte sha as inferred by the given partial binary sha
+        :raise AmbiguousObjectName:
+        :raise BadObject: """
+        candidate = None
+        for binsha in self._objs:
+            if is_equal_canonical_sha(canonical_length, partial_binsha, binsha):
+                if candidate is not None:
+                    raise AmbiguousObjectName(partial_binsha)
+                candidate = binsha
+            # END handle match
+        # END for each object
+        if candidate is None:
+            raise BadObject(partial_binsha)
+        return candidate
+
+    #} END object db read
+
+    #{ Object DB Write
+
+    def store(self, istream):
+        """Append the object to the pending pack.
+
+        :raise IOError: if data could not be written"""
+        if self._fd is None:
+            self._open()
+        # END open pending pack on first write
+
+        type, size, read = istream.type, istream.size, istream.read
+        if istream.binsha is not None:
+            # the stream is in loose object format, we need the plain data
+            type, size, stream = DecompressMemMapReader.new(read())
+            read = stream.read
+        # END handle object format
+
+        sha_writer = Sha1Writer()
+        sha_writer.write(loose_object_header(type, size))
+
+        def sha_read(count):
+            data = read(count)
+            sha_writer.write(data)
+            return data
+        # END read helper
+
+        if self._compression is None:
+            zstream = zlib.compressobj(self._zlib_compression)
+        else:
+            zstream = self._compression.compressobj(type, size)
+        # END handle compression policy
+
+        hdr = create_pack_object_header(type_to_type_id_map[type], size)
+        try:
+            self._write(hdr)
+            br, bw, crc = write_stream_to_pack(sha_read, self._write, zstream, base_crc=crc32(hdr))
+            if br != size:
+                raise ValueError("Expected to read %i bytes from input stream, got %i" % (size, br))
+            # END verify size
+
+            binsha = sha_writer.sha(as_hex=False)
+            if istream.binsha is not None and istream.binsha != binsha:
+                raise ValueError("Object in stream did not match the given sha %s" % istream.hexsha)
+            # END verify given sha
+        except:
+            self._truncate()
+            raise
+        # END drop partially written object on error
+
+        data_offset = self._ofs + len(hdr)
+        end_offset = data_offset + bw
+        if binsha in self._objs:
+            # drop the duplicate
+            self._truncate()
+        else:
+            self._objs[binsha] = (type, size, data_offset, end_offset, crc, self._ofs)
+            self._ofs = end_offset
+        # END handle duplicates
+
+        istream.binsha = binsha
+        return istream
+
+    #} END object db write
+
+    #{ Interface
+
+    def commit(self):
+        """Finalize the pending pack and write its index. Both are moved into place
+        atomically, the index first, so that readers never see a pack without index.
+
+        :return: PackEntity of the new pack, or None if no object was stored"""
+        if self._fd is None:
+            return None
+        # END handle nothing written
+
+        if not self._objs:
+            self.rollback()
+            return None
+        # END handle empty pack
+
+        # fix the object count in the header, and compute the pack's checksum
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        self._write(pack('>LLL', PackFile.pack_signature, PackFile.pack_version_default, len(self._objs)))
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        sha = make_sha()
+        while True:
+            chunk = os.read(self._fd, chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+        # END for each chunk
+        pack_sha = sha.digest()
+        self._write(pack_sha)
+        os.close(self._fd)
+        self._fd = None
+        self._rfile.close()
+
+        index = IndexWriter()
+        for binsha, info in self._objs.items():
+            index.append(binsha, info[4], info[5])
+        # END for each object
+        index_fd, index_path = tempfile.mkstemp('', 'tmp_idx_', self._root_path)
+        try:
+            index.write(pack_sha, lambda d: os.write(index_fd, d))
+        finally:
+            os.close(index_fd)
+        # END assure index is closed
+
+        fmt = os.path.join(self._root_path, "pack-%s.%s")
+        new_pack_path = fmt % (bin_to_hex(pack_sha).decode('ascii'), 'pack')
+        os.replace(index_path, fmt % (bin_to_hex(pack_sha).decode('ascii'), 'idx'))
+        os.replace(self._path, new_pack_path)
+        self._path = None
+        self._objs = dict()
+
+        return PackEntity(new_pack_path)
+
+    def rollback(self):
+        """Discard all objects stored so far, and remove the pending pack.
+
+        **Note:** can be called multiple times"""
+        if self._fd is None:
+            return
+        # END handle nothing written
+        os.close(self._fd)
+        self._fd = None
+        self._rfile.close()
+        remove(self._path)
+        self._path = None
+        self._objs = dict()
+
     #} END interface
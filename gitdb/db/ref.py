@@ -52,9 +52,9 @@ class ReferenceDB(CompoundDB):
 
         # remove existing
         for path in (cur_ref_paths_set - ref_paths_set):
-            for i, db in enumerate(self._dbs[:]):
+            for db in self._dbs[:]:
                 if db.root_path() == path:
-                    del(self._dbs[i])
+                    self.remove_db(db)
                     continue
                 # END del matching db
         # END for each path to remove
@@ -77,5 +77,11 @@ class ReferenceDB(CompoundDB):
 
     def update_cache(self, force=False):
         # re-read alternates and update databases
+        dbs = list(self._dbs)
         self._update_dbs_from_ref_file()
-        return super().update_cache(force)
+        changed = dbs != self._dbs
+        if changed:
+            # rare enough to forget everything
+            self.invalidate_cache()
+        # END handle changed alternates
+        return super().update_cache(force) or changed
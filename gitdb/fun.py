@@ -55,7 +55,8 @@ chunk_size = 1000 * mmap.PAGESIZE
 
 __all__ = ('is_loose_object', 'loose_object_header_info', 'msb_size', 'pack_object_header_info',
            'write_object', 'loose_object_header', 'stream_copy', 'apply_delta_data',
-           'is_equal_canonical_sha', 'connect_deltas', 'DeltaChunkList', 'create_pack_object_header')
+           'is_equal_canonical_sha', 'connect_deltas', 'DeltaChunkList', 'create_pack_object_header',
+           'create_delta')
 
 
 #{ Structures
@@ -678,6 +679,105 @@ def apply_delta_data(src_buf, src_buf_size, delta_buf, delta_buf_size, write):
     assert i == delta_buf_size, "delta replay has gone wild"
 
 
+def _encode_msb_size(size):
+    """:return: bytes encoding size the way ``msb_size`` reads it"""
+    out = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            out.append(c | 0x80)
+        else:
+            out.append(c)
+            break
+        # END handle last byte
+    # END until size is consumed
+    return out
+
+
+def create_delta(src_buf, target_buf, block_size=16):
+    """
+    Create delta data which turns the source buffer into the target buffer when
+    applied with ``apply_delta_data``.
+
+    Blocks of the source buffer are indexed, and each match found in the target buffer
+    is extended as far as possible and encoded as copy operation. Everything else
+    is inserted literally.
+
+    :param src_buf: bytes of the base object
+    :param target_buf: bytes of the object the delta should produce
+    :param block_size: size of the source blocks to index. Smaller blocks find more
+        matches, but increase the size of the index
+    :return: bytes of the uncompressed delta, including the source and target size header"""
+    src_len = len(src_buf)
+    target_len = len(target_buf)
+    out = _encode_msb_size(src_len)
+    out += _encode_msb_size(target_len)
+
+    def add_insert(start, end):
+        while start < end:
+            n = min(end - start, 0x7f)
+            out.append(n)
+            out.extend(target_buf[start:start + n])
+            start += n
+        # END for each insert op
+    # END utility
+
+    index = dict()
+    for i in range(0, src_len - block_size + 1, block_size):
+        index.setdefault(src_buf[i:i + block_size], i)
+    # END index source blocks
+
+    max_copy = 0xffffff
+    insert_start = 0
+    i = 0
+    while i + block_size <= target_len:
+        src_ofs = index.get(target_buf[i:i + block_size])
+        if src_ofs is None:
+            i += 1
+            continue
+        # END handle no match
+
+        # extend the match in large steps first, then byte by byte
+        length = block_size
+        step = 64
+        while step:
+            while (length + step <= max_copy and i + length + step <= target_len and
+                   src_ofs + length + step <= src_len and
+                   target_buf[i + length:i + length + step] == src_buf[src_ofs + length:src_ofs + length + step]):
+                length += step
+            # END while step matches
+            step //= 8
+        # END for each step size
+
+        add_insert(insert_start, i)
+        cmd = 0x80
+        args = bytearray()
+        for bit in range(4):
+            c = (src_ofs >> (bit * 8)) & 0xff
+            if c:
+                cmd |= 1 << bit
+                args.append(c)
+            # END handle offset byte
+        # END for each offset byte
+        for bit in range(3):
+            c = (length >> (bit * 8)) & 0xff
+            if c:
+                cmd |= 0x10 << bit
+                args.append(c)
+            # END handle size byte
+        # END for each size byte
+        out.append(cmd)
+        out += args
+
+        i += length
+        insert_start = i
+    # END for each target position
+    add_insert(insert_start, target_len)
+
+    return bytes(out)
+
+
 def is_equal_canonical_sha(canonical_length, match, sha1):
     """
     :return: True if the given lhs and rhs 20 byte binary shas
@@ -18,13 +18,19 @@ from gitdb.util import (
     unpack_from,
     bin_to_hex,
     byte_ord,
+    make_sha,
+    copy_file_range_to,
 )
 
 from gitdb.fun import (
+    apply_delta_data,
+    create_delta,
     create_pack_object_header,
     pack_object_header_info,
     is_equal_canonical_sha,
+    loose_object_header,
     type_id_to_type_map,
+    type_to_type_id_map,
     write_object,
     stream_copy,
     chunk_size,
@@ -55,20 +61,34 @@ from gitdb.stream import (
     DeltaApplyReader,
     Sha1Writer,
     NullStream,
-    FlexibleSha1Writer
+    FlexibleSha1Writer,
+    PipelinedCompressedSha1Writer,
+    ZippedContentReader
 )
 
 from struct import pack
 from binascii import crc32
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from itertools import islice
 
 from gitdb.const import NULL_BYTE
+from gitdb.utils.encoding import force_bytes
+from gitdb.typ import (
+    str_blob_type,
+    str_commit_type,
+    str_tag_type,
+    str_tree_type
+)
+
+from contextlib import suppress
 
 import tempfile
 import array
 import os
 import sys
 
-__all__ = ('PackIndexFile', 'PackFile', 'PackEntity')
+__all__ = ('PackIndexFile', 'PackFile', 'PackEntity', 'PackStreamScanner', 'AccessLog')
 
 
 #{ Utilities
@@ -167,8 +187,662 @@ def write_stream_to_pack(read, write, zstream, base_crc=None):
     return (br, bw, crc)
 
 
+def pack_crc32(cursor, start, end):
+    """:return: crc32 over the pack bytes in the range [start, end)
+    :param cursor: smmap cursor on the pack"""
+    crc = 0
+    while start < end:
+        buf = cursor.use_region(start, end - start).buffer()[:end - start]
+        crc = crc32(buf, crc)
+        start += len(buf)
+    # END for each mapped window
+    return crc & 0xffffffff
+
+
+def apply_delta(base_data, delta_data):
+    """:return: bytes of the object resulting from applying the given uncompressed
+        delta data to the given base data"""
+    i, src_size = msb_size(delta_data)
+    i, target_size = msb_size(delta_data, i)
+    out = list()
+    apply_delta_data(base_data, src_size, delta_data[i:], len(delta_data) - i, out.append)
+    data = b''.join(out)
+    if len(data) != target_size:
+        raise ParseError("Delta produced %i bytes, expected %i" % (len(data), target_size))
+    return data
+
+
+def resolve_delta_trees(pack_path, roots, ofs_children, ref_children):
+    """Resolve all deltas depending on the given base objects, directly or indirectly.
+
+    Only the data of the objects on the path from the current delta to its root is kept
+    in memory, which bounds the memory requirements by the depth of the delta chains.
+
+    :param pack_path: path to the pack file containing the objects
+    :param roots: iterable of tuple(offset, binsha) of base objects
+    :param ofs_children: dict mapping offsets to lists of OFS_DELTA offsets using them as base
+    :param ref_children: dict mapping binshas to lists of REF_DELTA offsets using them as base
+    :return: list of tuple(offset, binsha) of all resolved deltas
+
+    **Note:** must be a module level function to be usable in a process pool"""
+    pack_file = PackFile(pack_path)
+    out = list()
+    try:
+        for root_offset, root_sha in roots:
+            root = pack_file.stream(root_offset)
+            out.extend(resolve_delta_tree(pack_file, root_offset, root_sha, root.type, root.read(),
+                                          ofs_children, ref_children))
+        # END for each root
+    finally:
+        pack_file.close()
+    # END assure pack is closed
+    return out
+
+
+def delta_subtrees(roots, ofs_children, ref_children, known_shas):
+    """Restrict the child mappings to the deltas which may depend on the given base objects,
+    to pass no more than needed to a process resolving them.
+
+    REF_DELTAs whose base is a delta itself can't be attributed to a root before resolving,
+    they are kept for all roots. These are rare, as git writes OFS_DELTAs by default.
+
+    :param roots: iterable of tuple(offset, binsha) of base objects
+    :param ofs_children: see ``resolve_delta_trees``
+    :param ref_children: see ``resolve_delta_trees``
+    :param known_shas: set of the binshas of all objects resolved so far
+    :return: tuple(ofs_children, ref_children) restricted to the trees of the roots"""
+    sub_ref = {sha: children for sha, children in ref_children.items() if sha not in known_shas}
+    for _, sha in roots:
+        if sha in ref_children:
+            sub_ref[sha] = ref_children[sha]
+        # END handle REF_DELTA children
+    # END for each root
+
+    sub_ofs = dict()
+    stack = [ofs for ofs, _ in roots]
+    for children in sub_ref.values():
+        stack.extend(children)
+    # END for each list of REF_DELTA children
+    while stack:
+        ofs = stack.pop()
+        children = ofs_children.get(ofs)
+        if children is not None and ofs not in sub_ofs:
+            sub_ofs[ofs] = children
+            stack.extend(children)
+        # END handle OFS_DELTA children
+    # END for each object in the trees
+    return sub_ofs, sub_ref
+
+
+def resolve_delta_tree(pack_file, root_offset, root_sha, type, data, ofs_children, ref_children):
+    """Resolve all deltas depending on a single base object, whose data is given.
+
+    :param pack_file: PackFile containing the deltas
+    :param root_offset: offset of the base object in the pack, or None if it is not part of it
+    :param root_sha: binary sha of the base object
+    :param type: type string of the base object
+    :param data: uncompressed data of the base object
+    :param ofs_children: see ``resolve_delta_trees``
+    :param ref_children: see ``resolve_delta_trees``
+    :return: list of tuple(offset, binsha) of all resolved deltas"""
+    out = list()
+    stack = [(child, data) for child in ofs_children.get(root_offset, ())]
+    stack.extend((child, data) for child in ref_children.get(root_sha, ()))
+    del data
+    while stack:
+        offset, base_data = stack.pop()
+        data = apply_delta(base_data, pack_file.stream(offset).read())
+        sha = make_sha(loose_object_header(type, len(data)))
+        sha.update(data)
+        binsha = sha.digest()
+        out.append((offset, binsha))
+
+        stack.extend((child, data) for child in ofs_children.get(offset, ()))
+        stack.extend((child, data) for child in ref_children.get(binsha, ()))
+    # END for each delta in tree
+    return out
+
+
+def scan_pack_file(pack_file, progress=None):
+    """Scan all entries of the given pack once, verifying its checksum
+
+    :param pack_file: PackFile instance, it will be closed when done
+    :param progress: see ``PackEntity.index_pack``
+    :return: tuple(pack_sha, num_objects, crcs, shas, ofs_children, ref_children), see
+        ``index_pack_objects`` for details
+    :raise ParseError: if the pack is truncated or its checksum doesn't match"""
+    cursor = pack_file._cursor
+    num_objects = pack_file.size()
+    content_size = cursor.file_size() - pack_file.footer_size
+
+    # verify the checksum
+    sha = make_sha()
+    ofs = 0
+    while ofs < content_size:
+        buf = cursor.use_region(ofs, content_size - ofs).buffer()[:content_size - ofs]
+        sha.update(buf)
+        ofs += len(buf)
+    # END for each window
+    pack_sha = pack_file.checksum()
+    if sha.digest() != pack_sha:
+        raise ParseError("Checksum mismatch in pack at %s" % pack_file.path())
+    # END verify checksum
+
+    # SCAN ENTRIES
+    crcs = dict()           # offset -> crc
+    shas = dict()           # offset -> binsha
+    ofs_children = dict()   # base offset -> list of delta offsets
+    ref_children = dict()   # base binsha -> list of delta offsets
+    null = NullStream()
+    ofs = pack_file.first_object_offset
+    for _ in range(num_objects):
+        if ofs >= content_size:
+            raise ParseError("Pack at %s ended after less than %i objects" % (pack_file.path(), num_objects))
+        # END handle truncated pack
+        data_offset, ostream = pack_object_at(cursor, ofs, True)
+        if ostream.type_id in delta_types:
+            stream_copy(ostream.read, null.write, ostream.size, chunk_size)
+            if ostream.type_id == OFS_DELTA:
+                ofs_children.setdefault(ofs - ostream.delta_info, list()).append(ofs)
+            else:
+                ref_children.setdefault(bytes(ostream.delta_info), list()).append(ofs)
+            # END handle delta type
+        else:
+            sha_writer = Sha1Writer()
+            write_object(ostream.type, ostream.size, ostream.read, sha_writer.write)
+            shas[ofs] = sha_writer.sha(as_hex=False)
+        # END handle object type
+        next_ofs = data_offset + ostream.stream.compressed_bytes_read()
+        crcs[ofs] = pack_crc32(cursor, ofs, next_ofs)
+        ofs = next_ofs
+
+        if progress is not None and ostream.type_id not in delta_types:
+            progress(len(shas), num_objects)
+        # END handle progress
+    # END for each entry
+    pack_file.close()
+
+    return pack_sha, num_objects, crcs, shas, ofs_children, ref_children
+
+
+def append_pack_objects(pack_path, ostreams, zlib_compression=zlib.Z_BEST_SPEED):
+    """Append the given objects to the complete pack at pack_path, updating its header
+    and checksum accordingly.
+
+    :param ostreams: iterable of OStream instances to append as base objects
+    :return: tuple(pack_sha, list of tuple(offset, binsha, crc) of the appended objects)"""
+    out = list()
+    with open(pack_path, 'r+b') as fp:
+        fp.seek(8)
+        num_objects = unpack_from('>L', fp.read(4))[0]
+        ofs = fp.seek(-PackFile.footer_size, os.SEEK_END)
+        fp.truncate()
+        for ostream in ostreams:
+            hdr = create_pack_object_header(ostream.type_id, ostream.size)
+            fp.write(hdr)
+            br, bw, crc = write_stream_to_pack(ostream.read, fp.write, zlib.compressobj(zlib_compression),
+                                               base_crc=crc32(hdr))
+            out.append((ofs, ostream.binsha, crc))
+            ofs += len(hdr) + bw
+        # END for each object
+
+        fp.seek(8)
+        fp.write(pack('>L', num_objects + len(out)))
+        fp.seek(0)
+        sha = make_sha()
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+        # END for each chunk
+        pack_sha = sha.digest()
+        fp.write(pack_sha)
+    # END pack file handling
+    return pack_sha, out
+
+
+def index_pack_objects(pack_path, pack_sha, num_objects, crcs, shas, ofs_children, ref_children,
+                       workers=1, progress=None, base_db=None):
+    """Resolve all deltas of a scanned pack and produce the information for its index.
+
+    :param pack_path: path to the complete pack file
+    :param pack_sha: binary sha of the pack
+    :param num_objects: amount of objects in the pack
+    :param crcs: dict mapping the offsets of all objects to their crc32
+    :param shas: dict mapping the offsets of all base objects to their binsha. It will
+        be updated with the binshas of all deltas
+    :param ofs_children: see ``resolve_delta_trees``
+    :param ref_children: see ``resolve_delta_trees``
+    :param workers: amount of processes to use when resolving deltas
+    :param progress: see ``PackEntity.index_pack``
+    :param base_db: if not None, the pack may be thin. REF_DELTA bases which are not
+        part of the pack will be retrieved from this database and appended to the pack.
+        As this changes the pack, it will be moved to a temporary path in the same directory
+        beforehand, which allows memory maps of the original pack to stay valid
+    :return: tuple(pack_path, pack_sha, IndexWriter containing information about all objects),
+        pack_path being the possibly changed path to the pack
+    :raise ParseError: if not all deltas could be resolved"""
+    def resolve(roots):
+        if workers > 1 and len(roots) > 1:
+            batches = [roots[i::workers * 4] for i in range(min(len(roots), workers * 4))]
+            known_shas = set(shas.values())
+            with ProcessPoolExecutor(workers) as executor:
+                # each process only receives the trees of its roots, which bounds its memory
+                results = [executor.submit(resolve_delta_trees, pack_path, batch,
+                                           *delta_subtrees(batch, ofs_children, ref_children, known_shas))
+                           for batch in batches]
+                for result in results:
+                    shas.update(result.result())
+                    if progress is not None:
+                        progress(len(shas), num_objects)
+                    # END handle progress
+                # END for each result
+            # END process pool
+        elif roots:
+            shas.update(resolve_delta_trees(pack_path, roots, ofs_children, ref_children))
+            if progress is not None:
+                progress(len(shas), num_objects)
+            # END handle progress
+        # END handle worker count
+    # END utility
+
+    resolve([item for item in shas.items() if item[0] in ofs_children or item[1] in ref_children])
+
+    # complete thin packs like git does: take one missing base at a time, and resolve its
+    # deltas right away. These may produce bases of other deltas, which then aren't missing
+    # anymore - appending them as well would duplicate objects of the pack
+    if len(shas) < num_objects and base_db is not None:
+        available = set(shas.values())
+        missing = list()
+        pack_file = PackFile(pack_path)
+        try:
+            for base_sha in ref_children:
+                if base_sha in available or not base_db.has_object(base_sha):
+                    continue
+                # END skip resolved or unknown bases
+                ostream = base_db.stream(base_sha)
+                missing.append(base_sha)
+                available.add(base_sha)
+                for ofs, binsha in resolve_delta_tree(pack_file, None, base_sha, ostream.type, ostream.read(),
+                                                      ofs_children, ref_children):
+                    shas[ofs] = binsha
+                    available.add(binsha)
+                # END for each resolved delta
+            # END for each base of a delta
+        finally:
+            pack_file.close()
+        # END assure pack is closed
+
+        # a base may have been taken before the delta producing it was resolved
+        resolved = set(shas.values())
+        missing = [sha for sha in missing if sha not in resolved]
+        if missing:
+            fd, tmp_path = tempfile.mkstemp('', 'tmp_pack_', os.path.dirname(pack_path))
+            os.close(fd)
+            os.replace(pack_path, tmp_path)
+            pack_path = tmp_path
+            pack_sha, appended = append_pack_objects(pack_path, (base_db.stream(sha) for sha in missing))
+            num_objects += len(appended)
+            for ofs, binsha, crc in appended:
+                shas[ofs] = binsha
+                crcs[ofs] = crc
+            # END for each appended object
+        # END append missing bases
+        if progress is not None:
+            progress(len(shas), num_objects)
+        # END handle progress
+    # END complete thin pack
+
+    if len(shas) != num_objects:
+        raise ParseError("Could not resolve %i deltas in pack at %s, their bases are missing" %
+                         (num_objects - len(shas), pack_path))
+    # END verify all objects are resolved
+
+    index = IndexWriter()
+    for ofs, binsha in sorted(shas.items()):
+        index.append(binsha, crcs[ofs], ofs)
+    # END for each object
+    return pack_path, pack_sha, index
+
+
+def write_index_files(basename, pack_sha, index, write_rev=False):
+    """Write the index, and possibly the reverse index, of a pack. Each file is
+    written to a temporary file first, and moved into place once it is complete.
+
+    :param basename: path to the pack without its extension
+    :param pack_sha: binary sha of the pack
+    :param index: IndexWriter with information about all objects in the pack
+    :param write_rev: if True, the reverse index is written as well"""
+    base_dir = os.path.dirname(basename)
+    for ext, writer in (('idx', index.write), ('rev', write_rev and index.write_rev)):
+        if not writer:
+            continue
+        fd, tmp_path = tempfile.mkstemp('', 'tmp_%s_' % ext, base_dir)
+        try:
+            writer(pack_sha, lambda d: os.write(fd, d))
+        finally:
+            os.close(fd)
+        # END assure file is closed
+        os.replace(tmp_path, "%s.%s" % (basename, ext))
+    # END for each file to write
+
+
+class PackStreamScanner:
+
+    """Parses a pack as it is read from a possibly non-seekable stream, and passes
+    all bytes it reads on to a write function, usually writing them into a file.
+
+    While doing so, the crc's of all entries are computed, as well as the sha's of
+    all base objects, which is all information required to resolve the deltas
+    once the pack was received completely."""
+    __slots__ = ('_read', '_write', '_buf', '_pos', '_ofs', '_sha', '_crc')
+
+    def __init__(self, read, write):
+        """
+        :param read: function reading the given amount of bytes from the stream, returning
+            less bytes if there is currently no more data, and an empty bytes object
+            once the end of the stream is reached
+        :param write: function receiving all bytes of the pack"""
+        self._read = read
+        self._write = write
+        self._buf = bytearray()     # data read from the stream
+        self._pos = 0               # position of the first unconsumed byte in our buffer
+        self._ofs = 0
+        self._sha = make_sha()
+        self._crc = 0
+
+    def _fill(self, size):
+        while len(self._buf) - self._pos < size:
+            data = self._read(chunk_size)
+            if not data:
+                raise ParseError("Pack stream ended unexpectedly at offset %i"
+                                 % (self._ofs + len(self._buf) - self._pos))
+            # END handle end of stream
+            if self._pos:
+                # drop the consumed bytes before growing the buffer
+                del self._buf[:self._pos]
+                self._pos = 0
+            # END compact buffer
+            self._buf += data
+        # END while buffer is too small
+
+    def _consume(self, data):
+        self._sha.update(data)
+        self._crc = crc32(data, self._crc)
+        self._write(data)
+        self._ofs += len(data)
+
+    def _take(self, size):
+        self._fill(size)
+        data = bytes(self._buf[self._pos:self._pos + size])
+        self._pos += size
+        self._consume(data)
+        return data
+
+    def _inflate(self, write):
+        """Decompress the zlib stream at our position, passing the data to write
+        :return: amount of decompressed bytes"""
+        zstream = zlib.decompressobj()
+        br = 0
+        while not zstream.eof:
+            if self._pos == len(self._buf):
+                self._fill(1)
+            # END handle empty buffer
+            # the view must be released before the buffer may be resized
+            indata = memoryview(self._buf)[self._pos:]
+            try:
+                data = zstream.decompress(indata, chunk_size)
+                used = len(indata) - len(zstream.unconsumed_tail) - len(zstream.unused_data)
+                consumed = indata[:used].tobytes()
+            finally:
+                indata.release()
+            # END release buffer
+            self._pos += used
+            self._consume(consumed)
+            br += len(data)
+            write(data)
+        # END until the end of the compressed stream
+        return br
+
+    def scan(self):
+        """Read the whole pack from the stream
+
+        :return: tuple(pack_sha, num_objects, crcs, shas, ofs_children, ref_children), see
+            ``index_pack_objects`` for details
+        :raise ParseError: if the pack could not be parsed or its checksum didn't match
+
+        **Note:** the stream may be read beyond the end of the pack, these bytes are ignored"""
+        type_id, version, num_objects = unpack_from('>LLL', self._take(12))
+        if type_id != PackFile.pack_signature:
+            raise ParseError("Invalid pack signature: %i" % type_id)
+        # END check signature
+
+        crcs = dict()
+        shas = dict()
+        ofs_children = dict()
+        ref_children = dict()
+        null = NullStream()
+        for _ in range(num_objects):
+            ofs = self._ofs
+            self._crc = 0
+
+            c = byte_ord(self._take(1)[0])
+            type_id = (c >> 4) & 7
+            size = c & 15
+            s = 4
+            while c & 0x80:
+                c = byte_ord(self._take(1)[0])
+                size += (c & 0x7f) << s
+                s += 7
+            # END parse object header
+
+            if type_id == OFS_DELTA:
+                c = byte_ord(self._take(1)[0])
+                delta_offset = c & 0x7f
+                while c & 0x80:
+                    c = byte_ord(self._take(1)[0])
+                    delta_offset += 1
+                    delta_offset = (delta_offset << 7) + (c & 0x7f)
+                # END parse delta offset
+                ofs_children.setdefault(ofs - delta_offset, list()).append(ofs)
+                br = self._inflate(null.write)
+            elif type_id == REF_DELTA:
+                ref_children.setdefault(self._take(20), list()).append(ofs)
+                br = self._inflate(null.write)
+            else:
+                sha_writer = Sha1Writer()
+                sha_writer.write(loose_object_header(type_id_to_type_map[type_id], size))
+                br = self._inflate(sha_writer.write)
+                shas[ofs] = sha_writer.sha(as_hex=False)
+            # END handle object type
+
+            if br != size:
+                raise ParseError("Object at offset %i has %i bytes, expected %i" % (ofs, br, size))
+            # END verify size
+            crcs[ofs] = self._crc & 0xffffffff
+        # END for each object
+
+        pack_sha = self._sha.digest()
+        self._fill(20)
+        if self._buf[self._pos:self._pos + 20] != pack_sha:
+            raise ParseError("Checksum mismatch in pack stream")
+        # END verify checksum
+        self._write(pack_sha)
+
+        return pack_sha, num_objects, crcs, shas, ofs_children, ref_children
+
+
+def read_ewah_bitmap(data, offset):
+    """Read an EWAH compressed bitmap as serialized by git
+
+    :param data: buffer containing the bitmap
+    :param offset: offset into data at which the bitmap starts
+    :return: tuple(bit_size, words, next_offset) with words being the tuple of 64 bit
+        words of the compressed bitmap, and next_offset pointing behind the bitmap"""
+    bit_size, num_words = unpack_from(">LL", data, offset)
+    offset += 8
+    words = unpack_from(">%iQ" % num_words, data, offset)
+    # skip the words and the position of the last run length word
+    return bit_size, words, offset + num_words * 8 + 4
+
+
+def ewah_bit_positions(bit_size, words):
+    """:return: iterator yielding the positions of all set bits in ascending order
+    :param bit_size: amount of bits in the bitmap
+    :param words: compressed words as returned by ``read_ewah_bitmap``"""
+    pos = 0
+    i = 0
+    num_words = len(words)
+    while i < num_words:
+        # run length word: the running bit, 32 bits of run length, 31 bits of literal words count
+        rlw = words[i]
+        i += 1
+        run_bits = ((rlw >> 1) & 0xffffffff) * 64
+        if rlw & 1:
+            yield from range(pos, min(pos + run_bits, bit_size))
+        # END handle run of ones
+        pos += run_bits
+
+        for word in words[i:i + (rlw >> 33)]:
+            bit = 0
+            while word:
+                if word & 1 and pos + bit < bit_size:
+                    yield pos + bit
+                # END handle set bit
+                word >>= 1
+                bit += 1
+            # END for each set bit
+            pos += 64
+        # END for each literal word
+        i += rlw >> 33
+    # END for each run length word
+
+
 #} END utilities
 
+#{ Object Ordering
+
+# order in which object types are written by order_by_type, as git does it
+_type_order = {str_commit_type: 0, str_tag_type: 1, str_tree_type: 2, str_blob_type: 3}
+
+
+def order_by_type(objects, thin_bases=None):
+    """Ordering for ``PackEntity.write_pack`` which clusters objects by type, writing commits,
+    tags, trees and blobs in that order. The order of objects of the same type is retained.
+
+    :param objects: list of OStream instances
+    :param thin_bases: unused, for compatibility with the ordering interface
+    :return: list of the given objects in the order to write them"""
+    return sorted(objects, key=lambda obj: _type_order.get(obj.type, len(_type_order)))
+
+
+def order_bases_first(objects, thin_bases):
+    """Ordering for ``PackEntity.write_pack`` placing each delta base in front of its deltas,
+    which directly follow it. Reading a delta chain then touches a contiguous region of the pack.
+
+    :param objects: list of OStream instances
+    :param thin_bases: dict mapping binshas of objects to the binsha of their delta base, see
+        ``PackEntity.write_pack``. Bases which are not among the objects are ignored
+    :return: list of the given objects in the order to write them"""
+    thin_bases = thin_bases or dict()
+    shas = {obj.binsha for obj in objects}
+    children = dict()
+    roots = list()
+    for obj in objects:
+        base_sha = thin_bases.get(obj.binsha)
+        if base_sha in shas and base_sha != obj.binsha:
+            children.setdefault(base_sha, list()).append(obj)
+        else:
+            roots.append(obj)
+        # END handle deltas
+    # END for each object
+
+    ordered = list()
+    seen = set()
+    for root in roots:
+        stack = [root]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen:
+                continue
+            # END skip objects which are their own base through other objects
+            seen.add(id(obj))
+            ordered.append(obj)
+            stack.extend(reversed(children.get(obj.binsha, ())))
+        # END for each object in the delta tree
+    # END for each tree
+
+    # objects in base cycles are never reached from a root - keep them anyway
+    if len(ordered) < len(objects):
+        ordered.extend(obj for obj in objects if id(obj) not in seen)
+    # END handle cycles
+    return ordered
+
+
+class _AccessTrackingDB:
+
+    """Database proxy recording all objects read through stream() in an AccessLog"""
+    __slots__ = ('_db', '_log')
+
+    def __init__(self, db, log):
+        self._db = db
+        self._log = log
+
+    def __getattr__(self, attr):
+        return getattr(self._db, attr)
+
+    def stream(self, sha):
+        self._log.record(sha)
+        return self._db.stream(sha)
+
+
+class AccessLog:
+
+    """Records the order in which objects are first read, allowing to write packs in which
+    objects that are read together are adjacent::
+
+        log = AccessLog()
+        db = log.track(odb)
+        # ... read objects using db.stream(sha) as usual
+        PackEntity.create(objects, pack_dir, order=log.order)
+    """
+    __slots__ = '_positions'
+
+    def __init__(self):
+        self._positions = dict()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def record(self, sha):
+        """Record an access to the object with the given binary sha, unless it was seen before"""
+        if sha not in self._positions:
+            self._positions[sha] = len(self._positions)
+        # END record first access only
+
+    def track(self, db):
+        """:return: proxy to the given database which records all objects read through its
+            stream() method in this log"""
+        return _AccessTrackingDB(db, self)
+
+    def clear(self):
+        """Forget all recorded accesses"""
+        self._positions.clear()
+
+    def order(self, objects, thin_bases=None):
+        """Ordering for ``PackEntity.write_pack`` writing objects in the order in which they were
+        first accessed. Objects without recorded access follow in their original order
+
+        :param objects: list of OStream instances
+        :param thin_bases: unused, for compatibility with the ordering interface
+        :return: list of the given objects in the order to write them"""
+        positions = self._positions
+        unknown = len(positions)
+        return sorted(objects, key=lambda obj: positions.get(obj.binsha, unknown))
+
+#} END object ordering
+
 
 class IndexWriter:
 
@@ -177,6 +851,11 @@ class IndexWriter:
     **Note:** currently only writes v2 indices"""
     __slots__ = '_objs'
 
+    # reverse index format, hash id 1 is sha1
+    rev_signature = b'RIDX'
+    rev_version = 1
+    rev_hash_id = 1
+
     def __init__(self):
         self._objs = list()
 
@@ -240,6 +919,26 @@ class IndexWriter:
         write(sha)
         return sha
 
+    def write_rev(self, pack_sha, write):
+        """Write a reverse index, which maps positions of objects in the pack to
+        their position in the index, using the given write method
+        :param pack_sha: binary sha over the whole pack that we index
+        :return: sha1 binary sha over all reverse index contents"""
+        self._objs.sort(key=lambda o: o[0])
+        order = sorted(range(len(self._objs)), key=lambda i: self._objs[i][2])
+
+        sha_writer = FlexibleSha1Writer(write)
+        sha_write = sha_writer.write
+        sha_write(self.rev_signature)
+        sha_write(pack('>LL', self.rev_version, self.rev_hash_id))
+        sha_write(pack('>%iL' % len(order), *order))
+
+        assert(len(pack_sha) == 20)
+        sha_write(pack_sha)
+        sha = sha_writer.sha(as_hex=False)
+        write(sha)
+        return sha
+
 
 class PackIndexFile(LazyMixin):
 
@@ -261,8 +960,9 @@ class PackIndexFile(LazyMixin):
         self._indexpath = indexpath
 
     def close(self):
+        """Release our memory map. It is recreated once we are used again"""
         mman.force_map_handle_removal_win(self._indexpath)
-        self._cursor = None
+        self.__dict__.pop('_cursor', None)
 
     def _set_cache_(self, attr):
         if attr == "_packfile_checksum":
@@ -524,8 +1224,11 @@ class PackFile(LazyMixin):
         self._packpath = packpath
 
     def close(self):
+        """Release our memory map. It is recreated once we are used again"""
         mman.force_map_handle_removal_win(self._packpath)
-        self._cursor = None
+        with suppress(AttributeError):
+            del self._cursor
+        # END handle unused pack
 
     def _set_cache_(self, attr):
         # we fill the whole cache, whichever attribute gets queried first
@@ -656,24 +1359,43 @@ class PackEntity(LazyMixin):
 
     __slots__ = ('_index',           # our index file
                  '_pack',            # our pack file
-                 '_offset_map'       # on demand dict mapping one offset to the next consecutive one
+                 '_offset_map',      # on demand dict mapping one offset to the next consecutive one
+                 '_base_db',         # database to resolve REF_DELTA bases not contained in this pack
+                 '_type_table'       # on demand array with the type id of each object by index position
                  )
 
     IndexFileCls = PackIndexFile
     PackFileCls = PackFile
 
+    # objects of at least this size are compressed and written by separate threads
+    pipeline_threshold = 16 * 1024 * 1024
+
+    # git pack bitmap files
+    bitmap_signature = b'BITM'
+    bitmap_version = 1
+    bitmap_header_size = 32
+    # type ids in the order of the type bitmaps: commits, trees, blobs, tags
+    _bitmap_type_index = (1, 2, 3, 4)
+
     def __init__(self, pack_or_index_path):
         """Initialize ourselves with the path to the respective pack or index file"""
         basename, ext = os.path.splitext(pack_or_index_path)
         self._index = self.IndexFileCls("%s.idx" % basename)            # PackIndexFile instance
         self._pack = self.PackFileCls("%s.pack" % basename)         # corresponding PackFile instance
+        self._base_db = None
 
     def close(self):
+        """Release the memory maps of our index and pack. They are recreated on demand,
+        hence we remain usable"""
         self._index.close()
         self._pack.close()
 
     def _set_cache_(self, attr):
-        # currently this can only be _offset_map
+        if attr == '_type_table':
+            self._type_table = self._compute_type_table()
+            return
+        # END handle type table
+
         # TODO: make this a simple sorted offset array which can be bisected
         # to find the respective entry, from which we can take a +1 easily
         # This might be slower, but should also be much lighter in memory !
@@ -697,6 +1419,87 @@ class PackEntity(LazyMixin):
         # END handle offset amount
         self._offset_map = offset_map
 
+    def _compute_type_table(self):
+        """:return: array with the type id of each object in index order. Deltas are resolved
+            to the type of their base by following their chain of bases, which only requires
+            to read object headers. Objects whose type cannot be determined are 0"""
+        index = self._index
+        pack_info = self._pack.info
+        sha_to_index = index.sha_to_index
+        num_objects = index.size()
+        offset_to_index = {index.offset(i): i for i in range(num_objects)}
+        table = array.array('B', bytes(num_objects))
+
+        for i in range(num_objects):
+            chain = list()
+            j = i
+            while not table[j]:
+                chain.append(j)
+                info = pack_info(index.offset(j))
+                if info.type_id == OFS_DELTA:
+                    j = offset_to_index[info.pack_offset - info.delta_info]
+                elif info.type_id == REF_DELTA:
+                    j = sha_to_index(bytes(info.delta_info))
+                    if j is None:
+                        type_id = self._external_type_id(bytes(info.delta_info))
+                        break
+                    # END handle external base
+                else:
+                    type_id = info.type_id
+                    break
+                # END handle object type
+            else:
+                type_id = table[j]
+            # END follow chain to the first object with known type
+            for j in chain:
+                table[j] = type_id
+            # END for each object in the chain
+        # END for each object
+        return table
+
+    def _external_type_id(self, sha):
+        """:return: type id of the external base object with the given sha, or 0 if it is unknown"""
+        if self._base_db is None:
+            return 0
+        # END handle missing base database
+        try:
+            return type_to_type_id_map[self._base_db.info(sha).type]
+        except BadObject:
+            return 0
+        # END handle missing base
+
+    def _bitmap_type_positions(self, type_id):
+        """:return: iterator yielding the pack positions of all objects of the given type
+            according to our .bitmap file, or None if there is no usable bitmap file"""
+        try:
+            bitmap_index = self._bitmap_type_index.index(type_id)
+        except ValueError:
+            return None
+        # END handle unknown type
+        try:
+            with open(os.path.splitext(self._pack.path())[0] + '.bitmap', 'rb') as fp:
+                data = fp.read(self.bitmap_header_size)
+                if len(data) < self.bitmap_header_size:
+                    return None
+                signature, version = unpack_from(">4sH", data)
+                if (signature != self.bitmap_signature or version != self.bitmap_version or
+                        data[12:32] != self._pack.checksum()):
+                    return None
+                # END ignore unsupported or stale bitmaps
+
+                # the type bitmaps directly follow the header
+                data = fp.read(os.fstat(fp.fileno()).st_size)
+            # END assure file is closed
+        except OSError:
+            return None
+        # END handle missing bitmaps
+
+        offset = 0
+        for _ in range(bitmap_index + 1):
+            bit_size, words, offset = read_ewah_bitmap(data, offset)
+        # END skip bitmaps of other types
+        return ewah_bit_positions(bit_size, words)
+
     def _sha_to_index(self, sha):
         """:return: index for the given sha, or raise"""
         index = self._index.sha_to_index(sha)
@@ -789,6 +1592,16 @@ class PackEntity(LazyMixin):
         """:return: the underlying pack file instance"""
         return self._pack
 
+    def set_base_db(self, db):
+        """Set the database to use for resolving REF_DELTA base objects which are not
+        contained in this pack, as it is the case for packs which were fetched incrementally
+        :param db: ObjectDBR instance, or None to only resolve deltas within this pack"""
+        self._base_db = db
+
+    def base_db(self):
+        """:return: database used to resolve external REF_DELTA bases, or None"""
+        return self._base_db
+
     def index(self):
         """:return: the underlying pack index file instance"""
         return self._index
@@ -843,10 +1656,72 @@ class PackEntity(LazyMixin):
             # write a loose object, which is the basis for the sha
             write_object(stream.type, stream.size, stream.read, shawriter.write)
 
-            assert shawriter.sha(as_hex=False) == sha
             return shawriter.sha(as_hex=False) == sha
         # END handle crc/sha verification
 
+    def type_table(self):
+        """:return: array with the type id of each object in the order of the index, computed
+            from object headers and cached on first access. Deltas have the type of their base.
+            Objects are 0 if their type can not be determined, which is the case for external
+            delta bases without base database"""
+        return self._type_table
+
+    def iter_by_type(self, type):
+        """
+        :return: iterator yielding 20 byte shas of all objects of the given type in this pack,
+            without resolving any delta chains. The type bitmaps of a git pack bitmap file are
+            used if present, our type table otherwise.
+        :param type: type string, like 'blob' or 'tree'"""
+        type_id = type_to_type_id_map[force_bytes(type)]
+        sha = self._index.sha
+
+        positions = self._bitmap_type_positions(type_id)
+        if positions is not None:
+            # bitmaps use the order of objects in the pack
+            index = self._index
+            pack_order = sorted(range(index.size()), key=index.offset)
+            return (sha(pack_order[position]) for position in positions)
+        # END handle bitmaps
+        return (sha(i) for i, tid in enumerate(self._type_table) if tid == type_id)
+
+    def raw_entry(self, sha):
+        """
+        :return: bytes of the compressed entry of the given object as it is stored
+            in the pack, comprised of the pack object header, the delta base information if
+            the object is a delta, and the zlib compressed data
+        :param sha: 20 byte sha1 of the object
+        :raise BadObject: if the object is not contained in this pack"""
+        offset = self._index.offset(self._sha_to_index(sha))
+        size = self._offset_map[offset] - offset
+        # copy the data, a view would keep the shared region from being unmapped
+        buf = self._pack._cursor.use_region(offset, size).buffer()
+        if len(buf) >= size:
+            return bytes(buf[:size])
+        # END handle entry within our mapped window
+
+        # the entry crosses the boundary of our mapped window
+        with open(self._pack.path(), 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(size)
+        # END assure file is closed
+
+    def send_raw_entry(self, sha, out):
+        """Write the compressed entry of the given object, as returned by ``raw_entry``,
+        to the given file or socket without decompressing it, and without copying its data
+        through userspace if the platform allows it.
+
+        :param out: file descriptor, or object with a fileno() method, like a socket
+        :return: amount of bytes written
+        :raise BadObject: if the object is not contained in this pack"""
+        offset = self._index.offset(self._sha_to_index(sha))
+        size = self._offset_map[offset] - offset
+        fd = os.open(self._pack.path(), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            return copy_file_range_to(fd, offset, size, out)
+        finally:
+            os.close(fd)
+        # END assure file is closed
+
     def info_iter(self):
         """
         :return: Iterator over all objects in this pack. The iterator yields
@@ -864,6 +1739,9 @@ class PackEntity(LazyMixin):
         As the version in the PackFile, but can resolve REF deltas within this pack
         For more info, see ``collect_streams``
 
+        If a base database was set, REF deltas whose base is not contained in this pack
+        are resolved through it. The last stream is the base's OStream in that case
+
         :param offset: offset into the pack file at which the object can be found"""
         streams = self._pack.collect_streams(offset)
 
@@ -879,6 +1757,11 @@ class PackEntity(LazyMixin):
                     else:
                         sindex = self._index.sha_to_index(stream.delta_info)
                     if sindex is None:
+                        if self._base_db is not None:
+                            with suppress(BadObject):
+                                streams.append(self._base_db.stream(bytes(stream.delta_info)))
+                            # END ignore missing bases
+                        # END resolve base externally
                         break
                     stream = self._pack.stream(self._index.offset(sindex))
                     streams.append(stream)
@@ -910,7 +1793,8 @@ class PackEntity(LazyMixin):
 
     @classmethod
     def write_pack(cls, object_iter, pack_write, index_write=None,
-                   object_count=None, zlib_compression=zlib.Z_BEST_SPEED):
+                   object_count=None, zlib_compression=zlib.Z_BEST_SPEED, compression=None,
+                   thin_bases=None, base_db=None, order=None):
         """
         Create a new pack by putting all objects obtained by the object_iterator
         into a pack which is written using the pack_write method.
@@ -924,14 +1808,36 @@ class PackEntity(LazyMixin):
             this would be the place to put it. Otherwise we have to pre-iterate and store
             all items into a list to get the number, which uses more memory than necessary.
         :param zlib_compression: the zlib compression level to use
+        :param compression: if not None, an AdaptiveCompression instance which decides
+            on the compression level per object. zlib_compression is ignored in that case
+        :param thin_bases: if not None, a dict mapping binshas of objects to write to the
+            binsha of an object the receiver of the pack is known to have. These objects
+            are written as REF_DELTA against their base, if the delta is smaller than the
+            object itself, producing a thin pack
+        :param base_db: database providing the base objects of thin_bases
+        :param order: if not None, a function(objects, thin_bases) returning the list of
+            objects in the order in which to write them, like ``order_by_type``,
+            ``order_bases_first`` or ``AccessLog.order``. All objects are kept in memory then
         :return: tuple(pack_sha, index_binsha) binary sha over all the contents of the pack
             and over all contents of the index. If index_write was None, index_binsha will be None
 
         **Note:** The destination of the write functions is up to the user. It could
         be a socket, or a file for instance
 
-        **Note:** writes only undeltified objects"""
+        **Note:** writes only undeltified objects, unless thin_bases are given
+
+        **Note:** the compressed data of objects whose stream is a ``ZippedContentReader``
+        is written as it is, regardless of the compression settings"""
         objs = object_iter
+        if order is not None:
+            if object_count:
+                objs = list(islice(object_iter, object_count))
+            else:
+                objs = list(object_iter)
+            # END handle object count
+            objs = order(objs, thin_bases)
+            object_count = len(objs)
+        # END handle ordering
         if not object_count:
             if not isinstance(object_iter, (tuple, list)):
                 objs = list(object_iter)
@@ -958,8 +1864,23 @@ class PackEntity(LazyMixin):
             actual_count += 1
             crc = 0
 
+            type_id, size, read = obj.type_id, obj.size, obj.stream.read
+            base_sha = thin_bases.get(obj.binsha) if thin_bases else None
+            if base_sha is not None:
+                data = read()
+                delta = create_delta(base_db.stream(base_sha).read(), data)
+                if len(delta) < len(data):
+                    type_id, size, read = REF_DELTA, len(delta), BytesIO(delta).read
+                else:
+                    read = BytesIO(data).read
+                # END use delta only if it is smaller
+            # END handle thin delta
+
             # object header
-            hdr = create_pack_object_header(obj.type_id, obj.size)
+            hdr = create_pack_object_header(type_id, size)
+            if type_id == REF_DELTA:
+                hdr += base_sha
+            # END handle delta base
             if index_write:
                 crc = crc32(hdr)
             else:
@@ -968,10 +1889,33 @@ class PackEntity(LazyMixin):
             pwrite(hdr)
 
             # data stream
-            zstream = zlib.compressobj(zlib_compression)
-            ostream = obj.stream
-            br, bw, crc = write_stream_to_pack(ostream.read, pwrite, zstream, base_crc=crc)
-            assert(br == obj.size)
+            if base_sha is None and isinstance(obj.stream, ZippedContentReader):
+                # the stream provides the data exactly as we would write it
+                zdata = obj.stream.zipped_content()
+                pwrite(zdata)
+                br, bw = size, len(zdata)
+                if crc is not None:
+                    crc = crc32(zdata, crc)
+                # END handle crc
+            else:
+                if compression is None:
+                    zstream = zlib.compressobj(zlib_compression)
+                else:
+                    zstream = compression.compressobj(obj.type, size)
+                # END handle compression policy
+                if size >= cls.pipeline_threshold:
+                    writer = PipelinedCompressedSha1Writer(pwrite, zstream, hash=False, base_crc=crc)
+                    try:
+                        br = stream_copy(read, writer.write, size, chunk_size)
+                    finally:
+                        writer.close()
+                    # END assure all stages are finished
+                    bw, crc = writer.bytes_written(), writer.crc()
+                else:
+                    br, bw, crc = write_stream_to_pack(read, pwrite, zstream, base_crc=crc)
+                # END handle large objects
+            # END handle precompressed content
+            assert(br == size)
             if wants_index:
                 index.append(obj.binsha, crc, ofs)
             # END handle index
@@ -1001,7 +1945,82 @@ class PackEntity(LazyMixin):
         return pack_sha, index_sha
 
     @classmethod
-    def create(cls, object_iter, base_dir, object_count=None, zlib_compression=zlib.Z_BEST_SPEED):
+    def index_pack(cls, pack_path, workers=1, progress=None, write_rev=False, base_db=None):
+        """Create the index file for the given pack, similar to what git index-pack does.
+
+        All entries of the pack are scanned once to obtain their offsets and crc's, as
+        well as the sha's of all base objects. Afterwards all deltas are resolved
+        in dependency order, starting at their base objects. As the delta trees of
+        different bases are independent, they can be resolved in parallel processes.
+
+        :param pack_path: path to the pack file to index. The index is written next to it,
+            using the same basename
+        :param workers: amount of processes to use when resolving deltas. If 1, all
+            work is done in the calling process
+        :param progress: if not None, a function called with (num_objects_done, num_objects)
+            as the sha's of the pack's objects are determined
+        :param write_rev: if True, a reverse index (.rev) is written as well
+        :param base_db: if not None, the pack may be a thin pack. Base objects of its REF_DELTAs
+            which are not contained in it are retrieved from base_db and appended to the pack,
+            making it self-contained. The completed pack replaces the original one, and is
+            named after its new checksum
+        :return: PackEntity instance initialized with the pack and its new index
+        :raise ParseError: if the pack is corrupted or contains deltas whose base
+            objects are not contained in it"""
+        scan = scan_pack_file(cls.PackFileCls(pack_path), progress)
+        new_pack_path, pack_sha, index = index_pack_objects(pack_path, *scan, workers=workers,
+                                                            progress=progress, base_db=base_db)
+        if new_pack_path != pack_path:
+            # the pack was completed, name it after its new checksum
+            pack_path = os.path.join(os.path.dirname(pack_path),
+                                     "pack-%s.pack" % bin_to_hex(pack_sha).decode('ascii'))
+        # END handle completed thin pack
+        write_index_files(os.path.splitext(pack_path)[0], pack_sha, index, write_rev)
+        if new_pack_path != pack_path:
+            os.replace(new_pack_path, pack_path)
+        # END move completed pack into place
+        return cls(pack_path)
+
+    @classmethod
+    def create_from_stream(cls, read, base_dir, workers=1, progress=None, write_rev=False, base_db=None):
+        """Create a new on-disk entity from a pack read from a stream, which may be
+        non-seekable like a socket or pipe.
+
+        The pack is written to a temporary file while its entries are parsed, so that
+        only its deltas have to be resolved once the stream ended. Afterwards the pack and its
+        index are moved into place with their proper names, the index first.
+
+        :param read: read function of the stream, see ``PackStreamScanner``
+        :param base_dir: directory which is to contain the files
+        :return: PackEntity instance initialized with the new pack
+        :raise ParseError: if the pack could not be parsed
+
+        **Note:** for more information on the other parameters see the index_pack method"""
+        pack_fd, pack_path = tempfile.mkstemp('', 'tmp_pack_', base_dir)
+        try:
+            try:
+                scan = PackStreamScanner(read, lambda d: os.write(pack_fd, d)).scan()
+            finally:
+                os.close(pack_fd)
+            # END assure pack is closed
+            pack_path, pack_sha, index = index_pack_objects(pack_path, *scan, workers=workers,
+                                                            progress=progress, base_db=base_db)
+        except:
+            if os.path.exists(pack_path):
+                os.remove(pack_path)
+            # END handle pack removal
+            raise
+        # END remove incomplete pack on error
+
+        basename = os.path.join(base_dir, "pack-%s" % bin_to_hex(pack_sha).decode('ascii'))
+        write_index_files(basename, pack_sha, index, write_rev)
+        os.replace(pack_path, basename + '.pack')
+
+        return cls(basename + '.pack')
+
+    @classmethod
+    def create(cls, object_iter, base_dir, object_count=None, zlib_compression=zlib.Z_BEST_SPEED,
+               compression=None, thin_bases=None, base_db=None, order=None):
         """Create a new on-disk entity comprised of a properly named pack file and a properly named
         and corresponding index file. The pack contains all OStream objects contained in object iter.
         :param base_dir: directory which is to contain the files
@@ -1013,13 +2032,15 @@ class PackEntity(LazyMixin):
         pack_write = lambda d: os.write(pack_fd, d)
         index_write = lambda d: os.write(index_fd, d)
 
-        pack_binsha, index_binsha = cls.write_pack(object_iter, pack_write, index_write, object_count, zlib_compression)
+        pack_binsha, index_binsha = cls.write_pack(object_iter, pack_write, index_write, object_count,
+                                                   zlib_compression, compression, thin_bases, base_db,
+                                                   order)
         os.close(pack_fd)
         os.close(index_fd)
 
         fmt = "pack-%s.%s"
-        new_pack_path = os.path.join(base_dir, fmt % (bin_to_hex(pack_binsha), 'pack'))
-        new_index_path = os.path.join(base_dir, fmt % (bin_to_hex(pack_binsha), 'idx'))
+        new_pack_path = os.path.join(base_dir, fmt % (bin_to_hex(pack_binsha).decode('ascii'), 'pack'))
+        new_index_path = os.path.join(base_dir, fmt % (bin_to_hex(pack_binsha).decode('ascii'), 'idx'))
         os.rename(pack_path, new_pack_path)
         os.rename(index_path, new_index_path)
 
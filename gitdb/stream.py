@@ -3,7 +3,10 @@
 # This module is part of GitDB and is released under
 # the New BSD License: https://opensource.org/license/bsd-3-clause/
 
+from binascii import crc32
 from io import BytesIO
+from queue import Queue
+from threading import Thread
 
 import mmap
 import os
@@ -36,9 +39,135 @@ try:
 except ImportError:
     pass
 
-__all__ = ('DecompressMemMapReader', 'FDCompressedSha1Writer', 'DeltaApplyReader',
+__all__ = ('DecompressMemMapReader', 'ZippedContentReader', 'FDCompressedSha1Writer', 'DeltaApplyReader',
            'Sha1Writer', 'FlexibleSha1Writer', 'ZippedStoreShaWriter', 'FDCompressedSha1Writer',
-           'FDStream', 'NullStream')
+           'FDStream', 'NullStream', 'AdaptiveCompression', 'PipelinedCompressedSha1Writer',
+           'FDPipelinedCompressedSha1Writer')
+
+
+#{ Compression
+
+class AdaptiveCompression:
+
+    """A compression policy which decides per object which zlib level to use.
+
+    The first bytes of each object are sampled - if they do not compress well, the
+    object is most likely compressed already ( images, archives ) and will be stored
+    using ``zlib.Z_NO_COMPRESSION``, which still produces a valid zlib stream but
+    saves the CPU time spent on deflating it.
+
+    Instances keep counters about their decisions, which allow to judge the amount
+    of work that was saved:
+
+    * num_compressed, bytes_compressed - objects ( and their uncompressed bytes ) which were deflated
+    * num_stored, bytes_stored - objects ( and their bytes ) stored without compression
+
+    **Note:** counters are updated without locking, they may be slightly off if
+        the policy is shared between threads"""
+    __slots__ = ('level', 'min_ratio', 'sample_size', 'min_size', 'type_levels',
+                 'num_compressed', 'bytes_compressed', 'num_stored', 'bytes_stored')
+
+    def __init__(self, level=zlib.Z_BEST_SPEED, min_ratio=0.9, sample_size=64 * 1024,
+                 min_size=1024, type_levels=None):
+        """
+        :param level: zlib level to use for objects which compress well
+        :param min_ratio: if the compressed sample is at least min_ratio times as large
+            as the sample itself, the object will not be compressed
+        :param sample_size: amount of bytes to sample at the beginning of each object
+        :param min_size: objects smaller than this are always compressed with level,
+            as sampling them would cost more than it saves
+        :param type_levels: optional dict mapping type strings, like b'blob', to the zlib
+            level to use for them. Types not in the dict use level and will be sampled"""
+        self.level = level
+        self.min_ratio = min_ratio
+        self.sample_size = sample_size
+        self.min_size = min_size
+        self.type_levels = type_levels or dict()
+        self.num_compressed = self.bytes_compressed = 0
+        self.num_stored = self.bytes_stored = 0
+
+    def compression_level(self, type, size, sample):
+        """:return: zlib compression level to use for an object of the given type and size
+        :param type: type string of the object, or None if unknown
+        :param size: uncompressed size of the object in bytes
+        :param sample: the first bytes of the object's data"""
+        level = self.type_levels.get(type)
+        if level is None:
+            level = self.level
+            if size >= self.min_size and sample:
+                sample = sample[:self.sample_size]
+                if len(zlib.compress(sample, zlib.Z_BEST_SPEED)) >= len(sample) * self.min_ratio:
+                    level = zlib.Z_NO_COMPRESSION
+                # END handle incompressible sample
+            # END sample large objects
+        # END handle type specific level
+
+        if level == zlib.Z_NO_COMPRESSION:
+            self.num_stored += 1
+            self.bytes_stored += size
+        else:
+            self.num_compressed += 1
+            self.bytes_compressed += size
+        # END count decision
+        return level
+
+    def compressobj(self, type=None, size=None):
+        """:return: object compatible to the one returned by zlib.compressobj, which
+            determines its compression level once it has seen enough of the data.
+        :param type: type string of the object to compress
+        :param size: uncompressed size of the object. If type and size are None, the data
+            is expected to start with a loose object header which provides them"""
+        return _SampledCompressor(self, type, size)
+
+
+class _SampledCompressor:
+
+    """Buffers data until the compression policy could take a sample, and compresses
+    everything with the chosen level afterwards"""
+    __slots__ = ('_policy', '_type', '_size', '_buf', '_buflen', '_zip')
+
+    def __init__(self, policy, type, size):
+        self._policy = policy
+        self._type = type
+        self._size = size
+        self._buf = list()
+        self._buflen = 0
+        self._zip = None
+
+    def _init_zip(self):
+        sample = b''.join(self._buf)
+        self._buf = None
+        typ, size, data = self._type, self._size, sample
+        if size is None:
+            hdrend = sample.find(NULL_BYTE)
+            try:
+                typ, size = sample[:hdrend].split(BYTE_SPACE)
+                size = int(size)
+                data = sample[hdrend + 1:]
+            except ValueError:
+                typ, size = None, len(sample)
+            # END handle unparsable header
+        # END parse loose object header
+        self._zip = zlib.compressobj(self._policy.compression_level(typ, size, data))
+        return self._zip.compress(sample)
+
+    def compress(self, data):
+        if self._zip is not None:
+            return self._zip.compress(data)
+        # END handle initialized compressor
+
+        self._buf.append(data)
+        self._buflen += len(data)
+        if self._buflen < self._policy.sample_size:
+            return b''
+        return self._init_zip()
+
+    def flush(self):
+        if self._zip is None:
+            return self._init_zip() + self._zip.flush()
+        return self._zip.flush()
+
+#} END compression
 
 
 #{ RO Streams
@@ -319,6 +448,23 @@ class DecompressMemMapReader(LazyMixin):
         return dcompdat
 
 
+class ZippedContentReader(DecompressMemMapReader):
+
+    """Reads a complete zlib stream of object content, without an object header.
+    As the compressed data is exactly what packs store for the object, pack writers copy
+    it as it is instead of compressing the content once again"""
+    __slots__ = tuple()
+
+    def __init__(self, zdata, size):
+        """:param zdata: zlib stream of the object content
+        :param size: size of the uncompressed content"""
+        super().__init__(zdata, False, size)
+
+    def zipped_content(self):
+        """:return: the zlib stream of the object content we are reading from"""
+        return self._m
+
+
 class DeltaApplyReader(LazyMixin):
 
     """A reader which dynamically applies pack deltas to a base object, keeping the
@@ -607,10 +753,16 @@ class ZippedStoreShaWriter(Sha1Writer):
     """Remembers everything someone writes to it and generates a sha"""
     __slots__ = ('buf', 'zip')
 
-    def __init__(self):
+    def __init__(self, compression=None):
+        """:param compression: if not None, an AdaptiveCompression instance deciding
+            on the compression level to use"""
         Sha1Writer.__init__(self)
         self.buf = BytesIO()
-        self.zip = zlib.compressobj(zlib.Z_BEST_SPEED)
+        if compression is None:
+            self.zip = zlib.compressobj(zlib.Z_BEST_SPEED)
+        else:
+            self.zip = compression.compressobj()
+        # END handle compression policy
 
     def __getattr__(self, attr):
         return getattr(self.buf, attr)
@@ -649,10 +801,16 @@ class FDCompressedSha1Writer(Sha1Writer):
     # default exception
     exc = IOError("Failed to write all bytes to filedescriptor")
 
-    def __init__(self, fd):
+    def __init__(self, fd, compression=None):
+        """:param compression: if not None, an AdaptiveCompression instance deciding
+            on the compression level to use"""
         super().__init__()
         self.fd = fd
-        self.zip = zlib.compressobj(zlib.Z_BEST_SPEED)
+        if compression is None:
+            self.zip = zlib.compressobj(zlib.Z_BEST_SPEED)
+        else:
+            self.zip = compression.compressobj()
+        # END handle compression policy
 
     #{ Stream Interface
 
@@ -677,6 +835,166 @@ class FDCompressedSha1Writer(Sha1Writer):
     #} END stream interface
 
 
+class PipelinedCompressedSha1Writer(Sha1Writer):
+
+    """Digests data written to it, compresses it and passes the compressed data on to a
+    write function, like FDCompressedSha1Writer does. Hashing, compression and writing
+    are run by separate threads connected through bounded queues though, allowing to use
+    multiple cores and to overlap I/O with computation, as all stages release the GIL.
+
+    This pays off for large objects only, as passing chunks between threads has a cost.
+
+    **Note:** data is only fully written, and the sha available, once close() was called.
+    Errors of any stage are raised by the next call to write() or close()"""
+    __slots__ = ('zip', '_write', '_crc', '_bw', '_error', '_hash_queue', '_zip_queue',
+                 '_write_queue', '_threads')
+
+    def __init__(self, write, zstream=None, queue_size=8, hash=True, base_crc=None):
+        """:param write: function receiving the compressed data. It must write all bytes
+            or raise
+        :param zstream: compressobj compatible instance to use, defaults to a zlib compressor
+            using the fastest compression level
+        :param queue_size: maximum amount of chunks waiting in front of each stage
+        :param hash: if False, no sha is computed
+        :param base_crc: if not None, the crc32 of the written compressed data is computed,
+            starting at the given value, see ``crc``"""
+        super().__init__()
+        self.zip = zstream or zlib.compressobj(zlib.Z_BEST_SPEED)
+        self._write = write
+        self._crc = base_crc
+        self._bw = 0
+        self._error = None
+        self._hash_queue = hash and Queue(queue_size) or None
+        self._zip_queue = Queue(queue_size)
+        self._write_queue = Queue(queue_size)
+
+        stages = [self._zip_stage, self._write_stage]
+        if hash:
+            stages.append(self._hash_stage)
+        # END handle hashing
+        self._threads = [Thread(target=stage, daemon=True) for stage in stages]
+        for thread in self._threads:
+            thread.start()
+        # END for each stage
+
+    #{ Stages
+
+    def _drain(self, queue):
+        """Consume the given queue up to its end, to unblock the producer after an error"""
+        for _ in iter(queue.get, None):
+            pass
+        # END for each item
+
+    def _hash_stage(self):
+        update = self.sha1.update
+        for data in iter(self._hash_queue.get, None):
+            update(data)
+        # END for each chunk
+
+    def _zip_stage(self):
+        put = self._write_queue.put
+        try:
+            compress = self.zip.compress
+            for data in iter(self._zip_queue.get, None):
+                cdata = compress(data)
+                if cdata:
+                    put(cdata)
+                # END skip empty output
+            # END for each chunk
+            put(self.zip.flush())
+        except BaseException as e:
+            self._error = e
+            self._drain(self._zip_queue)
+        finally:
+            put(None)
+        # END assure the write stage ends
+
+    def _write_stage(self):
+        write = self._write
+        try:
+            for cdata in iter(self._write_queue.get, None):
+                write(cdata)
+                self._bw += len(cdata)
+                if self._crc is not None:
+                    self._crc = crc32(cdata, self._crc)
+                # END handle crc
+            # END for each chunk
+        except BaseException as e:
+            self._error = e
+            self._drain(self._write_queue)
+        # END handle errors
+
+    #} END stages
+
+    #{ Stream Interface
+
+    def write(self, data):
+        """:raise IOError: If not all bytes could be written
+        :return: length of incoming data"""
+        if self._error is not None:
+            raise self._error
+        # END handle errors of previous chunks
+        data = bytes(data)
+        if self._hash_queue is not None:
+            self._hash_queue.put(data)
+        # END handle hashing
+        self._zip_queue.put(data)
+        return len(data)
+
+    def close(self):
+        """Flush all pending data and wait for all stages to finish
+        :raise IOError: if any stage failed"""
+        if self._hash_queue is not None:
+            self._hash_queue.put(None)
+        # END handle hashing
+        self._zip_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        # END for each stage
+        if self._error is not None:
+            raise self._error
+        # END handle errors
+
+    #} END stream interface
+
+    #{ Interface
+
+    def bytes_written(self):
+        """:return: amount of compressed bytes written so far"""
+        return self._bw
+
+    def crc(self):
+        """:return: crc32 of all written compressed data, or None if it wasn't requested"""
+        return self._crc
+
+    #} END interface
+
+
+class FDPipelinedCompressedSha1Writer(PipelinedCompressedSha1Writer):
+
+    """As FDCompressedSha1Writer, but running hashing, compression and writing concurrently.
+    See ``PipelinedCompressedSha1Writer``"""
+    __slots__ = 'fd'
+
+    def __init__(self, fd, compression=None):
+        """:param compression: if not None, an AdaptiveCompression instance deciding
+            on the compression level to use"""
+        self.fd = fd
+        super().__init__(self._write_all, compression and compression.compressobj())
+
+    def _write_all(self, data):
+        if write(self.fd, data) != len(data):
+            raise FDCompressedSha1Writer.exc
+        # END handle partial writes
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            close(self.fd)
+        # END assure file is closed
+
+
 class FDStream:
 
     """A simple wrapper providing the most basic functions on a file descriptor
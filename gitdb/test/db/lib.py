@@ -21,15 +21,37 @@ from gitdb.base import (
     OInfo
 )
 
+from gitdb.db import (
+    CompoundDB,
+    PackedDB
+)
 from gitdb.exc import BadObject
 from gitdb.typ import str_blob_type
+from gitdb.util import release_unused_maps
 
 from io import BytesIO
 
 from struct import pack
 
 
-__all__ = ('TestDBBase', 'with_rw_directory', 'with_packs_rw', 'fixture_path')
+__all__ = ('TestDBBase', 'with_rw_directory', 'with_packs_rw', 'fixture_path', 'close_databases')
+
+
+def close_databases(*dbs):
+    """Close the pack entities of the given databases and all of their sub-databases,
+    and unmap all regions which aren't used anymore, releasing their file handles"""
+    dbs = list(dbs)
+    while dbs:
+        db = dbs.pop()
+        if isinstance(db, PackedDB):
+            for entity in db.entities():
+                entity.close()
+            # END for each entity
+        elif isinstance(db, CompoundDB):
+            dbs.extend(db.databases())
+        # END handle database type
+    # END for each database
+    release_unused_maps()
 
 
 class TestDBBase(TestBase):
@@ -2,15 +2,34 @@
 #
 # This module is part of GitDB and is released under
 # the New BSD License: https://opensource.org/license/bsd-3-clause/
+import glob
 import os
+import shutil
 from gitdb.test.db.lib import (
     TestDBBase,
-    with_rw_directory
+    with_rw_directory,
+    close_databases
 )
 from gitdb.exc import BadObject
-from gitdb.db import GitDB
-from gitdb.base import OStream, OInfo
-from gitdb.util import bin_to_hex
+from gitdb.db import GitDB, MemoryDB, PackedDB
+from gitdb.pack import PackEntity
+from gitdb.base import IStream, OStream, OInfo
+from gitdb.typ import (
+    str_blob_type,
+    str_commit_type,
+    str_tag_type,
+    str_tree_type
+)
+from gitdb.util import (
+    bin_to_hex,
+    hex_to_bin
+)
+from gitdb.test.lib import (
+    fixture_path,
+    make_bytes
+)
+
+from io import BytesIO
 
 
 class TestGitDB(TestDBBase):
@@ -51,3 +70,383 @@ class TestGitDB(TestDBBase):
 
         # its possible to write objects
         self._assert_object_writing(gdb)
+
+    @with_rw_directory
+    def test_bulk_store(self, path):
+        gdb = GitDB(path)
+        try:
+            shas = list()
+            with gdb.bulk_store() as bulk_db:
+                for i in range(100):
+                    data = b"%i" % i
+                    shas.append(bulk_db.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha)
+                    # readable right away
+                    assert gdb.stream(shas[-1]).read() == data
+                # END for each object
+            # END bulk store
+
+            # one pack, no loose objects
+            assert len(os.listdir(os.path.join(path, gdb.packs_dir))) == 2
+            assert gdb.size() == len(shas)
+            for sha in shas:
+                assert gdb.info(sha).type == str_blob_type
+            # END for each sha
+
+            # nothing is remembered about the temporary writer databases
+            for i in range(5):
+                with gdb.bulk_store() as bulk_db:
+                    data = b"bulk %i" % i
+                    sha = bulk_db.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+                    assert gdb.has_object(sha)
+                # END bulk store
+            # END for each bulk store
+            dbs = set(gdb.databases()) | {None}
+            assert set(gdb._db_stats) <= dbs and set(gdb._db_generations) <= dbs
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_iter_by_type(self, path):
+        gdb = GitDB(path)
+        try:
+            pack_dir = os.path.join(path, gdb.packs_dir)
+            os.makedirs(pack_dir)
+            data = b"loose blob"
+            blob_sha = gdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+            data = b"loose tag"
+            tag_sha = gdb.store(IStream(str_tag_type, len(data), BytesIO(data))).binsha
+            basename = fixture_path('packs/pack-59b44293cdd018665701a901eb7ebd68a554ad99')
+            for ext in ('.pack', '.idx', '.bitmap'):
+                shutil.copy(basename + ext, pack_dir)
+            # END for each file
+            gdb.update_cache(force=True)
+
+            blobs = list(gdb.iter_by_type(str_blob_type))
+            assert len(blobs) == 7 and blob_sha in blobs
+            assert set(gdb.iter_by_type('tag')) == {tag_sha, hex_to_bin('ef3f929ece0783aa59874f4b0362166aeb4fc50c')}
+            assert len(list(gdb.iter_by_type(str_commit_type))) == 3
+            assert sum(len(list(gdb.iter_by_type(type))) for type in (str_tree_type, str_commit_type)) == 9
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_dedupe_store(self, path):
+        gdb = GitDB(path, dedupe=True)
+        try:
+            gdb.dedupe_spool_size = 10
+            pack_dir = os.path.join(path, gdb.packs_dir)
+            os.makedirs(pack_dir)
+            basename = fixture_path('packs/pack-59b44293cdd018665701a901eb7ebd68a554ad99')
+            for ext in ('.pack', '.idx'):
+                shutil.copy(basename + ext, pack_dir)
+            # END for each file
+            gdb.update_cache(force=True)
+
+            # objects in packs and loose objects are not written again
+            # streams of packed objects keep their pack mapped, don't hold on to them
+            packed = [(sha, gdb.stream(sha).read()) for sha in gdb.iter_by_type(str_blob_type)]
+            datas = [data for _, data in packed] + [b"new", b"new object of some size"] * 2
+            istreams = [gdb.store(IStream(str_blob_type, len(data), BytesIO(data))) for data in datas]
+            assert [istream.binsha for istream in istreams[:len(packed)]] == [sha for sha, _ in packed]
+            assert len(list(gdb._loose_db.sha_iter())) == 2
+            num_skipped, bytes_skipped = gdb.skipped()
+            assert num_skipped == len(packed) + 2
+            assert bytes_skipped == sum(len(data) for data in datas[:len(packed) + 2])
+            for istream, data in zip(istreams, datas):
+                assert gdb.stream(istream.binsha).read() == data
+            # END for each object
+
+            # precompressed streams are checked by their sha
+            loose_sha = istreams[-1].binsha
+            raw = bytes(gdb._loose_db.raw_object(loose_sha))
+            gdb.store(IStream(str_blob_type, len(raw), BytesIO(raw), loose_sha))
+            assert gdb.skipped()[0] == num_skipped + 1
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_external_delta_bases(self, path):
+        gdb = GitDB(path)
+        try:
+            mdb = MemoryDB()
+            thin_bases = dict()
+            for i in range(4):
+                base = make_bytes(5000 + i, randomize=True)
+                data = base + b"changed %i" % i
+                base_sha = mdb.store(IStream(str_blob_type, len(base), BytesIO(base))).binsha
+                thin_bases[mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha] = base_sha
+            # END for each object pair
+            base_shas = list(thin_bases.values())
+
+            # two bases go into another pack, two are loose
+            pack_dir = os.path.join(path, gdb.packs_dir)
+            os.makedirs(pack_dir)
+            PackEntity.create((mdb.stream(sha) for sha in base_shas[:2]), pack_dir).close()
+            for sha in base_shas[2:]:
+                gdb.store(IStream(str_blob_type, mdb.info(sha).size, mdb.stream(sha)))
+            # END for each loose base
+            PackEntity.create((mdb.stream(sha) for sha in thin_bases), pack_dir,
+                              thin_bases=thin_bases, base_db=mdb).close()
+            gdb.update_cache(force=True)
+
+            for sha in thin_bases:
+                assert gdb.info(sha).size == mdb.info(sha).size
+                assert gdb.stream(sha).read() == mdb.stream(sha).read()
+            # END for each delta
+
+            # on its own, the pack database only resolves bases in its other packs
+            pdb = PackedDB(pack_dir)
+            try:
+                delta_shas = list(thin_bases)
+                assert pdb.stream(delta_shas[0]).read() == mdb.stream(delta_shas[0]).read()
+                self.assertRaises(BadObject, pdb.info, delta_shas[-1])
+            finally:
+                close_databases(pdb)
+            # END assure packs are closed
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_external_delta_bases_lifetime(self, path):
+        gdb = GitDB(path)
+        mdb = MemoryDB()
+        pack_dir = os.path.join(path, gdb.packs_dir)
+        os.makedirs(pack_dir)
+        datas = list()
+        thin_bases = dict()
+        for i in range(2):
+            base = make_bytes(5000, randomize=True)
+            data = base + b"changed %i" % i
+            base_sha = mdb.store(IStream(str_blob_type, len(base), BytesIO(base))).binsha
+            delta_sha = mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+            thin_bases[delta_sha] = base_sha
+            datas.append((delta_sha, data))
+        # END for each delta
+        (packed_sha, packed_data), (loose_sha, loose_data) = datas
+        PackEntity.create([mdb.stream(thin_bases[packed_sha])], pack_dir).close()
+        base = mdb.stream(thin_bases[loose_sha]).read()
+        gdb.store(IStream(str_blob_type, len(base), BytesIO(base)))
+        PackEntity.create([mdb.stream(sha) for sha, _ in datas], pack_dir,
+                          thin_bases=thin_bases, base_db=mdb).close()
+        gdb.update_cache(force=True)
+        pdb = gdb._pack_db()
+        try:
+            assert pdb.stream(packed_sha).read() == packed_data
+            assert pdb.stream(loose_sha).read() == loose_data
+
+            # once the owner is gone, only our own packs are searched for bases
+            del gdb
+            assert pdb.stream(packed_sha).read() == packed_data
+            assert pdb.info(packed_sha).size == len(packed_data)
+            self.assertRaises(ValueError, pdb.stream, loose_sha)
+        finally:
+            close_databases(pdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_pack_maintenance(self, path):
+        gdb = GitDB(path)
+        try:
+            shas = list()
+            for i in range(30):
+                data = b"loose %i" % i
+                shas.append(gdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha)
+            # END for each object
+
+            assert gdb.pack_loose_objects(min_count=31) == 0
+            assert gdb.pack_loose_objects(min_count=10, max_count=10) == len(shas)
+            pack_dir = os.path.join(path, gdb.packs_dir)
+            assert len(glob.glob(os.path.join(pack_dir, '*.pack'))) == 3
+            assert not list(gdb._loose_db.sha_iter())
+            assert gdb.size() == len(shas)
+
+            # a pack with bases, and one with deltas against them
+            mdb = MemoryDB()
+            bases = dict()
+            for i in range(3):
+                base = make_bytes(5000, randomize=True)
+                data = base + b"changed"
+                base_sha = mdb.store(IStream(str_blob_type, len(base), BytesIO(base))).binsha
+                bases[mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha] = base_sha
+            # END for each object pair
+            delta_shas = list(bases) + list(bases.values())
+            PackEntity.create((mdb.stream(sha) for sha in bases.values()), pack_dir).close()
+            PackEntity.create((mdb.stream(sha) for sha in bases), pack_dir,
+                              thin_bases=bases, base_db=mdb).close()
+            gdb.update_cache(force=True)
+
+            # sizes 3, 3, 10, 10, 10 - all get merged
+            assert gdb.merge_packs() == 5
+            assert gdb.merge_packs() == 0
+            pack_paths = glob.glob(os.path.join(pack_dir, '*.pack'))
+            assert len(pack_paths) == 1
+            assert os.path.getsize(pack_paths[0]) < 3 * 5000 * 2
+            for sha in shas + delta_shas:
+                assert gdb.stream(sha).read() == (mdb.stream(sha).read() if sha in delta_shas else
+                                                   b"loose %i" % shas.index(sha))
+            # END for each object
+
+            # a large pack isn't merged with a small one
+            data = b"new"
+            sha = gdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+            gdb.maintain(min_count=1, background=True).join()
+            assert len(glob.glob(os.path.join(pack_dir, '*.pack'))) == 2
+            assert gdb.stream(sha).read() == data
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_merge_packs_verification(self, path):
+        gdb = GitDB(path)
+        try:
+            # a pack with bases and deltas against them, and one with unrelated objects
+            mdb = MemoryDB()
+            bases = dict()
+            for i in range(3):
+                base = make_bytes(5000, randomize=True)
+                data = base + b"changed"
+                base_sha = mdb.store(IStream(str_blob_type, len(base), BytesIO(base))).binsha
+                bases[mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha] = base_sha
+            # END for each object pair
+            shas = list(bases.values()) + list(bases)
+            pack_dir = os.path.join(path, gdb.packs_dir)
+            os.makedirs(pack_dir)
+            PackEntity.create((mdb.stream(sha) for sha in shas), pack_dir, thin_bases=bases,
+                              base_db=mdb).close()
+            for i in range(3):
+                data = b"object %i" % i
+                shas.append(gdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha)
+            # END for each object
+            assert gdb.pack_loose_objects(min_count=1) == 3
+            pack_paths = sorted(glob.glob(os.path.join(pack_dir, '*')))
+
+            # deltas computed against shifted bases pass the CRC check, as the CRC is computed
+            # from the data we wrote, but not the sha check
+            stream = gdb.stream
+
+            def corrupted_stream(sha):
+                ostream = stream(sha)
+                if sha not in bases.values():
+                    return ostream
+                data = b"\0" + ostream.read()
+                return OStream(sha, ostream.type, len(data), BytesIO(data))
+            # END corrupted stream
+
+            gdb.stream = corrupted_stream
+            self.assertRaises(ValueError, gdb.merge_packs, factor=4)
+            del gdb.stream
+            assert sorted(glob.glob(os.path.join(pack_dir, '*'))) == pack_paths
+            for sha in shas:
+                assert gdb.stream(sha).read() == (mdb.stream(sha).read() if mdb.has_object(sha) else
+                                                   b"object %i" % (shas.index(sha) - 6))
+            # END for each object
+
+            assert gdb.merge_packs(factor=4) == 2
+            assert all(gdb.has_object(sha) for sha in shas)
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_merge_packs_without_deltas(self, path):
+        gdb = GitDB(path)
+        try:
+            shas = list()
+            for count in (1, 3, 7):
+                batch = list()
+                for i in range(count):
+                    data = b"object %i %i" % (count, i)
+                    batch.append(gdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha)
+                # END for each object
+                shas.extend(batch)
+                assert gdb.pack_loose_objects(min_count=1) == count
+            # END for each pack
+            pack_dir = os.path.join(path, gdb.packs_dir)
+            pack_paths = glob.glob(os.path.join(pack_dir, '*.pack'))
+            assert len(pack_paths) == 3
+            for pack_path in pack_paths:
+                assert os.path.basename(pack_path).startswith("pack-")
+                assert "'" not in pack_path
+                open(os.path.splitext(pack_path)[0] + '.bitmap', 'wb').close()
+            # END for each pack
+
+            # 7 objects don't outgrow the 4 objects of the smaller packs together
+            assert gdb.merge_packs(factor=2) == 3
+            assert len(glob.glob(os.path.join(pack_dir, '*.pack'))) == 1
+            assert not glob.glob(os.path.join(pack_dir, '*.bitmap'))
+            for sha in shas:
+                assert gdb.has_object(sha)
+                assert gdb.stream(sha).read().startswith(b"object ")
+            # END for each object
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_routing_cache(self, path):
+        os.mkdir(os.path.join(path, 'pack'))
+        gdb = GitDB(path)
+        try:
+            gdb.db_cache_size = 3
+            gdb.db_cache_negative = True
+            shas = [gdb.store(IStream(str_blob_type, 1, BytesIO(b"%i" % i))).binsha for i in range(5)]
+            for sha in shas:
+                assert gdb.has_object(sha)
+            # END for each sha
+            assert gdb.has_object(shas[-1])
+            info = gdb.cache_info()
+            assert info['hits'] == 1 and info['misses'] == 5
+            assert info['evictions'] == 2 and info['size'] == 3
+
+            # objects remembered to be missing become available once they are stored
+            missing_data = b"missing"
+            missing_sha = MemoryDB().store(IStream(str_blob_type, len(missing_data), BytesIO(missing_data))).binsha
+            assert not gdb.has_object(missing_sha)
+            assert not gdb.has_object(missing_sha)
+            assert gdb.cache_info()['negative_hits'] == 1
+            gdb.store(IStream(str_blob_type, len(missing_data), BytesIO(missing_data)))
+            assert gdb.has_object(missing_sha)
+
+            # changes of a sub-database invalidate its entries, the others are kept
+            ldb = gdb.databases()[1]
+            gdb.invalidate_cache(ldb)
+            assert gdb.has_object(missing_sha)
+            assert gdb.cache_info()['misses'] == 8
+
+            # routes to objects which moved are fixed on access
+            gdb.db_cache_size = 100
+            assert gdb.pack_loose_objects(min_count=1) == 6
+            for sha in shas:
+                gdb._cache_route(sha, ldb)
+                assert gdb.stream(sha).read() == b"%i" % shas.index(sha)
+            # END for each moved object
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_adaptive_db_order(self, path):
+        os.mkdir(os.path.join(path, 'pack'))
+        gdb = GitDB(path)
+        gdb.db_cache_size = 0
+        gdb.db_sort_interval = 10
+        pdb, ldb = gdb.databases()
+        assert isinstance(pdb, PackedDB)
+
+        shas = [gdb.store(IStream(str_blob_type, 1, BytesIO(b"%i" % i))).binsha for i in range(5)]
+        for _ in range(4):
+            for sha in shas:
+                assert gdb.stream(sha).read()
+            # END for each loose object
+        # END for each round
+
+        # the loose database provides all objects, hence it is queried first
+        stats = gdb.db_stats()
+        assert [db for db, hits, misses in stats] == [ldb, pdb]
+        assert stats[0][1] == 20 and stats[0][2] == 0
+        assert stats[1][1] == 0 and stats[1][2] == 9
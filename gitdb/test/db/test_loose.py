@@ -7,8 +7,21 @@ from gitdb.test.db.lib import (
     with_rw_directory
 )
 from gitdb.db import LooseObjectDB
-from gitdb.exc import BadObject
+from gitdb.exc import (
+    AmbiguousObjectName,
+    BadObject
+)
 from gitdb.util import bin_to_hex
+from gitdb.base import IStream
+from gitdb.fun import loose_object_header
+from gitdb.typ import str_blob_type
+from gitdb.test.lib import make_bytes
+
+from io import BytesIO
+
+import hashlib
+import os
+import zlib
 
 
 class TestLooseDB(TestDBBase):
@@ -34,3 +47,190 @@ class TestLooseDB(TestDBBase):
 
         self.assertRaises(BadObject, ldb.partial_to_complete_sha_hex, '0000')
         # raises if no object could be found
+
+    @with_rw_directory
+    def test_listing_cache(self, path):
+        ldb = LooseObjectDB(path)
+        ldb.listing_racy_seconds = -1
+        self._assert_object_writing(ldb)
+        shas = list(ldb.sha_iter())
+        assert shas == sorted(shas)
+        assert ldb.size() == len(shas)
+        ldb.listing_workers = 1
+        assert list(ldb.sha_iter()) == shas
+
+        # unrelated directories are not considered
+        os.makedirs(os.path.join(path, 'pack', 'ab'))
+        open(os.path.join(path, 'pack', 'ab', 'c' * 38), 'wb').close()
+
+        # the listing is only refreshed if the directory changes
+        obj_dir = os.path.join(path, bin_to_hex(shas[0]).decode()[:2])
+        st = os.stat(obj_dir)
+        new_obj_path = os.path.join(obj_dir, 'f' * 38)
+        open(new_obj_path, 'wb').close()
+        os.utime(obj_dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert ldb.size() == len(shas)
+        os.utime(obj_dir, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        assert ldb.size() == len(shas) + 1
+        os.remove(new_obj_path)
+        assert list(ldb.sha_iter()) == shas
+
+    @with_rw_directory
+    def test_partial_lookup(self, path):
+        ldb = LooseObjectDB(path)
+        obj_dir = os.path.join(path, 'ab')
+        os.makedirs(obj_dir)
+        for name in ('cd' + '0' * 36, 'cd' + '1' * 36, 'ce' + '0' * 36, 'c' * 38):
+            open(os.path.join(obj_dir, name), 'wb').close()
+        # END for each fake object
+
+        assert bin_to_hex(ldb.partial_to_complete_sha_hex('abce')) == b'abce' + b'0' * 36
+        assert bin_to_hex(ldb.partial_to_complete_sha_hex(b'ABCD1')) == b'abcd' + b'1' * 36
+        assert bin_to_hex(ldb.partial_to_complete_sha_hex('abcc')) == b'ab' + b'c' * 38
+        for ambiguous in ('abcd', 'abc', 'ab', 'a'):
+            self.assertRaises(AmbiguousObjectName, ldb.partial_to_complete_sha_hex, ambiguous)
+        # END for each ambiguous name
+        for missing in ('abcf', 'abcd2', 'ac', 'b', 'xyz', 'ab' * 21):
+            self.assertRaises(BadObject, ldb.partial_to_complete_sha_hex, missing)
+        # END for each missing name
+
+    @with_rw_directory
+    def test_store_many(self, path):
+        ldb = LooseObjectDB(path)
+        ldb.store_batch_size = 7
+        datas = [b"object %i" % i for i in range(50)] * 2
+        istreams = ldb.store_many((IStream(str_blob_type, len(data), BytesIO(data)) for data in datas),
+                                  workers=3, fsync=True)
+        assert len(istreams) == len(datas)
+        assert ldb.size() == len(datas) // 2
+        for istream, data in zip(istreams, datas):
+            assert ldb.stream(istream.binsha).read() == data
+            mode = os.stat(ldb.db_path(ldb.object_path(istream.hexsha))).st_mode & 0o777
+            assert os.name == 'nt' or mode == ldb.new_objects_mode
+        # END for each object
+        assert not [name for name in os.listdir(path) if name.startswith('obj')]
+
+        # precompressed objects are copied as they are
+        os.mkdir(os.path.join(path, 'target'))
+        target_db = LooseObjectDB(os.path.join(path, 'target'))
+        sha = istreams[0].binsha
+        istream = IStream(str_blob_type, 0, BytesIO(bytes(ldb.raw_object(sha))), sha)
+        assert target_db.store_many([istream])[0].binsha == sha
+        assert target_db.stream(sha).read() == datas[0]
+
+        # failures don't leave temporary files behind
+        closed_stream = BytesIO(b"data")
+        closed_stream.close()
+        self.assertRaises(ValueError, ldb.store_many, [IStream(str_blob_type, 4, closed_stream)])
+        assert not [name for name in os.listdir(path) if name.startswith('obj')]
+
+    @with_rw_directory
+    def test_anonymous_tmpfiles(self, path):
+        for use_anonymous_tmpfiles in (True, False):
+            ldb = LooseObjectDB(path)
+            ldb._use_anonymous_tmpfiles &= use_anonymous_tmpfiles
+            data = b"anonymous %i" % use_anonymous_tmpfiles
+            for _ in range(2):
+                sha = ldb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+            # END store duplicates
+            assert ldb.stream(sha).read() == data
+            mode = os.stat(ldb.db_path(ldb.object_path(bin_to_hex(sha)))).st_mode & 0o777
+            assert os.name == 'nt' or mode == ldb.new_objects_mode
+
+            # failures don't leave temporary files behind
+            closed_stream = BytesIO(data)
+            closed_stream.close()
+            self.assertRaises(ValueError, ldb.store, IStream(str_blob_type, len(data), closed_stream))
+            assert not [name for name in os.listdir(path) if name.startswith('obj')]
+        # END for each kind of tmp file
+
+    @with_rw_directory
+    def test_existence_cache(self, path):
+        ldb = LooseObjectDB(path)
+        ldb.listing_racy_seconds = -1
+        ldb.path_cache_size = 2
+        shas = [ldb.store(IStream(str_blob_type, 1, BytesIO(b"%i" % i))).binsha for i in range(5)]
+        assert all(ldb.has_object(sha) for sha in shas)
+        assert len(ldb._path_cache) == 2
+
+        # misses are remembered until the fan-out directory changes
+        obj_dir = os.path.dirname(ldb.db_path(ldb.object_path(bin_to_hex(shas[0]))))
+        missing_sha = shas[0][:1] + b'\0' * 19
+        missing_path = ldb.db_path(ldb.object_path(bin_to_hex(missing_sha)))
+        assert not ldb.has_object(missing_sha)
+        assert ldb._num_missing == 1
+        st = os.stat(obj_dir)
+        with open(ldb.db_path(ldb.object_path(bin_to_hex(shas[0]))), 'rb') as fp:
+            data = fp.read()
+        # END read object
+        with open(missing_path, 'wb') as fp:
+            fp.write(data)
+        # END write object under a wrong name, it's only about the file's existence
+        os.utime(obj_dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert not ldb.has_object(missing_sha)
+        os.utime(obj_dir, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        assert ldb.has_object(missing_sha)
+        assert ldb._num_missing == 0
+
+        # outdated misses don't count anymore once the directory is listed again
+        other_shas = [shas[0][:1] + bytes([i]) * 19 for i in (1, 2)]
+        assert not ldb.has_object(other_shas[0])
+        assert ldb._num_missing == 1
+        os.utime(obj_dir, ns=(st.st_atime_ns, st.st_mtime_ns + 2))
+        assert not ldb.has_object(other_shas[1])
+        assert ldb._num_missing == 1
+
+        # misses in directories which don't exist, and objects we write ourselves
+        ldb.negative_cache_validation_interval = 1000
+        data = b"new object"
+        new_sha = hashlib.sha1(loose_object_header(str_blob_type, len(data)) + data).digest()
+        assert not os.path.isdir(os.path.dirname(ldb.db_path(ldb.object_path(bin_to_hex(new_sha)))))
+        num_missing = ldb._num_missing
+        assert not ldb.has_object(new_sha)
+        assert ldb._num_missing == num_missing + 1
+        assert ldb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha == new_sha
+        assert ldb._num_missing == num_missing
+        assert ldb.has_object(new_sha)
+
+    @with_rw_directory
+    def test_header_info(self, path):
+        ldb = LooseObjectDB(path)
+        datas = (b"", b"small", make_bytes(100000, randomize=True), make_bytes(100000, randomize=False))
+        shas = [ldb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha for data in datas]
+        for read_size in (1, 7, 512):
+            ldb.header_read_size = read_size
+            infos = ldb.info_many(shas, workers=3)
+            assert [info.size for info in infos] == [len(data) for data in datas]
+            assert [info.binsha for info in infos] == shas
+            assert all(info.type == str_blob_type for info in infos)
+        # END for each read size
+        self.assertRaises(BadObject, ldb.info_many, shas + [b'\0' * 20])
+
+        # truncated objects
+        obj_path = ldb.db_path(ldb.object_path(bin_to_hex(shas[1])))
+        os.chmod(obj_path, 0o644)
+        with open(obj_path, 'r+b') as fp:
+            fp.truncate(3)
+        # END truncate object
+        self.assertRaises(ValueError, ldb.info, shas[1])
+
+    @with_rw_directory
+    def test_raw_object(self, path):
+        ldb = LooseObjectDB(path)
+        self._assert_object_writing(ldb)
+        sha = next(ldb.sha_iter())
+        ostream = ldb.stream(sha)
+
+        raw = ldb.raw_object(sha)
+        assert zlib.decompress(raw) == loose_object_header(ostream.type, ostream.size) + ostream.read()
+
+        out_path = os.path.join(path, 'raw')
+        with open(out_path, 'wb') as fp:
+            assert ldb.send_raw_object(sha, fp) == len(raw)
+        # END assure file is closed
+        with open(out_path, 'rb') as fp:
+            assert fp.read() == raw
+        # END assure file is closed
+        raw.release()
+        self.assertRaises(BadObject, ldb.raw_object, b'\0' * 20)
+        self.assertRaises(BadObject, ldb.send_raw_object, b'\0' * 20, 1)
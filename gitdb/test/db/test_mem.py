@@ -4,12 +4,26 @@
 # the New BSD License: https://opensource.org/license/bsd-3-clause/
 from gitdb.test.db.lib import (
     TestDBBase,
-    with_rw_directory
+    with_rw_directory,
+    close_databases
 )
 from gitdb.db import (
     MemoryDB,
-    LooseObjectDB
+    LooseObjectDB,
+    GitDB
 )
+from gitdb.base import (
+    IStream,
+    OInfo
+)
+from gitdb.stream import ZippedContentReader
+from gitdb.typ import str_blob_type
+from gitdb.test.lib import make_bytes
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import os
 
 
 class TestMemoryDB(TestDBBase):
@@ -32,3 +46,113 @@ class TestMemoryDB(TestDBBase):
             assert ldb.has_object(sha)
             assert ldb.stream(sha).read() == mdb.stream(sha).read()
         # END verify objects where copied and are equal
+
+    @with_rw_directory
+    def test_raw_storage_and_spilling(self, path):
+        mdb = MemoryDB(raw=True)
+        self._assert_object_writing_simple(mdb)
+        assert mdb.num_bytes() == 250 * 4
+
+        # shas match the ones of compressed storage
+        data = b"staged data" * 10
+        raw_sha = mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+        zipped_db = MemoryDB()
+        assert zipped_db.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha == raw_sha
+        assert zipped_db.stream_copy([raw_sha], mdb) == 0
+
+        # exceeding the budget moves the least recently used objects to disk
+        for raw in (True, False):
+            spill_dir = os.path.join(path, 'spill%i' % raw)
+            os.mkdir(spill_dir)
+            mdb = MemoryDB(raw=raw, max_bytes=100, spill_dir=spill_dir)
+            shas = list()
+            for i in range(10):
+                data = b"%i" % i * 30
+                shas.append(mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha)
+                # keep the first object in memory by using it
+                mdb.stream(shas[0])
+            # END for each object
+            assert mdb.num_bytes() <= 100
+            assert mdb.size() == len(set(mdb.sha_iter())) == 10
+            assert shas[0] in mdb._cache and shas[1] not in mdb._cache
+            assert mdb.spill_db().has_object(shas[1])
+            for i, sha in enumerate(shas):
+                assert mdb.has_object(sha)
+                assert mdb.stream(sha).read() == b"%i" % i * 30
+            # END for each object
+
+            os.mkdir(os.path.join(path, 'target%i' % raw))
+            ldb = LooseObjectDB(os.path.join(path, 'target%i' % raw))
+            assert mdb.stream_copy(mdb.sha_iter(), ldb) == 10
+            assert ldb.stream(shas[1]).read() == b"1" * 30
+        # END for each storage format
+
+    def test_independent_streams(self):
+        for raw in (True, False):
+            mdb = MemoryDB(raw=raw)
+            data = make_bytes(64 * 1024, randomize=True)
+            sha = mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+
+            info = mdb.info(sha)
+            assert type(info) is OInfo and info.size == len(data)
+
+            # interleaved reads don't affect each other
+            first, second = mdb.stream(sha), mdb.stream(sha)
+            assert first.read(100) == data[:100]
+            assert second.read() == data
+            assert first.read() == data[100:]
+
+            # concurrent readers
+            with ThreadPoolExecutor(4) as executor:
+                assert all(d == data for d in executor.map(lambda _: mdb.stream(sha).read(), range(32)))
+            # END assure threads are shut down
+
+            # objects in loose format are kept as they are
+            target_db = MemoryDB(raw=raw)
+            assert mdb.stream_copy([sha], target_db) == 1
+            assert target_db.stream(sha).read() == data
+        # END for each storage format
+
+    @with_rw_directory
+    def test_flush_to_pack(self, path):
+        gdb = GitDB(path)
+        try:
+            datas = [b"", b"small", make_bytes(64 * 1024, randomize=True), b"repeated " * 1000]
+            existing = gdb.store(IStream(str_blob_type, 5, BytesIO(b"exist"))).binsha
+
+            mdb = MemoryDB()
+            shas = [mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha for data in datas]
+            mdb.store(IStream(str_blob_type, 5, BytesIO(b"exist")))
+            # the compressed content is reused
+            pack_stream = mdb._pack_stream(shas[3])
+            assert isinstance(pack_stream.stream, ZippedContentReader)
+            assert pack_stream.read() == datas[3]
+
+            entity = mdb.flush_to_pack(gdb)
+            try:
+                assert entity.index().size() == len(datas)
+                assert entity.index().sha_to_index(existing) is None
+                for sha, data in zip(shas, datas):
+                    assert entity.is_valid_stream(sha, use_crc=True)
+                    assert gdb.stream(sha).read() == data
+                # END for each object
+            finally:
+                entity.close()
+            # END assure pack is closed
+            assert mdb.flush_to_pack(gdb) is None
+
+            # objects which aren't compressed in memory are compressed on the fly
+            raw_db = MemoryDB(raw=True)
+            for data in datas:
+                raw_db.store(IStream(str_blob_type, len(data), BytesIO(data)))
+            # END for each object
+            entity = raw_db.flush_to_pack(path)
+            try:
+                assert entity.index().size() == len(datas)
+                assert all(entity.is_valid_stream(sha, use_crc=True) for sha in shas)
+            finally:
+                entity.close()
+            # END assure pack is closed
+        finally:
+            close_databases(gdb)
+        # END assure packs are closed
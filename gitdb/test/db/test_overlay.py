@@ -0,0 +1,114 @@
+# Copyright (C) 2010, 2011 Sebastian Thiel (byronimo@gmail.com) and contributors
+#
+# This module is part of GitDB and is released under
+# the New BSD License: https://opensource.org/license/bsd-3-clause/
+from gitdb.test.db.lib import (
+    TestDBBase,
+    with_rw_directory,
+    close_databases
+)
+from gitdb.db import (
+    GitDB,
+    MemoryDB,
+    OverlayDB
+)
+from gitdb.base import IStream
+from gitdb.exc import BadObject
+from gitdb.typ import str_blob_type
+
+from io import BytesIO
+
+import os
+import time
+
+
+class FailingDB(MemoryDB):
+
+    """A database whose writes fail until told otherwise"""
+    fail = True
+
+    def store(self, istream):
+        if self.fail:
+            raise OSError("disk full")
+        return super().store(istream)
+
+
+class TestOverlayDB(TestDBBase):
+
+    def _store(self, db, data):
+        return db.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+
+    @with_rw_directory
+    def test_transactions(self, path):
+        os.mkdir(os.path.join(path, 'pack'))
+        gdb = GitDB(path)
+        odb = OverlayDB(gdb, auto_flush=False)
+        try:
+            self._assert_object_writing_simple(odb)
+            assert gdb.size() == 0 and odb.pending() == 250
+
+            # commit
+            assert odb.flush() == 250
+            assert gdb.size() == 250 and odb.pending() == 0
+            assert len(os.listdir(os.path.join(path, 'pack'))) == 2
+            assert odb.size() == 250
+
+            # rollback
+            sha = self._store(odb, b"uncommitted")
+            assert odb.stream(sha).read() == b"uncommitted"
+            assert odb.discard() == 1
+            assert not odb.has_object(sha)
+            self.assertRaises(BadObject, odb.info, sha)
+
+            # small batches become loose objects
+            sha = self._store(odb, b"loose")
+            assert odb.flush() == 1
+            assert gdb.has_object(sha) and os.path.isdir(os.path.join(path, bytes.hex(sha)[:2]))
+        finally:
+            odb.close()
+            close_databases(gdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_background_flush(self, path):
+        gdb = GitDB(path)
+        odb = OverlayDB(gdb)
+        odb.flush_count = 10
+        odb.flush_interval = 0.05
+        shas = [self._store(odb, b"%i" % i) for i in range(25)]
+        # objects stay readable while being flushed
+        assert all(odb.stream(sha).read() == b"%i" % i for i, sha in enumerate(shas))
+
+        # the last few objects are flushed once they are old enough
+        for _ in range(100):
+            if not odb.pending():
+                break
+            time.sleep(0.05)
+        # END wait for timer
+        assert odb.pending() == 0
+        assert odb.close() == 0
+        assert all(gdb.has_object(sha) for sha in shas)
+
+    def test_background_errors(self):
+        fdb = FailingDB()
+        odb = OverlayDB(fdb)
+        odb.flush_count = 2
+        odb.flush_interval = None
+        shas = [self._store(odb, b"%i" % i) for i in range(2)]
+        for _ in range(100):
+            if odb._error is not None and not odb._futures:
+                break
+            time.sleep(0.01)
+        # END wait for background flush
+        assert not odb._futures
+        # the failure is reported once, the objects stay available
+        self.assertRaises(OSError, self._store, odb, b"next")
+        assert odb.pending() == 2
+        assert all(odb.has_object(sha) for sha in shas)
+
+        # flushing writes them again
+        self.assertRaises(OSError, odb.flush)
+        fdb.fail = False
+        assert odb.close() == 2
+        assert odb.pending() == 0 and odb._executor is None
+        assert all(fdb.has_object(sha) for sha in shas)
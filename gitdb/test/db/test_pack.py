@@ -5,13 +5,24 @@
 from gitdb.test.db.lib import (
     TestDBBase,
     with_rw_directory,
-    with_packs_rw
+    with_packs_rw,
+    fixture_path,
+    close_databases
+)
+from gitdb.db import (
+    PackedDB,
+    PackWriterDB
 )
-from gitdb.db import PackedDB
 
-from gitdb.exc import BadObject, AmbiguousObjectName
+from gitdb.base import IStream
+from gitdb.pack import PackEntity
+from gitdb.exc import BadObject, AmbiguousObjectName, ParseError
+from gitdb.typ import str_blob_type
 from gitdb.util import mman
 
+from io import BytesIO
+
+import glob
 import os
 import random
 import sys
@@ -85,3 +96,117 @@ class TestPackDB(TestDBBase):
 
         # non-existing
         self.assertRaises(BadObject, pdb.partial_to_complete_sha, b'\0\0', 4)
+
+    @with_rw_directory
+    def test_pack_writer(self, path):
+        # nothing written, nothing committed
+        with PackWriterDB(path) as pwdb:
+            pass
+        assert not os.listdir(path)
+
+        # a failure removes the pending pack
+        try:
+            with PackWriterDB(path) as pwdb:
+                pwdb.store(IStream(str_blob_type, 4, BytesIO(b'data')))
+                raise ValueError("abort")
+        except ValueError:
+            pass
+        assert not os.listdir(path)
+
+        pwdb = PackWriterDB(path)
+        self._assert_object_writing_simple(pwdb)
+
+        # duplicates are not written twice
+        num_objs = pwdb.size()
+        data = b'0000'
+        istream = pwdb.store(IStream(str_blob_type, len(data), BytesIO(data)))
+        pwdb.store(IStream(str_blob_type, len(data), BytesIO(data)))
+        assert pwdb.size() == num_objs + 1
+        assert pwdb.partial_to_complete_sha(istream.binsha[:4], 8) == istream.binsha
+
+        entity = pwdb.commit()
+        try:
+            assert entity.index().size() == num_objs + 1
+            for info in entity.info_iter():
+                assert entity.is_valid_stream(info.binsha, use_crc=True)
+                assert entity.is_valid_stream(info.binsha, use_crc=False)
+            # END for each object
+            assert entity.stream(istream.binsha).read() == data
+        finally:
+            entity.close()
+        # END assure pack is closed
+
+        pdb = PackedDB(path)
+        try:
+            assert pdb.size() == num_objs + 1
+            assert pwdb.size() == 0
+        finally:
+            close_databases(pdb)
+        # END assure packs are closed
+
+    @with_rw_directory
+    def test_ingest_pack_stream(self, path):
+        pdb = PackedDB(path)
+        try:
+            assert pdb.size() == 0
+
+            pack_paths = glob.glob(fixture_path('packs/*.pack'))
+            for pack_path in pack_paths:
+                with open(pack_path, 'rb') as fp:
+                    data = fp.read()
+                # simulate a pipe which returns small amounts of data at a time
+                stream = BytesIO(data)
+                entity = pdb.ingest_pack_stream(lambda size: stream.read(min(size, 1000)))
+                orig_entity = PackEntity(pack_path)
+                try:
+                    assert entity.pack().checksum() == orig_entity.pack().checksum()
+                    assert entity.index().size() == orig_entity.index().size()
+                    for info in orig_entity.info_iter():
+                        assert pdb.info(info.binsha) == info
+                        assert pdb.stream(info.binsha).read() == orig_entity.stream(info.binsha).read()
+                    # END for each object
+                finally:
+                    entity.close()
+                    orig_entity.close()
+                # END assure packs are closed
+
+                # truncated and corrupted packs don't leave any trace
+                num_files = len(os.listdir(path))
+                for bad_data in (data[:-100], data[:-1] + bytes([data[-1] ^ 1])):
+                    stream = BytesIO(bad_data)
+                    self.assertRaises(ParseError, pdb.ingest_pack_stream, stream.read)
+                    assert len(os.listdir(path)) == num_files
+                # END for each bad pack
+            # END for each pack
+            assert len(pdb.entities()) == len(pack_paths)
+        finally:
+            close_databases(pdb)
+        # END assure packs are closed
+
+    def test_open_pack_limit(self):
+        pdb = PackedDB(fixture_path('packs'))
+        try:
+            pdb.max_open_packs = 2
+            entities = pdb.entities()
+            assert len(entities) > 2
+            assert pdb.resource_usage()['open_packs'] == 2
+
+            streams = dict()
+            for entity in entities:
+                for info in entity.info_iter():
+                    streams[info.binsha] = entity.stream(info.binsha).read()
+                # END for each object
+                entity.close()
+            # END for each pack
+
+            # packs are reopened transparently, while at most two of them are kept open
+            for sha, data in streams.items():
+                assert pdb.stream(sha).read() == data
+                usage = pdb.resource_usage()
+                assert usage['open_packs'] <= 2 and usage['file_handles'] >= 0
+            # END for each object
+            assert pdb.size() == len(streams) and len(set(pdb.sha_iter())) == len(streams)
+            assert sum('_cursor' in entity.index().__dict__ for entity in entities) <= 2
+        finally:
+            close_databases(pdb)
+        # END assure packs are closed
@@ -4,6 +4,7 @@
 # the New BSD License: https://opensource.org/license/bsd-3-clause/
 """Utilities used in ODB testing"""
 from gitdb import OStream
+from gitdb.util import release_unused_maps
 
 import sys
 import random
@@ -80,6 +81,8 @@ def with_rw_directory(func):
             # though this is not the case here unless we collect explicitly.
             if not keep:
                 gc.collect()
+                # regions of packs which aren't used anymore keep their file open
+                release_unused_maps()
                 shutil.rmtree(path)
         # END handle exception
     # END wrapper
@@ -7,6 +7,10 @@
 from gitdb.test.performance.lib import (
     TestBigRepoR
 )
+from gitdb.test.lib import (
+    make_bytes,
+    with_rw_directory
+)
 
 from gitdb import (
     MemoryDB,
@@ -16,7 +20,15 @@ from gitdb import (
 from gitdb.typ import str_blob_type
 from gitdb.exc import UnsupportedOperation
 from gitdb.db.pack import PackedDB
+from gitdb.pack import (
+    AccessLog,
+    PackEntity,
+    order_by_type
+)
+
+from io import BytesIO
 
+import random
 import sys
 import os
 from time import time
@@ -125,3 +137,37 @@ class TestPackedDBPerformance(TestBigRepoR):
             print("PDB: verified %i objects (crc=%i) in %f s ( %f objects/s )" %
                   (count, crc, elapsed, count / (elapsed or 1)), file=sys.stderr)
         # END for each verify mode
+
+    @with_rw_directory
+    def test_pack_ordering(self, path):
+        # read latency of objects read in a recorded sequence, depending on the pack layout
+        mdb = MemoryDB()
+        ni = 2000
+        shas = list()
+        for i in range(ni):
+            data = make_bytes(random.randint(1000, 8000), randomize=True)
+            shas.append(mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha)
+        # END for each object
+        random.shuffle(shas)
+
+        log = AccessLog()
+        tracked_db = log.track(mdb)
+        accessed = random.sample(shas, ni // 4)
+        for sha in accessed:
+            tracked_db.stream(sha)
+        # END record accesses
+
+        for name, order in (("iteration order", None), ("type order", order_by_type), ("access order", log.order)):
+            st = time()
+            entity = PackEntity.create((mdb.stream(sha) for sha in shas), path, object_count=ni, order=order)
+            write_elapsed = time() - st
+
+            st = time()
+            for sha in accessed:
+                entity.stream(sha).read()
+            # END for each access
+            elapsed = time() - st
+            print("Pack in %s: written in %f s, read %i objects in access order in %f s ( %f us/object )" %
+                  (name, write_elapsed, len(accessed), elapsed, elapsed * 1e6 / len(accessed)), file=sys.stderr)
+            entity.close()
+        # END for each ordering
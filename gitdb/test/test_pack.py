@@ -6,30 +6,60 @@
 from gitdb.test.lib import (
     TestBase,
     with_rw_directory,
-    fixture_path
+    fixture_path,
+    make_bytes
 )
 
-from gitdb.stream import DeltaApplyReader
+from gitdb.stream import (
+    AdaptiveCompression,
+    DeltaApplyReader
+)
 
 from gitdb.pack import (
+    AccessLog,
     PackEntity,
     PackIndexFile,
-    PackFile
+    PackFile,
+    apply_delta,
+    delta_subtrees,
+    order_by_type,
+    order_bases_first
 )
 
 from gitdb.base import (
+    IStream,
     OInfo,
     OStream,
 )
 
-from gitdb.fun import delta_types
-from gitdb.exc import UnsupportedOperation
+from gitdb.db import MemoryDB
+from gitdb.fun import (
+    delta_types,
+    create_delta,
+    pack_object_header_info,
+    REF_DELTA
+)
+from gitdb.exc import (
+    ParseError,
+    UnsupportedOperation
+)
+from gitdb.typ import (
+    str_blob_type,
+    str_commit_type,
+    str_tag_type,
+    str_tree_type
+)
 from gitdb.util import to_bin_sha
 
+from io import BytesIO
+
 import pytest
 
 import os
+import shutil
+import socket
 import tempfile
+import zlib
 
 
 #{ Utilities
@@ -231,18 +261,292 @@ class TestPack(TestBase):
         # END for each packpath, indexpath pair
 
         # verify the packs thoroughly
-        rewind_streams()
-        entity = PackEntity.create(pack_objs, rw_dir)
-        count = 0
-        for info in entity.info_iter():
-            count += 1
-            for use_crc in range(2):
-                assert entity.is_valid_stream(info.binsha, use_crc)
-            # END for each crc mode
-        # END for each info
-        assert count == len(pack_objs)
+        for compression in (None, AdaptiveCompression(min_size=0, min_ratio=0)):
+            rewind_streams()
+            entity = PackEntity.create(pack_objs, rw_dir, compression=compression)
+            count = 0
+            for info in entity.info_iter():
+                count += 1
+                for use_crc in range(2):
+                    assert entity.is_valid_stream(info.binsha, use_crc)
+                # END for each crc mode
+            # END for each info
+            assert count == len(pack_objs)
+            entity.close()
+        # END for each compression mode
+        assert compression.num_stored + compression.num_compressed == len(pack_objs)
+
+    @with_rw_directory
+    def test_index_pack(self, rw_dir):
+        for packinfo, indexinfo in ((self.packfile_v2_1, self.packindexfile_v1),
+                                    (self.packfile_v2_2, self.packindexfile_v2),
+                                    (self.packfile_v2_3_ascii, self.packindexfile_v2_3_ascii)):
+            pack_path = shutil.copy(packinfo[0], rw_dir)
+            orig_index = PackIndexFile(indexinfo[0])
+            try:
+                for workers in (1, 2):
+                    calls = list()
+                    entity = PackEntity.index_pack(pack_path, workers=workers, write_rev=True,
+                                                   progress=lambda *args: calls.append(args))
+                    try:
+                        assert calls[-1] == (orig_index.size(), orig_index.size())
+                        index = entity.index()
+                        assert index.version() == 2
+                        assert index.size() == orig_index.size()
+                        assert index.packfile_checksum() == orig_index.packfile_checksum()
+                        for i in range(index.size()):
+                            assert index.sha(i) == orig_index.sha(i)
+                            assert index.offset(i) == orig_index.offset(i)
+                            if orig_index.version() == 2:
+                                assert index.crc(i) == orig_index.crc(i)
+                            # END compare crc's
+                            assert entity.is_valid_stream(index.sha(i), use_crc=True)
+                        # END for each object
+
+                        # the reverse index lists index positions in pack order
+                        with open(os.path.splitext(pack_path)[0] + '.rev', 'rb') as fp:
+                            rev = fp.read()
+                        assert rev[:4] == b'RIDX'
+                        assert len(rev) == 12 + index.size() * 4 + 40
+                        first = int.from_bytes(rev[12:16], 'big')
+                        assert index.offset(first) == min(index.offsets())
+                    finally:
+                        entity.close()
+                    # END assure pack is closed
+                # END for each worker count
+            finally:
+                orig_index.close()
+            # END assure index is closed
+        # END for each pack
+
+    def test_delta_subtrees(self):
+        # 10 <- 20 <- 30, 40 <- 50, 60 <- ref to 'a' (a delta), b's REF_DELTA 70 <- 80
+        ofs_children = {10: [20], 20: [30], 40: [50], 70: [80]}
+        ref_children = {b'a': [60], b'b': [70]}
+        known_shas = {b'b', b'c'}
+        sub_ofs, sub_ref = delta_subtrees([(10, b'c')], ofs_children, ref_children, known_shas)
+        assert sub_ofs == {10: [20], 20: [30]}
+        # the base of 60 isn't resolved yet, it may be part of any tree
+        assert sub_ref == {b'a': [60]}
+        sub_ofs, sub_ref = delta_subtrees([(40, b'd'), (90, b'b')], ofs_children, ref_children, known_shas)
+        assert sub_ofs == {40: [50], 70: [80]}
+        assert sub_ref == {b'a': [60], b'b': [70]}
+
+    @with_rw_directory
+    def test_thin_pack(self, rw_dir):
+        # the receiver has the bases, the sender the modified objects
+        mdb = MemoryDB()
+        thin_bases = dict()
+        objs = list()
+        for i in range(5):
+            base = make_bytes(20000 + i * 100, randomize=True)
+            base_sha = mdb.store(IStream(str_blob_type, len(base), BytesIO(base))).binsha
+            data = base[:5000] + b"changed %i" % i + base[5000:]
+            objs.append(mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha)
+            thin_bases[objs[-1]] = base_sha
+        # END for each object pair
+
+        pack_path = os.path.join(rw_dir, 'pack-thin.pack')
+        with open(pack_path, 'wb') as fp:
+            PackEntity.write_pack((mdb.stream(sha) for sha in objs), fp.write, object_count=len(objs),
+                                  thin_bases=thin_bases, base_db=mdb)
+        assert os.path.getsize(pack_path) < 20000
+        pack_file = PackFile(pack_path)
+        try:
+            assert all(info.type_id == REF_DELTA for info in pack_file.stream_iter())
+        finally:
+            pack_file.close()
+        # END assure pack is closed
+
+        # without the bases, the pack cannot be indexed
+        self.assertRaises(ParseError, PackEntity.index_pack, pack_path)
+
+        # completion appends the bases
+        entity = PackEntity.index_pack(pack_path, base_db=mdb)
+        try:
+            assert not os.path.exists(pack_path)
+            assert entity.pack().size() == len(objs) * 2
+            assert entity.index().size() == len(objs) * 2
+            for sha in list(objs) + list(thin_bases.values()):
+                assert entity.stream(sha).read() == mdb.stream(sha).read()
+                assert entity.is_valid_stream(sha, use_crc=True)
+            # END for each object
+        finally:
+            entity.close()
+        # END assure pack is closed
+
+    @with_rw_directory
+    def test_thin_pack_chain(self, rw_dir):
+        # the missing base's child is the base of another delta, which the receiver has as well
+        mdb = MemoryDB()
+        datas = [make_bytes(20000, randomize=True)]
+        datas.append(datas[0][:5000] + b"first change" + datas[0][5000:])
+        datas.append(datas[1][:10000] + b"second change" + datas[1][10000:])
+        base_sha, mid_sha, tip_sha = [mdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+                                      for data in datas]
+        thin_bases = {mid_sha: base_sha, tip_sha: mid_sha}
+
+        for i, objs in enumerate(((mid_sha, tip_sha), (tip_sha, mid_sha))):
+            pack_path = os.path.join(rw_dir, 'pack-thin-%i.pack' % i)
+            with open(pack_path, 'wb') as fp:
+                PackEntity.write_pack((mdb.stream(sha) for sha in objs), fp.write, object_count=len(objs),
+                                      thin_bases=thin_bases, base_db=mdb)
+            # END write thin pack
+            entity = PackEntity.index_pack(pack_path, base_db=mdb)
+            try:
+                # only the base is appended, the pack and its index agree on the objects
+                assert entity.pack().size() == entity.index().size() == 3
+                assert sorted(entity.index().sha(i) for i in range(3)) == sorted((base_sha, mid_sha, tip_sha))
+                for sha in (base_sha, mid_sha, tip_sha):
+                    assert entity.stream(sha).read() == mdb.stream(sha).read()
+                    assert entity.is_valid_stream(sha, use_crc=False)
+                # END for each object
+            finally:
+                entity.close()
+            # END assure pack is closed
+        # END for each object order
+
+    @with_rw_directory
+    def test_raw_entry(self, rw_dir):
+        entity = PackEntity(self.packfile_v2_2[0])
+        try:
+            index = entity.index()
+            out_path = os.path.join(rw_dir, 'raw')
+            with open(out_path, 'wb') as fp:
+                for i in range(index.size()):
+                    sha = index.sha(i)
+                    raw = entity.raw_entry(sha)
+                    assert isinstance(raw, bytes)
+                    assert zlib.crc32(raw) == index.crc(i)
+                    type_id, size, data_offset = pack_object_header_info(raw)
+                    if type_id == REF_DELTA:
+                        data_offset += 20
+                    # END skip base sha
+                    assert type_id in delta_types or zlib.decompress(raw[data_offset:]) == entity.stream(sha).read()
+                    assert entity.send_raw_entry(sha, fp) == len(raw)
+                # END for each object
+            # END assure file is closed
+            with open(out_path, 'rb') as fp:
+                data = fp.read()
+            assert zlib.crc32(data) == zlib.crc32(b''.join(entity.raw_entry(sha) for sha in map(index.sha, range(index.size()))))
+
+            sock_in, sock_out = socket.socketpair()
+            with sock_in, sock_out:
+                sha = index.sha(0)
+                assert entity.send_raw_entry(sha, sock_out) == len(entity.raw_entry(sha))
+                assert sock_in.recv(len(entity.raw_entry(sha)) + 1) == entity.raw_entry(sha)
+            # END assure sockets are closed
+        finally:
+            entity.close()
+        # END assure pack is closed
+
+    @with_rw_directory
+    def test_pack_ordering(self, rw_dir):
+        mdb = MemoryDB()
+        shas = list()
+        bases = dict()
+        for i, type in enumerate((str_blob_type, str_tree_type, str_commit_type, str_tag_type) * 3):
+            data = b"%s %i" % (type, i) * 50
+            shas.append(mdb.store(IStream(type, len(data), BytesIO(data))).binsha)
+            if i >= 4:
+                bases[shas[-1]] = shas[i - 4]
+            # END chain objects of the same type
+        # END for each object
+
+        def written_shas(entity):
+            index = entity.index()
+            return [sha for offset, sha in sorted((index.offset(i), index.sha(i)) for i in range(index.size()))]
+        # END utility
+
+        # children come first in the input, bases are moved in front of them
+        entity = PackEntity.create([mdb.stream(sha) for sha in reversed(shas)], rw_dir,
+                                   thin_bases=bases, base_db=mdb, order=order_bases_first)
+        try:
+            order = written_shas(entity)
+            assert len(order) == len(shas)
+            for sha, base_sha in bases.items():
+                assert order.index(sha) == order.index(base_sha) + 1
+                assert entity.stream(sha).read() == mdb.stream(sha).read()
+            # END for each delta
+        finally:
+            entity.close()
+        # END assure pack is closed
+
+        entity = PackEntity.create((mdb.stream(sha) for sha in shas), rw_dir, order=order_by_type)
+        try:
+            assert [entity.info(sha).type for sha in written_shas(entity)] == \
+                [str_commit_type] * 3 + [str_tag_type] * 3 + [str_tree_type] * 3 + [str_blob_type] * 3
+        finally:
+            entity.close()
+        # END assure pack is closed
+
+        log = AccessLog()
+        tracked_db = log.track(mdb)
+        accessed = shas[5::2]
+        for sha in accessed + accessed[:2]:
+            tracked_db.stream(sha).read()
+        # END for each access
+        assert len(log) == len(accessed)
+        assert tracked_db.size() == len(shas)
+        entity = PackEntity.create((mdb.stream(sha) for sha in shas), rw_dir, object_count=len(shas),
+                                   order=log.order)
+        try:
+            order = written_shas(entity)
+            assert order[:len(accessed)] == accessed
+            assert order[len(accessed):] == [sha for sha in shas if sha not in accessed]
+        finally:
+            entity.close()
+        # END assure pack is closed
+
+    @with_rw_directory
+    def test_iter_by_type(self, rw_dir):
+        types = (str_commit_type, str_tree_type, str_blob_type, str_tag_type)
+        bitmap_pack = fixture_path('packs/pack-59b44293cdd018665701a901eb7ebd68a554ad99.pack')
+        for pack_path in (self.packfile_v2_1[0], self.packfile_v2_2[0], bitmap_pack):
+            entity = PackEntity(pack_path)
+            shas_by_type = {type: set() for type in types}
+            for info in entity.info_iter():
+                shas_by_type[info.type].add(info.binsha)
+            # END for each object
+            for type in types:
+                shas = list(entity.iter_by_type(type))
+                assert len(shas) == len(shas_by_type[type])
+                assert set(shas) == shas_by_type[type]
+            # END for each type
+            assert 0 not in entity.type_table()
+            entity.close()
+        # END for each pack
+
+        # bitmaps are used if they belong to the pack, the type table otherwise
+        entity = PackEntity(bitmap_pack)
+        assert entity._bitmap_type_positions(1) is not None
+        assert list(entity._bitmap_type_positions(4)) == [1]
+        entity.close()
+        basename = os.path.splitext(bitmap_pack)[0]
+        rw_basename = os.path.join(rw_dir, os.path.basename(basename))
+        for ext in ('.pack', '.idx'):
+            shutil.copy(basename + ext, rw_basename + ext)
+        # END for each file
+        with open(basename + '.bitmap', 'rb') as fp:
+            bitmap = bytearray(fp.read())
+        # END read bitmap
+        bitmap[12] ^= 1
+        with open(rw_basename + '.bitmap', 'wb') as fp:
+            fp.write(bitmap)
+        # END write stale bitmap
+        entity = PackEntity(rw_basename + '.pack')
+        assert entity._bitmap_type_positions(1) is None
+        assert len(list(entity.iter_by_type(str_blob_type))) == 6
         entity.close()
 
+    def test_create_delta(self):
+        base = make_bytes(10000, randomize=True)
+        for data in (b'', base, base[500:] + b'new' + base[:500], b'new' * 1000):
+            delta = create_delta(base, data)
+            assert apply_delta(base, delta) == data
+        # END for each target
+        assert len(create_delta(base, base)) < 20
+
     def test_pack_64(self):
         # TODO: hex-edit a pack helping us to verify that we can handle 64 byte offsets
         # of course without really needing such a huge pack
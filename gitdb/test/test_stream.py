@@ -9,19 +9,28 @@ from gitdb.test.lib import (
     DummyStream,
     make_bytes,
     make_object,
-    fixture_path
+    fixture_path,
+    with_rw_directory
 )
 
 from gitdb import (
+    AdaptiveCompression,
     DecompressMemMapReader,
     FDCompressedSha1Writer,
     LooseObjectDB,
     Sha1Writer,
     MemoryDB,
     IStream,
+    PipelinedCompressedSha1Writer,
 )
+from gitdb.pack import PackEntity
 from gitdb.util import hex_to_bin
+from gitdb.fun import (
+    create_pack_object_header,
+    loose_object_header
+)
 
+import hashlib
 import zlib
 from gitdb.typ import (
     str_blob_type
@@ -147,6 +156,80 @@ class TestStream(TestBase):
             os.remove(path)
         # END for each os
 
+    def test_adaptive_compression(self):
+        policy = AdaptiveCompression(min_size=100)
+        incompressible = os.urandom(200 * 1000)
+        compressible = make_bytes(200 * 1000, randomize=False)
+        for data in (incompressible, compressible, b'small'):
+            fd, path = tempfile.mkstemp()
+            ostream = FDCompressedSha1Writer(fd, policy)
+            # write in small chunks to exercise sampling across writes
+            ostream.write(loose_object_header(str_blob_type, len(data)))
+            for ofs in range(0, len(data), 4096):
+                ostream.write(data[ofs:ofs + 4096])
+            ostream.close()
+
+            with open(path, 'rb') as fp:
+                zdata = fp.read()
+            os.remove(path)
+
+            typ, size, reader = DecompressMemMapReader.new(zdata)
+            assert typ == str_blob_type and size == len(data)
+            assert reader.read() == data
+        # END for each data set
+        assert policy.num_stored == 1 and policy.bytes_stored == len(incompressible)
+        assert policy.num_compressed == 2
+
+        # databases use the policy as well
+        mdb = MemoryDB(compression=policy)
+        istream = mdb.store(IStream(str_blob_type, len(incompressible), BytesIO(incompressible)))
+        assert policy.num_stored == 2
+        assert mdb.stream(istream.binsha).read() == incompressible
+
+        # type specific levels take precedence
+        policy = AdaptiveCompression(type_levels={str_blob_type: zlib.Z_BEST_COMPRESSION})
+        assert policy.compression_level(str_blob_type, len(incompressible), incompressible) == zlib.Z_BEST_COMPRESSION
+        assert policy.num_compressed == 1
+
+    @with_rw_directory
+    def test_pipelined_writer(self, path):
+        data = make_bytes(1000 * 1000, randomize=True) + make_bytes(1000 * 1000, randomize=False)
+        chunks = list()
+        writer = PipelinedCompressedSha1Writer(chunks.append, queue_size=2, base_crc=0)
+        for ofs in range(0, len(data), 4096):
+            assert writer.write(memoryview(data)[ofs:ofs + 4096]) == min(4096, len(data) - ofs)
+        # END for each chunk
+        writer.close()
+        zdata = b''.join(chunks)
+        assert zlib.decompress(zdata) == data
+        assert writer.sha() == hashlib.sha1(data).digest()
+        assert writer.bytes_written() == len(zdata)
+        assert writer.crc() == zlib.crc32(zdata)
+
+        # errors of the stages are raised to the caller
+        def failing_write(data):
+            raise OSError("disk full")
+        # END failing write
+        writer = PipelinedCompressedSha1Writer(failing_write, hash=False)
+        writer.write(data)
+        self.assertRaises(OSError, writer.close)
+
+        # databases use it for large objects
+        ldb = LooseObjectDB(path)
+        ldb.pipeline_threshold = 1000
+        istream = ldb.store(IStream(str_blob_type, len(data), BytesIO(data)))
+        assert istream.binsha == hashlib.sha1(loose_object_header(str_blob_type, len(data)) + data).digest()
+        assert ldb.stream(istream.binsha).read() == data
+
+        pack_write = BytesIO()
+        # don't change the threshold of all PackEntity instances
+        class PipelinedPackEntity(PackEntity):
+            pipeline_threshold = 1000
+        # END pack entity with low threshold
+        PipelinedPackEntity.write_pack([ldb.stream(istream.binsha)], pack_write.write, BytesIO().write)
+        pack_data = pack_write.getvalue()
+        assert zlib.decompress(pack_data[12 + len(create_pack_object_header(3, len(data))):-20]) == data
+
     def test_decompress_reader_special_case(self):
         odb = LooseObjectDB(fixture_path('objects'))
         mdb = MemoryDB()
@@ -83,6 +83,17 @@ def remove(*args, **kwargs):
     return _retry(os.remove, *args, **kwargs)
 
 
+# kernel-side copying of file ranges, see copy_file_range_to
+_kernel_copy_methods = list()
+if hasattr(os, 'sendfile'):
+    _kernel_copy_methods.append(lambda in_fd, offset, count, out_fd: os.sendfile(out_fd, in_fd, offset, count))
+if hasattr(os, 'copy_file_range'):
+    _kernel_copy_methods.append(lambda in_fd, offset, count, out_fd: os.copy_file_range(in_fd, out_fd, count, offset))
+_kernel_copy_unsupported_errors = {getattr(errno, name) for name in
+                                   ('EINVAL', 'ENOSYS', 'EXDEV', 'EBADF', 'ENOTSOCK', 'EOPNOTSUPP', 'ENOTSUP')
+                                   if hasattr(errno, name)}
+
+
 # Backwards compatibility imports
 from gitdb.const import (
     NULL_BIN_SHA,
@@ -216,6 +227,64 @@ def sliding_ro_buffer(filepath, flags=0):
     return SlidingWindowMapBuffer(mman.make_cursor(filepath), flags=flags)
 
 
+def release_unused_maps():
+    """Unmap all regions of our memory manager which are not used by any cursor anymore,
+    which also releases their file handles
+    :return: amount of released regions"""
+    return mman.collect()
+
+
+def copy_file_range_to(in_fd, offset, size, out):
+    """Copy a range of bytes from a file into another file or a socket, letting the kernel
+    do the work if possible. ``os.sendfile`` is tried first, then ``os.copy_file_range``,
+    and data is finally copied through userspace if the platform supports neither for
+    the given descriptors.
+
+    :param in_fd: file descriptor of a regular file to read from. Its position may change
+    :param offset: absolute offset into in_fd to start copying at
+    :param size: amount of bytes to copy
+    :param out: file descriptor, or an object with a fileno() method, like a socket or
+        a file. Data is written at its current position, which is advanced accordingly.
+        Buffered file objects must be flushed before
+    :return: amount of bytes copied, which is smaller than size only if the end of in_fd was reached"""
+    if hasattr(out, 'fileno'):
+        out = out.fileno()
+    # END handle file-like objects
+
+    copied = 0
+    for method in _kernel_copy_methods:
+        try:
+            while copied < size:
+                count = method(in_fd, offset + copied, size - copied, out)
+                if not count:
+                    return copied
+                # END handle end of file
+                copied += count
+            # END copy loop
+            return copied
+        except OSError as e:
+            # continue with the next method where this one stopped if it is unsupported
+            if e.errno not in _kernel_copy_unsupported_errors:
+                raise
+            # END handle unsupported operation
+        # END exception handling
+    # END for each kernel method
+
+    while copied < size:
+        os.lseek(in_fd, offset + copied, os.SEEK_SET)
+        data = os.read(in_fd, min(size - copied, 1024 * 1024))
+        if not data:
+            break
+        # END handle end of file
+        view = memoryview(data)
+        while view:
+            view = view[os.write(out, view):]
+        # END write all
+        copied += len(data)
+    # END userspace copy loop
+    return copied
+
+
 def to_hex_sha(sha):
     """:return: hexified version  of sha"""
     if len(sha) == 40: